@@ -19,6 +19,10 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from .poll_api import PollAPI
 
 
@@ -27,13 +31,36 @@ class InterpretationList(object):
     Represents the interpretation list from GeL CIP-API. Can be used to return
     a list of case numbers by status along with the hash of the current case
     data.
+
+    With workers > 1 the first page is fetched on its own to find the number
+    of pages, then the rest are fetched concurrently. Pages are always merged
+    and filtered in page order as they arrive. Time spent listing is kept in
+    self.timings.
     """
-    def __init__(self, sample_type, sample=None):
+    west_london_codes = ['RYJ', 'RQM', 'RPY', 'RT3', 'RYJ99', 'TRX', 'CW', 'FPNE', 'WM', 'WLGMC']
+    status_lookup = {'raredisease': ["sent_to_gmcs", "report_generated", "report_sent"],
+                     'cancer': ['interpretation_generated', "sent_to_gmcs", "report_generated", "report_sent"]}
+
+    def __init__(self, sample_type, sample=None, workers=1):
         self.sample_type = sample_type
         self.sample = sample
+        self.workers = max(int(workers or 1), 1)
+        self.timings = {}
+        # cases_to_poll and blocked_cases are filled as each page is read
+        self.cases_to_poll = []
+        self.blocked_cases = []
         self.all_cases = self.get_all_cases()
-        self.cases_to_poll = self.get_poll_cases()
-        self.blocked_cases = self.get_blocked_cases()
+
+    def get_page(self, page):
+        """
+        Polls a single page of the interpretation request list and returns
+        its json.
+        """
+        request_list_poll = PollAPI(
+            "cip_api",
+            "interpretation-request?page={page}".format(page=page)
+        )
+        return request_list_poll.get_json_response()
 
     def get_all_cases(self):
         """
@@ -41,76 +68,104 @@ class InterpretationList(object):
         given user.
         """
         all_cases = []
-        west_london_codes = ['RYJ', 'RQM', 'RPY', 'RT3', 'RYJ99', 'TRX', 'CW', 'FPNE', 'WM', 'WLGMC']
-        last_page = False
+        start = time.time()
+
         page = 1
-        while not last_page:
-            request_list_poll = PollAPI(
-                "cip_api",
-                "interpretation-request?page={page}".format(page=page)
-            )
-            request_list_poll.get_json_response()
-            request_list_results = request_list_poll.response_json["results"]
-
-            if self.sample:
-                all_cases += [{
-                    # add the ir_id, sample type, and latest status to dict
-                    "interpretation_request_id":
-                        result["interpretation_request_id"],
-                    "sample_type":
-                        result["sample_type"],
-                    "last_status":
-                        result["last_status"]}
-                    for result in request_list_results
-                    if result["sample_type"] == self.sample_type
-                    and result['proband'] == self.sample]
-            else:
-                for result in request_list_results:
-                    download = True
-                    if result["sample_type"] == self.sample_type and not result['proband'].startswith('12000'):
-                        if not result['sites']:
-                            pass  # Download just in case
-                        elif len(result['sites']) > 1:
-                            part_of_west_london = []
-                            for site in result['sites']:
-                                part_of_west_london.append(any([f.startswith(site) for f in west_london_codes]))
-                            if all(part_of_west_london):
-                                download = False
-                        elif any([f.startswith(result['sites'][0]) for f in west_london_codes]):
-                            download = False
-                        if download:
-                            all_cases.append({
-                                # add the ir_id, sample type, and latest status to dict
-                                "interpretation_request_id":
-                                    result["interpretation_request_id"],
-                                "sample_type":
-                                    result["sample_type"],
-                                "last_status":
-                                    result["last_status"]})
-
-            if request_list_poll.response_json["next"]:
-                page += 1
-            else:
-                last_page = True
-
-        self.all_cases_count = request_list_poll.response_json["count"]
+        page_json = self.get_page(page)
+        all_cases += self.add_page(page_json["results"])
+        self.all_cases_count = page_json["count"]
+        self.timings["first_page"] = time.time() - start
+
+        if page_json["next"] and self.workers > 1 and page_json["results"]:
+            # count and page size from the first page tell us how many pages
+            # there are, so fetch the rest at once
+            page_size = len(page_json["results"])
+            last_page = int(math.ceil(page_json["count"] / float(page_size)))
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                # map yields in page order, so filtering streams in order
+                for next_json in executor.map(self.get_page, range(2, last_page + 1)):
+                    if not next_json.get("results"):
+                        # the listing has shrunk since the first page was
+                        # read, and pages past its end are 404s
+                        break
+                    page += 1
+                    page_json = next_json
+                    all_cases += self.add_page(page_json["results"])
+                    self.all_cases_count = page_json["count"]
+
+        # follow next sequentially; in parallel mode this only picks up pages
+        # added to the listing while the others were being fetched
+        while page_json["next"]:
+            next_json = self.get_page(page + 1)
+            if not next_json.get("results"):
+                break
+            page += 1
+            page_json = next_json
+            all_cases += self.add_page(page_json["results"])
+            self.all_cases_count = page_json["count"]
+
+        self.timings["pages"] = page
+        self.timings["total"] = time.time() - start
+        print("Listed {cases} cases from {pages} pages in {total:.1f}s "
+              "({workers} workers)".format(
+                  cases=len(all_cases), workers=self.workers, **self.timings))
         return all_cases
 
-    def get_poll_cases(self):
+    def add_page(self, request_list_results):
         """
-        Removes cases from self.all_cases which are not of interest, ie. keep
-        only 'sent_to_gmcs', 'report_generated', 'report_sent'.
+        Filters one page of listing results and adds the cases kept to
+        cases_to_poll and blocked_cases by their status. Returns the cases
+        kept.
         """
-        status_lookup = {'raredisease': [ "sent_to_gmcs", "report_generated", "report_sent"],
-                         'cancer': ['interpretation_generated', "sent_to_gmcs", "report_generated", "report_sent"]}
-        cases_to_poll = [
-            case for case in self.all_cases if case["last_status"] in status_lookup[self.sample_type]]
+        cases = self.filter_results(request_list_results)
+        self.cases_to_poll += [
+            case for case in cases if case["last_status"] in self.status_lookup[self.sample_type]]
+        self.blocked_cases += [case for case in cases if case["last_status"] == 'blocked']
+        return cases
 
-        return cases_to_poll
+    def filter_results(self, request_list_results):
+        """
+        Keeps the results of the desired sample type (and proband, if
+        self.sample is set), otherwise dropping pilot cases and cases which
+        belong only to West London sites.
+        """
+        cases = []
+        if self.sample:
+            cases += [
+                self.listing_entry(result)
+                for result in request_list_results
+                if result["sample_type"] == self.sample_type
+                and result['proband'] == self.sample]
+        else:
+            for result in request_list_results:
+                download = True
+                if result["sample_type"] == self.sample_type and not result['proband'].startswith('12000'):
+                    if not result['sites']:
+                        pass  # Download just in case
+                    elif len(result['sites']) > 1:
+                        part_of_west_london = []
+                        for site in result['sites']:
+                            part_of_west_london.append(any([f.startswith(site) for f in self.west_london_codes]))
+                        if all(part_of_west_london):
+                            download = False
+                    elif any([f.startswith(result['sites'][0]) for f in self.west_london_codes]):
+                        download = False
+                    if download:
+                        cases.append(self.listing_entry(result))
+        return cases
 
-    def get_blocked_cases(self):
+    def listing_entry(self, result):
         """
-        Finds all cases with a blocked status so the status of these cases can be updated
+        Takes the fields we keep from a listing result: the ir_id, sample
+        type and latest status, plus the version and modification markers
+        used to tell whether a case has changed since it was last fetched.
+        These last may not be present in every CIP-API release, so are None
+        if missing.
         """
-        blocked_cases = [case for case in self.all_cases if case["last_status"] == 'blocked']
-        return blocked_cases
+        return {
+            "interpretation_request_id": result["interpretation_request_id"],
+            "sample_type": result["sample_type"],
+            "last_status": result["last_status"],
+            "version": result.get("version"),
+            "last_modified": result.get("last_modified"),
+            "cip_version": result.get("cip_version")}
@@ -0,0 +1,504 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import base64
+import json
+import logging
+import random
+import threading
+import time
+
+import requests
+
+from ..config import load_config
+from .rate_limiter import RateLimiter, parse_rates
+from .replay import ReplayStore, fake_token, is_token_url, make_response
+
+logger = logging.getLogger(__name__)
+
+
+class RetryableResponseError(Exception):
+    """
+    Raised for responses worth trying again: server errors and throttling.
+    """
+    def __init__(self, url, status_code):
+        self.url = url
+        self.status_code = status_code
+        Exception.__init__(self, "{status} response from {url}".format(
+            status=status_code, url=url))
+
+
+class TokenError(Exception):
+    """
+    Raised when a token endpoint doesn't give a token, e.g. because the
+    credentials were refused.
+    """
+    pass
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of making a request to a host whose circuit is open.
+    """
+    pass
+
+
+# errors after which a request is retried, and which count against a host's
+# circuit breaker. ValueError covers bodies which aren't valid JSON.
+RETRYABLE_ERRORS = (
+    requests.exceptions.RequestException, ValueError, RetryableResponseError)
+
+
+class CircuitBreaker(object):
+    """
+    Tracks consecutive failures of requests to one host.
+
+    After failure_threshold failures in a row the circuit opens and requests
+    fail immediately with CircuitOpenError. Once reset_timeout seconds have
+    passed a single trial request is let through: if it succeeds the circuit
+    closes, if it fails the circuit opens again.
+    """
+    def __init__(self, host, failure_threshold=5, reset_timeout=120):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow_request(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.trial_in_progress or \
+                    time.time() - self.opened_at < self.reset_timeout:
+                return False
+            self.trial_in_progress = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.trial_in_progress = False
+
+    def record_failure(self):
+        """
+        Returns True if this failure opened the circuit.
+        """
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.trial_in_progress or (
+                    self.opened_at is None and
+                    self.consecutive_failures >= self.failure_threshold):
+                self.trial_in_progress = False
+                self.opened_at = time.time()
+                return True
+            return False
+
+
+class HTTPClient(object):
+    """
+    Process-wide HTTP client shared by every PollAPI instance.
+
+    Holds one keep-alive requests.Session per host so that successive polls
+    reuse open TLS connections rather than handshaking each time, and caches
+    CIP-API JWTs so a token is only minted when the cached one is close to
+    expiry or has been rejected by the server. Failed requests are retried by
+    call() with exponential backoff, within a budget per call and per run,
+    and each host has a CircuitBreaker so a degraded server fails fast.
+
+    Attributes:
+        max_retries (int): retries of a single call() before giving up.
+        retry_budget (int): retries allowed across every call in the current
+            run; see start_run(). None for no limit.
+        retries_left (int): what remains of retry_budget.
+        circuits (dict): host -> CircuitBreaker.
+        circuit_events (list): (host, time opened, failures) for each circuit
+            opened since the last call to pop_circuit_events().
+        rate_limiter (RateLimiter): request rate limits per host, shared with
+            other processes, or None for no limits.
+        pool_maxsize (int): number of keep-alive connections kept per host;
+            should be at least the number of threads polling a host at once.
+        sessions (dict): host -> requests.Session.
+        tokens (dict): token URL -> (token, expiry as a unix timestamp).
+        tokens_minted (int): number of tokens fetched from token endpoints.
+        replay_mode (str): 'off' to talk to the real servers, 'record' to
+            also save each response to replay_store, or 'replay' to answer
+            every request from replay_store without touching the network.
+        replay_store (ReplayStore): recorded responses, if replay_mode isn't
+            'off'.
+        standin_url (str): base URL of a stand-in server (see the
+            run_api_standin management command) which PollAPI should send
+            requests to instead of the real servers, or None.
+    """
+    # refresh a cached token this many seconds before it actually expires
+    TOKEN_REFRESH_MARGIN = 60
+    # lifetime assumed for tokens whose expiry can't be read from the payload
+    TOKEN_DEFAULT_LIFETIME = 300
+    # retry n waits a random time up to min(BACKOFF_BASE * 2 ** n, BACKOFF_MAX)
+    BACKOFF_BASE = 1
+    BACKOFF_MAX = 60
+
+    def __init__(self, max_retries=5, pool_maxsize=32, replay_mode='off',
+                 replay_dir=None, standin_url=None, retry_budget=None,
+                 circuit_failures=5, circuit_reset=120, rate_limiter=None):
+        self.max_retries = max_retries
+        self.retry_budget = retry_budget
+        self.retries_left = retry_budget
+        self.circuit_failures = circuit_failures
+        self.circuit_reset = circuit_reset
+        self.circuits = {}
+        self.circuit_events = []
+        self.pool_maxsize = pool_maxsize
+        if replay_mode not in ('off', 'record', 'replay'):
+            raise ValueError(
+                '{} is not a valid replay mode; please use off, record or '
+                'replay.'.format(replay_mode))
+        self.replay_mode = replay_mode
+        self.replay_store = None
+        if replay_mode != 'off':
+            self.replay_store = ReplayStore(replay_dir)
+        self.standin_url = standin_url or None
+        self.rate_limiter = rate_limiter
+
+        self.sessions = {}
+        self.tokens = {}
+        self.tokens_minted = 0
+        self.host_semaphores = {}
+
+        self._sessions_lock = threading.Lock()
+        self._tokens_lock = threading.Lock()
+        self._retries_lock = threading.Lock()
+
+    def get_session(self, host):
+        """
+        Returns the keep-alive session for a host, creating it on first use.
+        """
+        with self._sessions_lock:
+            session = self.sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                # retries are handled with backoff by call(), not the adapter
+                adapter = requests.adapters.HTTPAdapter(
+                    max_retries=0,
+                    pool_connections=1,
+                    pool_maxsize=self.pool_maxsize)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self.sessions[host] = session
+            return session
+
+    def set_host_concurrency(self, host, limit):
+        """
+        Cap the number of simultaneous requests made to a host.
+
+        Args:
+            host (str): the network location of the server, e.g.
+                cipapi.genomicsengland.nhs.uk
+            limit (int): maximum requests in flight; None or < 1 removes the
+                cap.
+        """
+        with self._sessions_lock:
+            if limit is None or int(limit) < 1:
+                self.host_semaphores.pop(host, None)
+            else:
+                self.host_semaphores[host] = threading.BoundedSemaphore(
+                    int(limit))
+
+    def get_host_semaphore(self, host):
+        """
+        Returns the semaphore capping requests to a host, or None if uncapped.
+        """
+        with self._sessions_lock:
+            return self.host_semaphores.get(host)
+
+    @property
+    def offline(self):
+        """
+        True if requests are answered from recordings rather than live
+        servers, so no real credentials are needed.
+        """
+        return self.replay_mode == 'replay' or self.standin_url is not None
+
+    def request(self, method, host, **kwargs):
+        """
+        Make a request through the host's pooled session, waiting for a free
+        slot if the host has a concurrency cap. In replay mode the response
+        comes from the replay store instead; in record mode it is also saved
+        there.
+        """
+        url = kwargs["url"]
+        if self.replay_mode == 'replay':
+            if is_token_url(url):
+                return make_response(
+                    url, 200, json.dumps({"token": fake_token()}).encode())
+            return self.replay_store.replay(url)
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(host)
+        session = self.get_session(host)
+        semaphore = self.get_host_semaphore(host)
+        if semaphore is None:
+            response = session.request(method, **kwargs)
+        else:
+            with semaphore:
+                response = session.request(method, **kwargs)
+
+        if self.replay_mode == 'record' and not is_token_url(url):
+            self.replay_store.record(url, response)
+        return response
+
+    def get(self, host, **kwargs):
+        return self.request("GET", host, **kwargs)
+
+    def get_circuit(self, host):
+        with self._sessions_lock:
+            circuit = self.circuits.get(host)
+            if circuit is None:
+                circuit = CircuitBreaker(
+                    host, self.circuit_failures, self.circuit_reset)
+                self.circuits[host] = circuit
+            return circuit
+
+    def call(self, host, attempt):
+        """
+        Runs attempt() until it returns without one of RETRYABLE_ERRORS,
+        sleeping with exponential backoff and jitter between tries.
+
+        Gives up, re-raising the last error, after max_retries retries or
+        once the run's retry budget is spent. Raises CircuitOpenError without
+        calling attempt() if the host's circuit is open.
+        """
+        circuit = self.get_circuit(host)
+        retries = 0
+        while True:
+            if not circuit.allow_request():
+                raise CircuitOpenError(
+                    "Circuit open for {host} after {failures} consecutive "
+                    "failures".format(
+                        host=host, failures=circuit.consecutive_failures))
+            try:
+                result = attempt()
+            except RETRYABLE_ERRORS as e:
+                if circuit.record_failure():
+                    logger.warning("Opening circuit for " + host + ": " + str(e))
+                    with self._sessions_lock:
+                        self.circuit_events.append(
+                            (host, time.time(), circuit.consecutive_failures))
+                if retries >= self.max_retries or not self.take_retry():
+                    raise
+                retries += 1
+                logger.info("Retrying {host} ({retries}/{max}): {error}".format(
+                    host=host, retries=retries, max=self.max_retries, error=e))
+                time.sleep(self.backoff_delay(retries))
+            else:
+                circuit.record_success()
+                return result
+
+    def backoff_delay(self, retries):
+        return random.uniform(
+            0, min(self.BACKOFF_BASE * 2 ** retries, self.BACKOFF_MAX))
+
+    def take_retry(self):
+        """
+        Spends one retry from the run's budget; False if none are left.
+        """
+        with self._retries_lock:
+            if self.retries_left is None:
+                return True
+            if self.retries_left <= 0:
+                return False
+            self.retries_left -= 1
+            return True
+
+    def start_run(self):
+        """
+        Refills the retry budget at the start of a run, e.g. a database
+        update.
+        """
+        with self._retries_lock:
+            self.retries_left = self.retry_budget
+
+    def pop_circuit_events(self):
+        """
+        Returns and clears the circuits opened since the last call, as
+        (host, time opened, failures) tuples.
+        """
+        with self._sessions_lock:
+            events, self.circuit_events = self.circuit_events, []
+            return events
+
+    def post(self, host, **kwargs):
+        return self.request("POST", host, **kwargs)
+
+    def get_token(self, host, token_url, credentials, stale_token=None):
+        """
+        Returns a JWT for token_url, minting one only if none is cached, the
+        cached one is near expiry, or the caller reports it has been rejected.
+
+        Args:
+            host (str): network location of the token endpoint.
+            token_url (str): URL to POST credentials to.
+            credentials (dict): username and password to POST.
+            stale_token (str): a token the server has refused (e.g. with a
+                401). If it is still the cached token a new one is minted;
+                if another thread has already replaced it, the replacement is
+                returned without minting again.
+
+        Returns:
+            str: the token.
+
+        Raises:
+            RetryableResponseError: for server error and throttling
+                responses.
+            TokenError: for any other response without a token.
+        """
+        with self._tokens_lock:
+            cached = self.tokens.get(token_url)
+            if cached is not None:
+                token, expiry = cached
+                fresh = expiry - time.time() > self.TOKEN_REFRESH_MARGIN
+                if fresh and token != stale_token:
+                    return token
+
+            # a failed mint must not leave a token cached, or it would be
+            # reused until it expired
+            self.tokens.pop(token_url, None)
+            token_response = self.post(
+                host, url=token_url, json=credentials)
+            status = token_response.status_code
+            if status >= 500 or status == 429:
+                raise RetryableResponseError(token_url, status)
+            token = None
+            if status == 200:
+                try:
+                    token = token_response.json().get("token")
+                except (AttributeError, ValueError):
+                    token = None
+            if not token:
+                raise TokenError(
+                    "No token in {status} response from {url}: {body}".format(
+                        status=status, url=token_url,
+                        body=token_response.text[:500]))
+            self.tokens_minted += 1
+            self.tokens[token_url] = (token, self.get_token_expiry(token))
+            return token
+
+    def get_token_expiry(self, token):
+        """
+        Reads the exp claim from a JWT's payload. The signature is not
+        checked; this is only used to decide when to refresh our own token.
+        """
+        try:
+            payload = token.split(".")[1]
+            payload += "=" * (-len(payload) % 4)
+            claims = json.loads(
+                base64.urlsafe_b64decode(payload.encode()).decode())
+            return float(claims["exp"])
+        except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+            return time.time() + self.TOKEN_DEFAULT_LIFETIME
+
+    def connection_stats(self):
+        """
+        Counts connections opened and requests that reused an open connection,
+        per host, from the urllib3 pools behind each session.
+
+        Returns:
+            dict: host -> {'opened': int, 'reused': int, 'requests': int}
+        """
+        stats = {}
+        with self._sessions_lock:
+            sessions = list(self.sessions.items())
+        for host, session in sessions:
+            host_stats = {'opened': 0, 'reused': 0, 'requests': 0}
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in list(pools.keys()):
+                    pool = pools.get(key)
+                    if pool is None:
+                        continue
+                    host_stats['opened'] += pool.num_connections
+                    host_stats['requests'] += pool.num_requests
+            host_stats['reused'] = max(
+                host_stats['requests'] - host_stats['opened'], 0)
+            stats[host] = host_stats
+        return stats
+
+    def close(self):
+        """
+        Closes all pooled connections and forgets cached tokens.
+        """
+        with self._sessions_lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
+        with self._tokens_lock:
+            self.tokens = {}
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_http_client():
+    """
+    Returns the process-wide HTTPClient, creating it on first use with the
+    retry, rate limit and replay settings from config.txt.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            config_dict = load_config.LoadConfig().load()
+            retry_budget = config_dict.get('api_retry_budget')
+            rate_limiter = None
+            rates = parse_rates(config_dict.get('rate_limits'))
+            if rates:
+                rate_limiter = RateLimiter(
+                    config_dict.get('rate_limit_dir', '/tmp/gel2mdt_rate_limits'),
+                    rates,
+                    burst=float(config_dict.get('rate_limit_burst', 1)))
+            _client = HTTPClient(
+                max_retries=int(config_dict.get('api_max_retries', 5)),
+                retry_budget=int(retry_budget) if retry_budget else None,
+                circuit_failures=int(config_dict.get('api_circuit_failures', 5)),
+                circuit_reset=float(config_dict.get('api_circuit_reset', 120)),
+                rate_limiter=rate_limiter,
+                replay_mode=config_dict.get('api_replay_mode', 'off'),
+                replay_dir=config_dict.get('api_replay_dir'),
+                standin_url=config_dict.get('api_standin_url'))
+        return _client
+
+
+def set_http_client(client):
+    """
+    Replaces the process-wide HTTPClient, e.g. to switch a test or
+    benchmark to replaying recorded responses. Returns the previous client.
+    """
+    global _client
+    with _client_lock:
+        previous, _client = _client, client
+        return previous
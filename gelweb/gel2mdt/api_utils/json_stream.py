@@ -0,0 +1,216 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import codecs
+import hashlib
+import json
+
+CHUNK_SIZE = 1 << 20
+
+
+class MemberReader(object):
+    """
+    Reads the members of a JSON file's top level object one at a time,
+    decoding only as much of the file as the current member needs.
+
+    Attributes:
+        json_file (file): the JSON file, opened in binary mode.
+        buffer (str): decoded text not yet consumed.
+        buffer_offset (int): byte offset in the file of buffer[0].
+    """
+    def __init__(self, json_file, chunk_size=CHUNK_SIZE):
+        self.json_file = json_file
+        self.chunk_size = chunk_size
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.buffer_offset = 0
+        self.eof = False
+
+    def fill(self):
+        """
+        Reads more of the file, growing the buffer fourfold so that a large
+        member is only re-decoded a few times while it is being read in.
+        """
+        if self.eof:
+            return False
+        chunk = self.json_file.read(max(self.chunk_size, 3 * len(self.buffer)))
+        self.eof = not chunk
+        self.buffer += self.utf8.decode(chunk, final=self.eof)
+        return True
+
+    def next_char(self, pos):
+        """
+        Returns the index and value of the first non-whitespace character at
+        or after pos, or (pos, None) at the end of the file.
+        """
+        while True:
+            while pos < len(self.buffer) and self.buffer[pos] in " \t\n\r":
+                pos += 1
+            if pos < len(self.buffer):
+                return pos, self.buffer[pos]
+            if not self.fill():
+                return pos, None
+
+    def decode(self, pos):
+        """
+        Decodes the JSON value starting at pos, reading more of the file
+        until the value is complete. Returns the value and the index after it.
+        """
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, pos)
+            except json.JSONDecodeError:
+                if self.fill():
+                    continue
+                raise
+            # a number cut off by the end of the buffer decodes to its first
+            # part, so make sure what follows can't be more of it
+            if end < len(self.buffer) and self.buffer[end] not in "0123456789.eE+-":
+                return value, end
+            if not self.fill():
+                return value, end
+
+    def byte_offset(self, pos):
+        return self.buffer_offset + len(self.buffer[:pos].encode("utf-8"))
+
+    def consume(self, pos):
+        self.buffer_offset = self.byte_offset(pos)
+        self.buffer = self.buffer[pos:]
+
+    def members(self):
+        """
+        Generator of (key, value, value_start, value_end) for each member of
+        the top level object, with the value's byte offsets in the file.
+        """
+        pos, char = self.next_char(0)
+        if char != "{":
+            raise ValueError("JSON document is not an object")
+        pos, char = self.next_char(pos + 1)
+        if char == "}":
+            return
+        while True:
+            if char != '"':
+                raise ValueError("Expected a key at byte {}".format(self.byte_offset(pos)))
+            key, pos = self.decode(pos)
+            pos, char = self.next_char(pos)
+            if char != ":":
+                raise ValueError("Expected ':' at byte {}".format(self.byte_offset(pos)))
+            pos, char = self.next_char(pos + 1)
+            self.consume(pos)
+            value_start = self.buffer_offset
+            value, pos = self.decode(0)
+            self.consume(pos)
+            yield key, value, value_start, self.buffer_offset
+            del value
+
+            pos, char = self.next_char(0)
+            if char == "}":
+                return
+            if char != ",":
+                raise ValueError("Expected ',' or '}}' at byte {}".format(self.byte_offset(pos)))
+            pos, char = self.next_char(pos + 1)
+
+
+def canonical_chunks(value, depth=3):
+    """
+    Yields json.dumps(value, sort_keys=True) in pieces, serialising the
+    containers in the top depth levels an item at a time so that no single
+    string as large as the whole value is built.
+    """
+    if depth and isinstance(value, dict) and value:
+        for i, key in enumerate(sorted(value)):
+            yield "{opening}{key}: ".format(
+                opening=", " if i else "{", key=json.dumps(key))
+            for chunk in canonical_chunks(value[key], depth - 1):
+                yield chunk
+        yield "}"
+    elif depth and isinstance(value, list) and value:
+        for i, item in enumerate(value):
+            yield ", " if i else "["
+            for chunk in canonical_chunks(item, depth - 1):
+                yield chunk
+        yield "]"
+    else:
+        yield json.dumps(value, sort_keys=True)
+
+
+def hash_canonical(value):
+    """
+    Returns hashlib.sha512(json.dumps(value, sort_keys=True)).hexdigest(),
+    hashing the dump as it is produced instead of building it whole.
+    """
+    canonical_hash = hashlib.sha512()
+    for chunk in canonical_chunks(value):
+        canonical_hash.update(chunk.encode("utf-8"))
+    return canonical_hash.hexdigest()
+
+
+def load_sections(path, keep=None, chunk_size=CHUNK_SIZE, canonical_hash=True):
+    """
+    Parses a JSON object file one top level member at a time.
+
+    As well as the members named in keep, returns the SHA512 of the file's
+    canonical form, i.e. hashlib.sha512(json.dumps(obj, sort_keys=True))
+    for the whole object, so it compares equal to hashes taken of the fully
+    parsed json. Members not in keep are dropped as soon as they have been
+    read, so only one of them is held in memory at a time; they are read
+    again when their turn comes in the hash.
+
+    Args:
+        path (str): the JSON file.
+        keep (iterable): top level keys to return, or None for all of them.
+        chunk_size (int): bytes read at a time.
+        canonical_hash (bool): whether to compute the hash; if False, the
+            file is only read once and None is returned in its place.
+
+    Returns:
+        (dict, str): the kept members and the canonical hash.
+    """
+    keep = None if keep is None else set(keep)
+    sections = {}
+    offsets = {}
+    with open(path, "rb") as json_file:
+        for key, value, value_start, value_end in MemberReader(json_file, chunk_size).members():
+            # as with json.loads, a repeated key takes the last value
+            offsets[key] = (value_start, value_end)
+            if keep is None or key in keep:
+                sections[key] = value
+            del value
+        if not canonical_hash:
+            return sections, None
+
+        canonical_hash = hashlib.sha512(b"{")
+        for i, key in enumerate(sorted(offsets)):
+            if key in sections:
+                value = sections[key]
+            else:
+                value_start, value_end = offsets[key]
+                json_file.seek(value_start)
+                value = json.loads(json_file.read(value_end - value_start).decode("utf-8"))
+            canonical_hash.update("{separator}{key}: ".format(
+                separator=", " if i else "",
+                key=json.dumps(key)).encode("utf-8"))
+            for chunk in canonical_chunks(value):
+                canonical_hash.update(chunk.encode("utf-8"))
+            del value
+        canonical_hash.update(b"}")
+    return sections, canonical_hash.hexdigest()
@@ -23,9 +23,31 @@ import os
 import getpass
 import requests
 import json
+from urllib.parse import urlparse
 
 import labkey as lk
 
+from .http_client import RetryableResponseError, get_http_client
+
+
+def set_host_concurrency(host, limit):
+    """
+    Cap the number of simultaneous requests PollAPI makes to a host.
+
+    Args:
+        host (str): the network location of the server, e.g.
+            cipapi.genomicsengland.nhs.uk
+        limit (int): maximum requests in flight; None or < 1 removes the cap.
+    """
+    get_http_client().set_host_concurrency(host, limit)
+
+
+def get_host_semaphore(host):
+    """
+    Returns the semaphore capping requests to a host, or None if uncapped.
+    """
+    return get_http_client().get_host_semaphore(host)
+
 
 class PollAPI(object):
     """
@@ -49,6 +71,9 @@ class PollAPI(object):
         url (str): the URL which should give the desired JSON response. This is
             generated by formatting the 'server' format string with .format(),
             passing in the value for self.endpoint
+        host (str): the network location of url, used to pick the pooled
+            session in the shared HTTPClient and any cap on concurrent
+            requests set with set_host_concurrency()
         headers_required (bool): whether the API requires headers - either
             auth headers or simply Content-Type/Accept headers to specify a
             JSON response instead of XML. Auth headers only required for
@@ -56,7 +81,7 @@ class PollAPI(object):
             dict key; headers_required being the 1 index of the asoociated dict
             value tuple.
         headers (dict): the dict which is passed as a header value when polling
-            and API with requests.Session.get(). May be auth headers in the
+            and API with the shared HTTPClient. May be auth headers in the
             case of CIP-API and include a token, or may just specifiy a JSON
             request.
         token_url (str): the URL used to fetch an authentication token. This is
@@ -107,7 +132,8 @@ class PollAPI(object):
         }
 
         self.server = self.server_list[api][0]
-        self.url = self.server.format(endpoint=self.endpoint)
+        self.url = self.standin(self.server.format(endpoint=self.endpoint))
+        self.host = urlparse(self.url).netloc
         self.headers_required = self.server_list[api][1]
         self.headers = None
 
@@ -117,81 +143,94 @@ class PollAPI(object):
 
     def get_json_response(self, content=False):
         """
-        Creates a request session which polls the desired API for JSON.
-
-        Request will be tried 20 times (MAX_RETRIES) in the case of failure to
-        fetch a proper JSON. This covers connection/retrieval failures, but not
-        improper JSON objects which return despite a 200 code. This is instead
-        covered by a bool json_poll_sucess. At the end of each response, the
-        json library is used to attempt to decode the JSON into a dict. Upon a
-        failure, json_poll_sucess remains false and another request Session is
-        attempted.
+        Polls the desired API for JSON through the shared HTTPClient.
+
+        Each attempt is made by poll(). Connection failures, server error and
+        throttling responses, and bodies which aren't valid JSON are retried
+        by HTTPClient.call() with exponential backoff, up to api_max_retries
+        times for this call and within the run's api_retry_budget, after
+        which the last error is raised. If the host has been failing its
+        circuit is open, and CircuitOpenError is raised without polling.
+        """
+        return get_http_client().call(self.host, lambda: self.poll(content))
+
+    def poll(self, content=False):
+        """
+        Makes a single attempt to fetch the response, raising
+        RetryableResponseError for server error and throttling responses.
         """
-        json_poll_success = False
-        while not json_poll_success:
-            MAX_RETRIES = 20
-            session = requests.Session()
-            adapter = requests.adapters.HTTPAdapter(max_retries=MAX_RETRIES)
-            session.mount("https://", adapter)
-
-            # IF/ELIF/ELSE tree used to check several conditions. If headers
-            # are required (self.headers_required) and they have not yet been
-            # set (self.headers = None), then we must set the self.headers
-            # value. In the case of CIP-API, we need to fetch auth headers
-            # (first if statement), which is handled by the class method
-            # get_auth_headers(). If not, then standard headers can be set
-            # using get_headers() method instead. If headers are required and
-            # they HAVE been set, we can now use a GET method via the request
-            # Session to fetch the JSON API response, passing in the
-            # server/endpoint and the set headers. Finally, if headers are not
-            # required, we can call the GET response immediately without
-            # setting headers first.
-            if (self.headers_required) and (self.headers is None) and (self.api.startswith('cip_api')):
-                # get auth headers if we need them and they're not yet set
-                self.get_auth_headers()
-                continue
-            elif (self.headers_required) and (self.headers is None) and (self.api == 'genenames'):
-                self.get_headers()
-                continue
-            elif (self.headers_required) and (self.headers is None) and (self.api == 'ensembl'):
-                self.get_headers()
-                continue
-            elif (self.headers_required) and (self.headers is not None):
-                # auth headers required; have been set
-                response = session.get(
-                    url=self.url,
-                    headers=self.headers)
-            elif not self.headers_required:
-                # no headers required
-                response = session.get(
-                    url=self.url)
-
-            if content:
-                return response.content  # return the content, which is a JSON
-            else:
-                # The response may not have a content section, particularly in
-                # the case of errors. In this case, the whole response can be
-                # treated as a JSON, and will contain error information. We can
-                # extract this for debugging purposes - if it is decodable.
-                try:
-                    self.response_json = response.json()
-                    self.response_status = response.status_code
-                    json_poll_success = True
-                except json.JSONDecodeError as e:
-                    continue
-
-                return response.json()
-
-    def get_auth_headers(self):
+        self.set_headers()
+        if self.headers_required:
+            response = self.get_response(
+                url=self.url,
+                headers=self.headers)
+        else:
+            # no headers required
+            response = self.get_response(
+                url=self.url)
+
+        self.response_status = response.status_code
+        if response.status_code >= 500 or response.status_code == 429:
+            raise RetryableResponseError(self.url, response.status_code)
+
+        if content:
+            return response.content  # return the content, which is a JSON
+        # The response may not have a content section, particularly in the
+        # case of errors. In this case, the whole response can be treated as
+        # a JSON, and will contain error information. We can extract this for
+        # debugging purposes - if it is decodable; if not, the ValueError
+        # raised means the poll is tried again.
+        self.response_json = response.json()
+        return self.response_json
+
+    def set_headers(self):
         """
-        Creates a CIP-API token, then creates Accept/Auth header accordingly.
+        Sets the headers for the API if it needs them and they aren't set.
+        """
+        # IF/ELIF tree used to check several conditions. If headers are
+        # required (self.headers_required) and they have not yet been set
+        # (self.headers = None), then we must set the self.headers value. In
+        # the case of CIP-API, we need to fetch auth headers (first if
+        # statement), which is handled by the class method
+        # get_auth_headers(). If not, then standard headers can be set using
+        # get_headers() method instead.
+        if (self.headers_required) and (self.headers is None) and (self.api.startswith('cip_api')):
+            # get auth headers if we need them and they're not yet set
+            self.get_auth_headers()
+        elif (self.headers_required) and (self.headers is None) and (self.api == 'genenames'):
+            self.get_headers()
+        elif (self.headers_required) and (self.headers is None) and (self.api == 'ensembl'):
+            self.get_headers()
+
+    def get_response(self, **kwargs):
+        """
+        GET a response through the shared HTTPClient.
+
+        If CIP-API rejects the token (401), the cached token is assumed to
+        have expired early or been revoked, so a new one is fetched and the
+        request is tried once more.
+        """
+        client = get_http_client()
+        response = client.get(self.host, **kwargs)
+        if response.status_code == 401 and self.api.startswith('cip_api'):
+            self.get_auth_headers(stale=True)
+            kwargs["headers"] = self.headers
+            response = client.get(self.host, **kwargs)
+        return response
+
+    def get_auth_headers(self, stale=False):
+        """
+        Gets a CIP-API token, then creates Accept/Auth header accordingly.
 
         Token is created based on CIP-API username and password, which should
         be environment variables; class method get_credentials() ensures this.
-        Once executed, headers will be set as a class instance attribute.
+        Tokens are cached by the shared HTTPClient and reused by every PollAPI
+        until they near expiry. Once executed, headers will be set as a class
+        instance attribute.
 
         Args:
-            None
+            stale (bool): the token in the current headers has been refused
+                by the server and must not be reused.
 
         Returns:
             None
@@ -201,22 +240,41 @@ class PollAPI(object):
             "cip_api_for_report": "get-token/"}
         token_endpoint = token_endpoint_list[self.api]
 
-        self.token_url = self.server.format(endpoint=token_endpoint)
+        stale_token = None
+        if stale and self.headers:
+            stale_token = self.headers.get("Authorization", "")[len("JWT "):]
+
+        self.token_url = self.standin(self.server.format(endpoint=token_endpoint))
         self.get_credentials()
-        token_response = requests.post(
-            url=self.token_url,
-            json=dict(
+        token = get_http_client().get_token(
+            self.host,
+            self.token_url,
+            dict(
                 username=os.environ["cip_api_username"],
                 password=os.environ["cip_api_password"]
             ),
-        )
-
-        token_json = token_response.json()
+            stale_token=stale_token)
 
         self.headers = {
             "Accept": "application/json",
             "Authorization": "JWT {token}".format(
-                token=token_json.get("token"))}
+                token=token)}
+
+    def standin(self, url):
+        """
+        If a stand-in server is configured (api_standin_url in config.txt),
+        rewrites url to point at it, keeping the original host as the first
+        path segment so the stand-in knows which API is being polled, e.g.
+        http://127.0.0.1:8800/rest.genenames.org/fetch/symbol/BRCA1
+        """
+        standin_url = get_http_client().standin_url
+        if standin_url is None:
+            return url
+        parsed = urlparse(url)
+        return "{standin}/{host}{resource}".format(
+            standin=standin_url.rstrip("/"),
+            host=parsed.netloc,
+            resource=url[len(parsed.scheme + "://" + parsed.netloc):])
 
     def get_headers(self):
         """
@@ -251,6 +309,10 @@ class PollAPI(object):
         Returns:
             None
         """
+        if get_http_client().offline:
+            # recorded responses don't check credentials
+            os.environ.setdefault("cip_api_username", "offline")
+            os.environ.setdefault("cip_api_password", "offline")
         try:
             user = os.environ["cip_api_username"]
         except KeyError as e:
@@ -0,0 +1,151 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # no file locking outside unix; buckets are then only shared by the
+    # threads of one process
+    fcntl = None
+
+
+def parse_rates(rate_string):
+    """
+    Parses the rate_limits config value, a comma separated list of
+    host:requests per second pairs, e.g.
+    cipapi.genomicsengland.nhs.uk:10,rest.ensembl.org:15
+    """
+    rates = {}
+    for pair in (rate_string or "").split(","):
+        if pair.strip():
+            host, rate = pair.strip().rsplit(":", 1)
+            rates[host] = float(rate)
+    return rates
+
+
+class RateLimiter(object):
+    """
+    Token bucket per host, shared by every process on the machine.
+
+    Each host's bucket lives in a small json file in directory, updated under
+    an exclusive fcntl lock, so Celery workers, the batch update and web
+    views all draw from the same buckets without needing another service. A
+    bucket refills at the host's rate and holds at most burst tokens. Callers
+    take a token each; if none is available they reserve the next one, which
+    may take the bucket negative, and sleep until it is due. Reserving rather
+    than polling means waiting callers are served in the order they arrived.
+
+    Attributes:
+        directory (str): where bucket state files are kept.
+        rates (dict): host -> requests per second. Hosts not listed are not
+            limited.
+        burst (float): seconds' worth of requests a bucket can hold.
+        metrics (dict): host -> {'requests', 'waited', 'max_wait'} for the
+            requests made by this process.
+    """
+    def __init__(self, directory, rates, burst=1.0):
+        self.directory = directory
+        self.rates = rates
+        self.burst = burst
+        self.metrics = {}
+        self._lock = threading.Lock()
+        if rates:
+            os.makedirs(directory, exist_ok=True)
+
+    def bucket_path(self, host):
+        return os.path.join(self.directory, host.replace(":", "_") + ".bucket")
+
+    def reserve(self, host, rate):
+        """
+        Takes a token from the host's bucket, returning how many seconds the
+        caller must wait before using it.
+        """
+        capacity = max(rate * self.burst, 1)
+        fd = os.open(self.bucket_path(host), os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, "r+") as bucket_file:
+            if fcntl is not None:
+                fcntl.flock(bucket_file, fcntl.LOCK_EX)
+            try:
+                state = json.loads(bucket_file.read() or "{}")
+            except ValueError:
+                state = {}
+            now = time.time()
+            tokens = state.get("tokens", capacity)
+            updated = state.get("updated", now)
+            tokens = min(capacity, tokens + (now - updated) * rate) - 1
+            wait = max(-tokens / rate, 0)
+            state.update({
+                "tokens": tokens,
+                "updated": now,
+                "requests": state.get("requests", 0) + 1,
+                "waited": state.get("waited", 0) + wait,
+            })
+            bucket_file.seek(0)
+            bucket_file.truncate()
+            bucket_file.write(json.dumps(state))
+            bucket_file.flush()
+            # closing the file releases the lock
+        return wait
+
+    def acquire(self, host):
+        """
+        Blocks until a request may be made to host. Returns the time waited.
+        """
+        rate = self.rates.get(host)
+        if not rate:
+            return 0
+        if fcntl is None:
+            with self._lock:
+                wait = self.reserve(host, rate)
+        else:
+            wait = self.reserve(host, rate)
+        if wait:
+            time.sleep(wait)
+
+        with self._lock:
+            host_metrics = self.metrics.setdefault(
+                host, {'requests': 0, 'waited': 0.0, 'max_wait': 0.0})
+            host_metrics['requests'] += 1
+            host_metrics['waited'] += wait
+            host_metrics['max_wait'] = max(host_metrics['max_wait'], wait)
+        return wait
+
+    def shared_metrics(self):
+        """
+        Returns host -> {'requests', 'waited'} totalled over every process
+        which has used the buckets since their files were created.
+        """
+        shared = {}
+        for host in self.rates:
+            try:
+                with open(self.bucket_path(host)) as bucket_file:
+                    state = json.loads(bucket_file.read() or "{}")
+            except (IOError, ValueError):
+                continue
+            shared[host] = {
+                'requests': state.get("requests", 0),
+                'waited': state.get("waited", 0.0)}
+        return shared
@@ -0,0 +1,199 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+
+
+# keys whose values identify a person; compared lower case with underscores
+# and spaces removed
+SENSITIVE_KEYS = {
+    'firstname', 'lastname', 'surname', 'forename', 'forenames', 'fullname',
+    'clinicianname', 'dateofbirth', 'dob', 'nhsnumber', 'hospitalnumber',
+    'email', 'emailaddress', 'address', 'postcode', 'phone', 'telephone',
+    'username', 'user', 'author', 'createdby', 'lastmodifiedby',
+}
+
+
+class RecordingNotFound(Exception):
+    """
+    Raised in replay mode when no response has been recorded for a URL.
+    """
+    pass
+
+
+def is_token_url(url):
+    return urlparse(url).path.rstrip("/").endswith("get-token")
+
+
+def fake_token(lifetime=3600):
+    """
+    Returns an unsigned JWT which HTTPClient will cache for lifetime seconds.
+    Used in place of a real CIP-API token when running offline.
+    """
+    def encode(part):
+        return base64.urlsafe_b64encode(
+            json.dumps(part).encode()).decode().rstrip("=")
+    return "{header}.{payload}.offline".format(
+        header=encode({"alg": "none", "typ": "JWT"}),
+        payload=encode({"username": "offline", "exp": int(time.time() + lifetime)}))
+
+
+def make_response(url, status_code, content, content_type="application/json"):
+    """
+    Builds a requests.Response as if it had come back from url.
+    """
+    response = requests.models.Response()
+    response.url = url
+    response.status_code = status_code
+    response._content = content
+    response.encoding = "utf-8"
+    response.headers["Content-Type"] = content_type
+    return response
+
+
+class ReplayStore(object):
+    """
+    Directory of recorded API responses, one json file per URL.
+
+    Recordings are keyed on the host, path and query string of the original
+    URL, so they can be served back either in-process by HTTPClient in replay
+    mode or over HTTP by the stand-in server, whatever host the stand-in runs
+    on. Values under SENSITIVE_KEYS are replaced with salted hashes before
+    being written; the salt is kept in the directory so that repeated values
+    stay consistent between recording sessions, and should be deleted before
+    a recording is shared.
+
+    Attributes:
+        directory (str): where the recordings are written.
+    """
+    salt_file = ".anonymisation_salt"
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._salt = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(url):
+        """
+        Returns the host and the hash of path + query identifying a URL.
+        """
+        parsed = urlparse(url)
+        resource = parsed.path
+        if parsed.query:
+            resource += "?" + parsed.query
+        return parsed.netloc, hashlib.sha1(resource.encode()).hexdigest()
+
+    def path(self, url):
+        host, digest = self.key(url)
+        return os.path.join(self.directory, host, digest + ".json")
+
+    @property
+    def salt(self):
+        with self._lock:
+            if self._salt is None:
+                salt_path = os.path.join(self.directory, self.salt_file)
+                if os.path.exists(salt_path):
+                    with open(salt_path) as salt_file:
+                        self._salt = salt_file.read().strip()
+                else:
+                    os.makedirs(self.directory, exist_ok=True)
+                    self._salt = base64.b16encode(os.urandom(16)).decode()
+                    with open(salt_path, "w") as salt_file:
+                        salt_file.write(self._salt)
+            return self._salt
+
+    def pseudonym(self, value):
+        digest = hashlib.sha256(
+            (self.salt + str(value)).encode()).hexdigest()[:12]
+        if isinstance(value, int) and not isinstance(value, bool):
+            return int(digest, 16)
+        return "anon-" + digest
+
+    def anonymise(self, data, sensitive=False):
+        """
+        Returns a copy of a decoded json with every value under a sensitive
+        key replaced with a pseudonym.
+        """
+        if isinstance(data, dict):
+            return {
+                key: self.anonymise(
+                    value,
+                    sensitive or key.lower().replace("_", "").replace(" ", "") in SENSITIVE_KEYS)
+                for key, value in data.items()}
+        elif isinstance(data, list):
+            return [self.anonymise(value, sensitive) for value in data]
+        elif sensitive and data is not None and not isinstance(data, bool):
+            return self.pseudonym(data)
+        return data
+
+    def record(self, url, response):
+        """
+        Anonymise and write a response to the store.
+        """
+        content_type = response.headers.get("Content-Type", "application/json")
+        try:
+            body = json.dumps(self.anonymise(json.loads(response.content.decode("utf-8"))))
+        except ValueError:
+            # not json, e.g. an html error page; nothing to anonymise
+            body = response.content.decode("utf-8", "replace")
+
+        recording_path = self.path(url)
+        os.makedirs(os.path.dirname(recording_path), exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(recording_path, threading.get_ident())
+        with open(tmp_path, "w") as recording_file:
+            json.dump({
+                "url": url,
+                "status_code": response.status_code,
+                "content_type": content_type,
+                "body": body,
+            }, recording_file)
+        os.replace(tmp_path, recording_path)
+
+    def load(self, url):
+        """
+        Returns the recording for url as a dict with status_code,
+        content_type and body, or raises RecordingNotFound.
+        """
+        try:
+            with open(self.path(url)) as recording_file:
+                return json.load(recording_file)
+        except FileNotFoundError:
+            raise RecordingNotFound("No recorded response for " + url)
+
+    def replay(self, url):
+        """
+        Returns the recording for url as a requests.Response.
+        """
+        recording = self.load(url)
+        return make_response(
+            url,
+            recording["status_code"],
+            recording["body"].encode("utf-8"),
+            recording["content_type"])
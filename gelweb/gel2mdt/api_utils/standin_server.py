@@ -0,0 +1,133 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import json
+import random
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from .replay import RecordingNotFound, fake_token, is_token_url
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    """
+    Serves recorded responses for requests of the form
+    /<original host>/<original path>?<original query>, as sent by PollAPI
+    when api_standin_url is set.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def original_url(self):
+        host, _, resource = self.path.lstrip("/").partition("/")
+        return "https://{host}/{resource}".format(host=host, resource=resource)
+
+    def send_body(self, status_code, body, content_type="application/json"):
+        body = body.encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def respond(self):
+        server = self.server
+        server.requests_served += 1
+        if server.latency:
+            time.sleep(max(
+                server.latency + server.random.uniform(-server.jitter, server.jitter), 0))
+        if server.error_rate and server.random.random() < server.error_rate:
+            server.errors_injected += 1
+            self.send_body(
+                server.error_status, json.dumps({"detail": "Injected error"}))
+            return
+
+        url = self.original_url()
+        if is_token_url(url):
+            self.send_body(200, json.dumps({"token": fake_token()}))
+            return
+        try:
+            recording = server.store.load(url)
+        except RecordingNotFound as e:
+            self.send_body(404, json.dumps({"detail": str(e)}))
+            return
+        self.send_body(
+            recording["status_code"], recording["body"], recording["content_type"])
+
+    def do_GET(self):
+        self.respond()
+
+    def do_POST(self):
+        # drain the body (token requests carry credentials) so the keep-alive
+        # connection stays usable
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.respond()
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class StandinServer(socketserver.ThreadingMixIn, HTTPServer):
+    """
+    Local HTTP server standing in for CIP-API, PanelApp, genenames and the
+    other APIs PollAPI talks to, serving responses from a ReplayStore.
+
+    Attributes:
+        store (ReplayStore): the recorded responses to serve.
+        latency (float): seconds to wait before answering each request.
+        jitter (float): latency is varied uniformly by up to this much.
+        error_rate (float): fraction of requests answered with error_status
+            instead of the recording.
+        error_status (int): HTTP status of injected errors.
+        requests_served (int): number of requests received.
+        errors_injected (int): number of requests answered with an error.
+    """
+    daemon_threads = True
+
+    def __init__(self, store, host="127.0.0.1", port=8800, latency=0.0,
+                 jitter=0.0, error_rate=0.0, error_status=503, seed=None,
+                 verbose=False):
+        HTTPServer.__init__(self, (host, port), StandinHandler)
+        self.store = store
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.verbose = verbose
+        self.requests_served = 0
+        self.errors_injected = 0
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return "http://{host}:{port}".format(host=host, port=port)
+
+    def start(self):
+        """
+        Serves requests from a background thread until shutdown() is called.
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
@@ -0,0 +1,428 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import copy
+import gc
+import hashlib
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import pandas as pd
+from django.db import transaction
+from django.utils import timezone
+
+from .api_utils.json_stream import hash_canonical
+from .database_utils.case_handler import CaseAttributeManager
+from .database_utils.copy_loader import CopyLoader
+from .database_utils.natural_keys import NaturalKeyIndex
+from .models import (
+    ToolOrAssemblyVersion, Transcript, Variant, TranscriptVariant,
+    InterpretationReportFamily, GELInterpretationReport, ProbandVariant)
+from .vep_utils import parse_vep
+from .vep_utils.run_vep_batch import CaseVariant, CaseTranscript, CSQ_FIELDS, transcript_records
+
+
+def measure(function, repeat=5):
+    """
+    Runs function once under tracemalloc for its peak memory, then repeat
+    times for its CPU time.
+
+    Returns:
+        (float, int): CPU seconds per call and peak bytes allocated.
+    """
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    start = time.process_time()
+    for _ in range(repeat):
+        function()
+    return (time.process_time() - start) / repeat, peak
+
+
+def case_json_benchmark(file_path, repeat=5, **options):
+    """
+    Compares the per case work Case used to do to keep and hash a case json
+    (deepcopy, then a sorted json.dumps of the whole payload) with the
+    canonical and raw hash modes it uses now. Parsing the response is the
+    same for all of them and isn't included.
+
+    Returns:
+        list: (name, CPU seconds per case, peak bytes) for each approach.
+    """
+    with open(file_path, 'rb') as json_file:
+        raw_json = json_file.read()
+    case_json = json.loads(raw_json.decode('utf-8'))
+
+    def deepcopy_and_dumps():
+        copy.deepcopy(case_json)
+        return hashlib.sha512(json.dumps(case_json, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def canonical():
+        return hash_canonical(case_json)
+
+    def raw():
+        return hashlib.sha512(raw_json).hexdigest()
+
+    if deepcopy_and_dumps() != canonical():
+        raise AssertionError('canonical hash differs from the deepcopy_and_dumps hash')
+    return [
+        (name, ) + measure(function, repeat)
+        for name, function in (
+            ('deepcopy_and_dumps', deepcopy_and_dumps),
+            ('canonical', canonical),
+            ('raw', raw))]
+
+
+class Rollback(Exception):
+    pass
+
+
+def new_transcript_variants(rows):
+    """
+    Makes the Transcripts and Variants for rows new TranscriptVariants, each
+    variant on 100 transcripts, and returns the unsaved TranscriptVariants.
+    """
+    assembly = ToolOrAssemblyVersion.objects.create(
+        tool_name='genome_build', version_number='benchmark')
+    transcripts_per_variant = 100
+    Transcript.objects.bulk_create([
+        Transcript(name='ENSTBENCH{}'.format(i), strand='+', genome_assembly=assembly)
+        for i in range(transcripts_per_variant)])
+    Variant.objects.bulk_create([
+        Variant(chromosome='1', position=i, reference='A', alternate='T',
+                genome_assembly=assembly)
+        for i in range(-(-rows // transcripts_per_variant))])
+    transcripts = list(Transcript.objects.filter(genome_assembly=assembly))
+    variants = list(Variant.objects.filter(genome_assembly=assembly))
+    return [
+        TranscriptVariant(
+            transcript=transcripts[i % transcripts_per_variant],
+            variant=variants[i // transcripts_per_variant],
+            af_max='0', hgvs_c='c.1A>T', hgvs_p='p.Met1?', hgvs_g='g.1A>T')
+        for i in range(rows)]
+
+
+def bulk_create_and_fetch(model_index, objs):
+    created = model_index.model_type.objects.bulk_create(objs)
+    model_index.add(created)
+    model_index.fetch(
+        key for key in (
+            model_index.key({
+                field.name: getattr(obj, field.attname)
+                for field in model_index.fields})
+            for obj in objs)
+        if key not in model_index.index)
+    return list(model_index.index.values())
+
+
+def ingest_write_benchmark(rows=50000, **options):
+    """
+    Compares the paths add_cases can use on the configured database to write
+    new TranscriptVariants and learn their ids: bulk_create then a fetch,
+    NaturalKeyIndex.upsert, and on PostgreSQL the CopyLoader. Each path runs
+    in a transaction which is rolled back, so nothing is left behind.
+
+    Returns:
+        list: (name, seconds, rows per second) for each available path.
+    """
+    paths = (
+        ('bulk_create', lambda model_index: True, bulk_create_and_fetch),
+        ('upsert', NaturalKeyIndex.can_upsert,
+         lambda model_index, objs: model_index.upsert(objs)),
+        ('copy', CopyLoader.supports,
+         lambda model_index, objs: CopyLoader(model_index).load(objs)))
+    results = []
+    for name, available, write in paths:
+        model_index = NaturalKeyIndex(TranscriptVariant)
+        if not available(model_index):
+            continue
+        try:
+            with transaction.atomic():
+                objs = new_transcript_variants(rows)
+                start = time.perf_counter()
+                written = write(model_index, objs)
+                seconds = time.perf_counter() - start
+                if len(written) != rows:
+                    raise AssertionError('{name} returned {count} rows, not {rows}'.format(
+                        name=name, count=len(written), rows=rows))
+                raise Rollback
+        except Rollback:
+            pass
+        results.append((name, seconds, rows / seconds))
+    return results
+
+
+def new_report_versions(rows, versions=2):
+    """
+    Creates rows GELInterpretationReports, versions of them for each of
+    rows / versions new InterpretationReportFamilies, with the newest
+    version of each flagged is_latest.
+    """
+    assembly = ToolOrAssemblyVersion.objects.create(
+        tool_name='genome_build', version_number='benchmark')
+    families = -(-rows // versions)
+    InterpretationReportFamily.objects.bulk_create([
+        InterpretationReportFamily(ir_family_id='B{}'.format(i), priority='routine', cip='benchmark')
+        for i in range(families)])
+    family_ids = list(InterpretationReportFamily.objects.filter(
+        cip='benchmark').values_list('id', flat=True))
+    now = timezone.now()
+    GELInterpretationReport.objects.bulk_create([
+        GELInterpretationReport(
+            ir_family_id=family_ids[i % families], archived_version=i // families + 1,
+            is_latest=i + families >= rows, status='report_sent', updated=now,
+            sample_type='raredisease', assembly=assembly, user='benchmark',
+            sha_hash='benchmark{}'.format(i))
+        for i in range(rows)])
+
+
+def pandas_latest_ids(sample_type):
+    """
+    The latest report ids as latest_cases_by_sample_type used to find them,
+    by loading every report into a DataFrame and dropping older versions.
+    """
+    qs = GELInterpretationReport.objects.filter(sample_type=sample_type)
+    qs_df = pd.DataFrame(list(qs.values())).sort_values(
+        by=["ir_family_id", "archived_version"])
+    ids_of_latest_cases = qs_df.drop_duplicates(
+        subset=["ir_family_id"], keep="last")["id"].tolist()
+    return list(GELInterpretationReport.objects.filter(
+        id__in=ids_of_latest_cases).values_list('id', flat=True))
+
+
+def is_latest_ids(sample_type):
+    return list(GELInterpretationReport.objects.latest_cases_by_sample_type(
+        sample_type).values_list('id', flat=True))
+
+
+def latest_reports_benchmark(rows=50000, repeat=5, **options):
+    """
+    Compares finding the latest report of each family, as the case lists,
+    audit page and exports do, by dropping older versions with pandas
+    against filtering on is_latest. rows reports are added, two versions
+    per family, in a transaction which is rolled back.
+
+    Returns:
+        list: (name, seconds per call, reports per second) for each approach.
+    """
+    results = []
+    try:
+        with transaction.atomic():
+            new_report_versions(rows)
+            reports = GELInterpretationReport.objects.filter(sample_type='raredisease').count()
+            if sorted(pandas_latest_ids('raredisease')) != sorted(is_latest_ids('raredisease')):
+                raise AssertionError('is_latest differs from the latest versions found with pandas')
+            for name, function in (
+                    ('pandas', pandas_latest_ids),
+                    ('is_latest', is_latest_ids)):
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    function('raredisease')
+                seconds = (time.perf_counter() - start) / repeat
+                results.append((name, seconds, reports / seconds))
+            raise Rollback
+    except Rollback:
+        pass
+    return results
+
+
+def case_with_transcripts(variants, transcripts_per_variant=20):
+    """
+    Makes a raredisease case with the given number of variants, each on
+    transcripts_per_variant of its transcripts, and the Variant, Transcript
+    and ProbandVariant entries CaseAttributeManager would have by the time
+    it joins them. Nothing is saved; the entries are given ids directly.
+    """
+    assembly = ToolOrAssemblyVersion(pk=1, tool_name='genome_build', version_number='GRCh38')
+    case_variants = [
+        CaseVariant(chromosome='1', position=i, case_id='1-1', variant_count=str(i),
+                    ref='A', alt='T', genome_build='GRCh38')
+        for i in range(variants)]
+    variant_entries = [
+        Variant(pk=i + 1, chromosome='1', position=i, reference='A', alternate='T',
+                genome_assembly=assembly)
+        for i in range(variants)]
+    transcript_entries = [
+        Transcript(pk=i + 1, name='ENST{}'.format(i), genome_assembly=assembly)
+        for i in range(variants + transcripts_per_variant)]
+    proband_variants = [
+        ProbandVariant(pk=i + 1, variant=variant_entries[i]) for i in range(variants)]
+    case_transcripts = [
+        CaseTranscript('1-1', str(i), None, None, None, 'ENST{}'.format(i + j), 'NO', '+',
+                       'missense_variant', '0', None, None, 'c.1A>T', 'p.Met1?', 'g.1A>T')
+        for i in range(variants) for j in range(transcripts_per_variant)]
+
+    def manager(entries):
+        return SimpleNamespace(case_model=SimpleNamespace(
+            case_models=[SimpleNamespace(entry=entry) for entry in entries]))
+
+    return SimpleNamespace(
+        json={'sample_type': 'raredisease'},
+        variants=case_variants,
+        transcripts=case_transcripts,
+        ig_objs=[],
+        clinical_report_objs=[],
+        attribute_managers={
+            ToolOrAssemblyVersion: manager([assembly]),
+            Variant: manager(variant_entries),
+            Transcript: manager(transcript_entries),
+            ProbandVariant: manager(proband_variants)})
+
+
+def case_joins_benchmark(rows=8000, **options):
+    """
+    Times CaseAttributeManager joining a case's CaseTranscripts to its
+    variants, Variant and Transcript entries and ProbandVariants, for cases
+    of rows / 8, rows / 4, rows / 2 and rows variants with 20 transcripts
+    each. A constant rate shows the joins scale linearly with the number of
+    variants. Nothing touches the database.
+
+    Returns:
+        list: (variant count, seconds, variants per second) for each size.
+    """
+    results = []
+    for variants in (rows // 8, rows // 4, rows // 2, rows):
+        case = case_with_transcripts(variants)
+        manager = CaseAttributeManager.__new__(CaseAttributeManager)
+        manager.case = case
+        manager.model_index = None
+        # time without the cyclic garbage collector, as timeit does, since
+        # its passes over the case's objects grow with the case
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.process_time()
+            manager.get_transcript_variants()
+            manager.get_proband_transcript_variants()
+            seconds = time.process_time() - start
+        finally:
+            gc.enable()
+        if any(transcript.proband_variant_entry is None for transcript in case.transcripts):
+            raise AssertionError('a transcript was not joined to its ProbandVariant')
+        results.append(('{} variants'.format(variants), seconds, variants / seconds))
+    return results
+
+
+# the CSQ fields VEP 91 writes with --everything --hgvsg --merged
+EVERYTHING_CSQ_FIELDS = (
+    'Allele', 'Consequence', 'IMPACT', 'SYMBOL', 'Gene', 'Feature_type', 'Feature', 'BIOTYPE', 'EXON',
+    'INTRON', 'HGVSc', 'HGVSp', 'cDNA_position', 'CDS_position', 'Protein_position', 'Amino_acids',
+    'Codons', 'Existing_variation', 'DISTANCE', 'STRAND', 'FLAGS', 'PICK', 'VARIANT_CLASS',
+    'SYMBOL_SOURCE', 'HGNC_ID', 'CANONICAL', 'TSL', 'APPRIS', 'CCDS', 'ENSP', 'SWISSPROT', 'TREMBL',
+    'UNIPARC', 'REFSEQ_MATCH', 'SOURCE', 'GENE_PHENO', 'SIFT', 'PolyPhen', 'DOMAINS', 'HGVS_OFFSET',
+    'HGVSg', 'AF', 'AFR_AF', 'AMR_AF', 'EAS_AF', 'EUR_AF', 'SAS_AF', 'AA_AF', 'EA_AF', 'gnomAD_AF',
+    'gnomAD_AFR_AF', 'gnomAD_AMR_AF', 'gnomAD_ASJ_AF', 'gnomAD_EAS_AF', 'gnomAD_FIN_AF', 'gnomAD_NFE_AF',
+    'gnomAD_OTH_AF', 'gnomAD_SAS_AF', 'MAX_AF', 'MAX_AF_POPS', 'CLIN_SIG', 'SOMATIC', 'PHENO', 'PUBMED',
+    'MOTIF_NAME', 'MOTIF_POS', 'HIGH_INF_POS', 'MOTIF_SCORE_CHANGE')
+
+
+def synthetic_vep_vcf(path, rows, transcripts_per_variant=3):
+    """
+    Writes a VEP annotated vcf of rows variants, each with
+    transcripts_per_variant transcripts in its CSQ, every one with all the
+    EVERYTHING_CSQ_FIELDS filled in.
+    """
+    with open(path, 'w') as vcf:
+        vcf.write('##fileformat=VCFv4.1\n')
+        vcf.write('##INFO=<ID=CSQ,Number=.,Type=String,Description="Consequence annotations from '
+                  'Ensembl VEP. Format: {}">\n'.format('|'.join(EVERYTHING_CSQ_FIELDS)))
+        vcf.write('##contig=<ID=1>\n')
+        vcf.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+        for i in range(rows):
+            transcripts = []
+            for j in range(transcripts_per_variant):
+                values = dict((field, field.lower()) for field in EVERYTHING_CSQ_FIELDS)
+                values.update({
+                    'Gene': 'ENSG{:011d}'.format(i), 'Feature': 'ENST{:011d}'.format(i * 10 + j),
+                    'HGNC_ID': 'HGNC:{}'.format(i), 'CANONICAL': 'YES' if j == 0 else '',
+                    'STRAND': '1', 'MAX_AF': '0.001', 'HGVSp': 'ENSP{:011d}:p.Leu{}%3D'.format(i, j)})
+                transcripts.append('|'.join(values[field] for field in EVERYTHING_CSQ_FIELDS))
+            vcf.write('1\t{pos}\t1234-1:{i}\tA\tG\t.\t.\tCSQ={csq}\n'.format(
+                pos=i + 1, i=i, csq=','.join(transcripts)))
+
+
+def vep_parse_benchmark(rows=500000, repeat=1, **options):
+    """
+    Compares reading the transcript records of a synthetic VEP vcf of rows
+    variants with ParseVep.read_file, which parses every record with Pysam
+    into a list of dicts of all INFO keys and CSQ fields, with the streaming
+    ParseVep.iter_records and read_columns, which only split out CSQ_FIELDS.
+    Each approach keeps what parse_vep_records' callers would keep: the
+    records, or for read_columns the column arrays. read_file peaks at about
+    18KB a variant under tracemalloc, so the default size needs around 10GB
+    of memory; use fewer rows on smaller hosts.
+
+    Returns:
+        list: (name, CPU seconds per vcf, peak bytes) for each approach.
+    """
+    parser = parse_vep.ParseVep()
+
+    def read_file(path):
+        return [
+            (variant['id'], transcript_records(
+                [tuple(transcript[field] for field in CSQ_FIELDS)
+                 for transcript in variant['transcript_data'].values()]))
+            for variant in parser.read_file(path)]
+
+    def iter_records(path):
+        return [
+            (variant_id, transcript_records(transcripts))
+            for variant_id, transcripts in parser.iter_records(path, CSQ_FIELDS)]
+
+    def read_columns(path):
+        return parser.read_columns(path, CSQ_FIELDS)
+
+    vcf = tempfile.NamedTemporaryFile(suffix='.vcf', delete=False)
+    vcf.close()
+    try:
+        # check the records match on a small vcf, as read_file needs
+        # several GB for the full one
+        synthetic_vep_vcf(vcf.name, min(rows, 1000))
+        if read_file(vcf.name) != iter_records(vcf.name):
+            raise AssertionError('iter_records differs from read_file')
+        synthetic_vep_vcf(vcf.name, rows)
+        return [
+            (name, ) + measure(lambda: function(vcf.name), repeat)
+            for name, function in (
+                ('read_file', read_file),
+                ('iter_records', iter_records),
+                ('read_columns', read_columns))]
+    finally:
+        os.remove(vcf.name)
+
+
+BENCHMARKS = {
+    'case_json': case_json_benchmark,
+    'ingest_write': ingest_write_benchmark,
+    'latest_reports': latest_reports_benchmark,
+    'case_joins': case_joins_benchmark,
+    'vep_parse': vep_parse_benchmark,
+}
+
+# benchmarks which return (name, seconds, rows per second)
+RATE_BENCHMARKS = ('ingest_write', 'latest_reports', 'case_joins')
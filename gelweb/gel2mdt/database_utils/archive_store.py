@@ -0,0 +1,247 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import contextlib
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import threading
+
+from ..config import load_config
+
+try:
+    import zstandard
+except ImportError:
+    # zstd is optional; without it the archive is gzipped
+    zstandard = None
+
+EXTENSIONS = {
+    'gzip': '.json.gz',
+    'zstd': '.json.zst',
+}
+
+
+class ArchiveStore(object):
+    """
+    Compressed, content-addressed store of case jsons from the CIP-API.
+
+    Each distinct json is written once, compressed, to
+    objects/<sha[:2]>/<sha[2:4]>/<sha>.json.<gz|zst> under directory, where
+    sha is the case's sha_hash. A case re-archived under a new version with
+    an identical payload therefore takes no more space. A SQLite index in
+    the same directory maps (ir_family_id, archived_version) to the object,
+    with the proband, so a json can be found without listing directories.
+
+    Jsons archived before the store existed are flat
+    <ir_family_id>-<archived_version>.json files in directory; they are
+    still read until moved into the store with
+    `python manage.py migrate_case_archive`.
+
+    Attributes:
+        directory (str): the cip_api_storage directory.
+        codec (str): 'zstd' or 'gzip', used for new objects. Objects already
+            stored keep the codec they were written with.
+    """
+    index_name = "archive_index.sqlite3"
+
+    def __init__(self, directory=None, codec=None):
+        if directory is None or codec is None:
+            config_dict = load_config.LoadConfig().load()
+            directory = directory or config_dict['cip_api_storage']
+            codec = codec or config_dict.get('archive_codec') or None
+        if codec is None:
+            codec = 'zstd' if zstandard is not None else 'gzip'
+        if codec not in EXTENSIONS:
+            raise ValueError('{codec} is not a valid archive codec; use "gzip" or "zstd".'.format(codec=codec))
+        if codec == 'zstd' and zstandard is None:
+            raise ValueError('The zstd archive codec needs the zstandard package.')
+        self.directory = directory
+        self.codec = codec
+        self.index_path = os.path.join(directory, self.index_name)
+        os.makedirs(directory, exist_ok=True)
+        with self.connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS archive (
+                    ir_family_id TEXT NOT NULL,
+                    archived_version INTEGER NOT NULL,
+                    proband TEXT,
+                    sha_hash TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    codec TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    PRIMARY KEY (ir_family_id, archived_version)
+                )""")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS archive_sha_hash ON archive (sha_hash)")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS archive_proband ON archive (proband)")
+
+    @contextlib.contextmanager
+    def connect(self):
+        """
+        Context manager giving a connection to the index, committed and closed
+        on exit. A connection per call keeps the store usable from several
+        threads and processes at once.
+        """
+        connection = sqlite3.connect(self.index_path, timeout=60)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def object_path(self, sha_hash, codec):
+        return os.path.join(
+            "objects", sha_hash[:2], sha_hash[2:4], sha_hash + EXTENSIONS[codec])
+
+    def flat_path(self, ir_family_id, archived_version):
+        return os.path.join(
+            self.directory, '{}-{}.json'.format(ir_family_id, archived_version))
+
+    def open_object(self, path, codec, mode='rb'):
+        """
+        Opens a stored object for reading or writing bytes, (de)compressing
+        on the fly.
+        """
+        if codec == 'zstd':
+            if zstandard is None:
+                raise ValueError('Reading {} needs the zstandard package.'.format(path))
+            if 'w' in mode:
+                return zstandard.ZstdCompressor().stream_writer(open(path, mode))
+            return zstandard.ZstdDecompressor().stream_reader(open(path, mode))
+        return gzip.open(path, mode)
+
+    def find_object(self, sha_hash):
+        """
+        Returns (path, codec, size) of the object stored for sha_hash, in
+        whichever codec it was written, or None.
+        """
+        for codec in EXTENSIONS:
+            path = self.object_path(sha_hash, codec)
+            full_path = os.path.join(self.directory, path)
+            if os.path.exists(full_path):
+                return path, codec, os.path.getsize(full_path)
+        return None
+
+    def write_object(self, sha_hash, source):
+        """
+        Compresses source into the object for sha_hash, unless it is already
+        stored.
+
+        Args:
+            sha_hash (str): the case's sha_hash.
+            source (str, bytes or dict): path of a json file, the json as
+                received, or the decoded json.
+
+        Returns:
+            (str, str, int, bool): path relative to directory, codec,
+                compressed size, and whether a new object was written.
+        """
+        found = self.find_object(sha_hash)
+        if found is not None:
+            return found + (False,)
+
+        path = self.object_path(sha_hash, self.codec)
+        full_path = os.path.join(self.directory, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        tmp_path = "{}.{}.{}.tmp".format(full_path, os.getpid(), threading.get_ident())
+        try:
+            with self.open_object(tmp_path, self.codec, 'wb') as out_file:
+                if isinstance(source, str):
+                    with open(source, 'rb') as json_file:
+                        shutil.copyfileobj(json_file, out_file, 1 << 20)
+                elif isinstance(source, bytes):
+                    out_file.write(source)
+                else:
+                    out_file.write(json.dumps(source).encode('utf-8'))
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        # another process may have stored the same json meanwhile; the
+        # contents are the same, so whichever rename lands last is fine
+        os.replace(tmp_path, full_path)
+        return path, self.codec, os.path.getsize(full_path), True
+
+    def put(self, ir_family_id, archived_version, proband, sha_hash, source):
+        """
+        Archives a case json and indexes it under its IR family and version,
+        replacing any earlier entry for them.
+
+        Returns:
+            bool: True if the json was new, False if an identical one was
+                already stored and has been reused.
+        """
+        path, codec, size, written = self.write_object(sha_hash, source)
+        with self.connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO archive VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (ir_family_id, int(archived_version), proband, sha_hash, path, codec, size))
+        return written
+
+    def lookup(self, ir_family_id, archived_version):
+        """
+        Returns the index entry for a case as a dict, or None.
+        """
+        with self.connect() as connection:
+            connection.row_factory = sqlite3.Row
+            row = connection.execute(
+                "SELECT * FROM archive WHERE ir_family_id = ? AND archived_version = ?",
+                (ir_family_id, int(archived_version))).fetchone()
+        return dict(row) if row is not None else None
+
+    def open(self, ir_family_id, archived_version):
+        """
+        Opens an archived json for reading as bytes, falling back to a flat
+        file from before the store existed. Returns None if there is neither.
+        """
+        entry = self.lookup(ir_family_id, archived_version)
+        if entry is not None:
+            return self.open_object(
+                os.path.join(self.directory, entry['path']), entry['codec'])
+        flat_path = self.flat_path(ir_family_id, archived_version)
+        if os.path.isfile(flat_path):
+            return open(flat_path, 'rb')
+        return None
+
+    def load(self, ir_family_id, archived_version):
+        """
+        Returns an archived json, decoded, or None if it isn't archived.
+        """
+        json_file = self.open(ir_family_id, archived_version)
+        if json_file is None:
+            return None
+        with json_file:
+            return json.loads(json_file.read().decode('utf-8'))
+
+    def stats(self):
+        """
+        Returns a dict of the number of cases indexed, distinct objects
+        stored and their total compressed size in bytes.
+        """
+        with self.connect() as connection:
+            cases, = connection.execute("SELECT COUNT(*) FROM archive").fetchone()
+            objects, size = connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM "
+                "(SELECT DISTINCT sha_hash, size FROM archive)").fetchone()
+        return {'cases': cases, 'objects': objects, 'size': size}
@@ -28,16 +28,25 @@ from django.utils.dateparse import parse_date
 import time
 from ..models import *
 from ..api_utils.poll_api import PollAPI
+from ..api_utils.json_stream import hash_canonical
+from .natural_keys import NaturalKeyIndex
 from ..vep_utils.run_vep_batch import CaseVariant, CaseCNV, CaseSTR
 from ..config import load_config
 import re
-import copy
 import pprint
 from tqdm import tqdm
 from protocols.reports_6_0_0 import InterpretedGenome, InterpretationRequestRD, CancerInterpretationRequest, ClinicalReport
 import csv
 
 
+def variant_key(variant):
+    """
+    The (chromosome, position, reference, alternate) a Variant entry is
+    matched on within a case, which has a single genome assembly.
+    """
+    return (variant.chromosome, variant.position, variant.reference, variant.alternate)
+
+
 class Case(object):
     """
     Entity object which represents a case and it's associated details.
@@ -48,11 +57,11 @@ class Case(object):
 
     Attributes:
         json (dict): upon initialisation of the Case, this is the full json
-            response from PollAPI. This is edited during the database update
-            process to keep relevant information together in the datastructure.
-        raw_json (dict): a deepcopy of the json, which remains unmodified, for
-            the purpose of saving the json to disk once a Case has been added
-            or updated in the database.
+            response from PollAPI. It is shared with the caller and must be
+            treated as read-only.
+        raw_json (bytes): the json as it was received, for the purpose of
+            archiving it once a Case has been added or updated in the
+            database.
         json_case_data (dict): a sub-dict within the json which refers to the
             interpretation_request_data.
         json_request_data (dict): a sub-dict of json_case_data which holds the
@@ -60,8 +69,10 @@ class Case(object):
             attributes during init mostly to avoid long dict accessors in the
             code itself.
         request_id (str): the XXXX-X CIP-ID of the Interpretation Request.
-        json_hash (str): the MD5 hash of the json file, which has been sorted
-            to maintain consistency of values (which would change the hash).
+        json_hash (str): the SHA512 hash of the json. With hash_mode
+            'canonical' the json is serialised with sorted keys first, so
+            the hash doesn't depend on the order of keys in the response;
+            with 'raw' it is the hash of raw_json as received.
         proband (dict): sub-dict of json which holds the information about the
             proband only.
         proband_sample (str): the sample ID used for sequencing of the proband,
@@ -108,21 +119,31 @@ class Case(object):
             updated in the database, then the MCA will create (in the correct
             order) CaseAttributeManagers for each model type for each case.
     """
-    def __init__(self, case_json, panel_manager, variant_manager, gene_manager, skip_demographics=False, pullt3=True):
+    hash_modes = ('canonical', 'raw')
+
+    def __init__(self, case_json, panel_manager, variant_manager, gene_manager, skip_demographics=False, pullt3=True,
+                 raw_json=None, hash_mode='canonical'):
         """
         Initialise a Case with the json, then pull out relevant sections.
 
-        The JSON is deepcopied for raw_json, then the relevant sections are
-        extracted by dictionary accessors or standalone functions (in the case
-        of proband, family_members, tools_and_versions). A SHA512 hash is also
-        calculated for the JSON, to later check if the JSON used for a case
-        has changed in the CIP API.
+        The relevant sections are extracted by dictionary accessors or
+        standalone functions (in the case of proband, family_members,
+        tools_and_versions). A SHA512 hash is also calculated for the JSON,
+        to later check if the JSON used for a case has changed in the CIP API.
+
+        raw_json should be the response body case_json was decoded from; it
+        is archived and (in 'raw' hash_mode) hashed as it is. Without it the
+        json is serialised once to make it.
         """
+        if hash_mode not in self.hash_modes:
+            raise ValueError('{hash_mode} is not a valid hash mode; please enter either "canonical" or "raw".'.format(hash_mode=hash_mode))
 
         self.json = case_json
-        # raw json created to dump at the end; json attr is modified
         self.pullt3 = pullt3
-        self.raw_json = copy.deepcopy(case_json)
+        self.hash_mode = hash_mode
+        if raw_json is None:
+            raw_json = json.dumps(case_json).encode('utf-8')
+        self.raw_json = raw_json
         self.json_case_data = self.json["interpretation_request_data"]
         self.json_request_data = self.json_case_data["json_request"]
         self.request_id = str(
@@ -168,14 +189,15 @@ class Case(object):
 
     def hash_json(self):
         """
-        Hash the given json for this Case, sorting the keys to ensure
+        Hash the given json for this Case. In 'raw' hash_mode this is the
+        hash of the response body. Otherwise the keys are sorted to ensure
         that order is preserved, or else different order -> different
-        hash.
+        hash; the sorted json is hashed as it is serialised, a piece at a
+        time, rather than built as one string.
         """
-        hash_buffer = json.dumps(self.json, sort_keys=True).encode('utf-8')
-        hash_hex = hashlib.sha512(hash_buffer)
-        hash_digest = hash_hex.hexdigest()
-        return hash_digest
+        if self.hash_mode == 'raw':
+            return hashlib.sha512(self.raw_json).hexdigest()
+        return hash_canonical(self.json)
 
     def get_proband_json(self):
         """
@@ -447,13 +469,15 @@ class CaseAttributeManager(object):
     Holds get/refresh functions to be called by MCA, as well as pointing to
     CaseModels and ManyCaseModels for access by MCA.bulk_create_new().
     """
-    def __init__(self, case, model_type, model_objects, many=False):
+    def __init__(self, case, model_type, model_index, many=False):
         """
         Initialise with CaseModel or ManyCaseModel, dependent on many param.
+        model_index is the NaturalKeyIndex for model_type, shared by every
+        case in the bin.
         """
         self.case = case  # for accessing related table entries
         self.model_type = model_type
-        self.model_objects = model_objects
+        self.model_index = model_index
         self.many = many
         self.case_model = self.get_case_model()
 
@@ -557,7 +581,7 @@ class CaseAttributeManager(object):
             "email": "unknown",  # clinician email not on labkey
             "hospital": clinician_details['hospital'],
             "added_by_user": False
-        }, self.model_objects)
+        }, self.model_index)
         return clinician
 
     def get_paricipant_demographics(self, participant_id):
@@ -638,7 +662,7 @@ class CaseAttributeManager(object):
             'disease_group': disease_group,
             'disease_subtype': disease_subtype,
             "gmc": clinician.entry.hospital
-        }, self.model_objects)
+        }, self.model_index)
         return proband
 
     def get_relatives(self):
@@ -675,7 +699,7 @@ class CaseAttributeManager(object):
             "surname": relative["surname"],
             "date_of_birth": datetime.strptime(relative["date_of_birth"], "%Y/%m/%d").date(),
             "sex": relative["sex"],
-        } for relative in relative_list], self.model_objects)
+        } for relative in relative_list], self.model_index)
 
         return relatives
 
@@ -750,7 +774,7 @@ class CaseAttributeManager(object):
             "gel_family_id": family_id,
             "trio_sequenced": self.case.trio_sequenced,
             "has_de_novo": self.case.has_de_novo
-        }, self.model_objects)
+        }, self.model_index)
         return family
 
     def get_phenotypes(self):
@@ -763,9 +787,9 @@ class CaseAttributeManager(object):
                  "description": "unknown"}
                 for phenotype in self.case.proband.hpoTermList
                 if phenotype.termPresence == 'yes'
-            ], self.model_objects)
+            ], self.model_index)
         else:
-            phenotypes = ManyCaseModel(Phenotype, [], self.model_objects)
+            phenotypes = ManyCaseModel(Phenotype, [], self.model_index)
         return phenotypes
 
     def get_family_phenotyes(self):
@@ -773,7 +797,7 @@ class CaseAttributeManager(object):
         family_phenotypes = ManyCaseModel(FamilyPhenotype, [
             {"family": None,
              "phenotype": None}
-        ], self.model_objects)
+        ], self.model_index)
 
         return family_phenotypes
 
@@ -830,9 +854,9 @@ class CaseAttributeManager(object):
                 "panel_name": panel.panel_name_results["SpecificDiseaseName"],
                 "disease_group": panel.panel_name_results["DiseaseGroup"],
                 "disease_subgroup": panel.panel_name_results["DiseaseSubGroup"]
-            } for panel in self.case.panels], self.model_objects)
+            } for panel in self.case.panels], self.model_index)
         else:
-            panels = ManyCaseModel(Panel, [], self.model_objects)
+            panels = ManyCaseModel(Panel, [], self.model_index)
 
         return panels
 
@@ -857,9 +881,9 @@ class CaseAttributeManager(object):
                 # create the MCM
                 "version_number": panel.panelapp_results["version"],
                 "panel": panel.model
-            } for panel in self.case.panels], self.model_objects)
+            } for panel in self.case.panels], self.model_index)
         else:
-            panel_versions = ManyCaseModel(PanelVersion, [], self.model_objects)
+            panel_versions = ManyCaseModel(PanelVersion, [], self.model_index)
         return panel_versions
 
     def get_genes(self):
@@ -948,7 +972,7 @@ class CaseAttributeManager(object):
             "ensembl_id": gene["EnsembleGeneIds"],  # TODO: which ID to use?
             "hgnc_name": gene["GeneSymbol"],
             "hgnc_id": gene['HGNC_ID']
-        } for gene in cleaned_gene_list if gene["HGNC_ID"]], self.model_objects)
+        } for gene in cleaned_gene_list if gene["HGNC_ID"]], self.model_index)
         return genes
 
     def get_panel_version_genes(self):
@@ -956,7 +980,7 @@ class CaseAttributeManager(object):
         panel_version_genes = ManyCaseModel(PanelVersionGenes, [{
             "panel_version": None,
             "gene": None
-        }], self.model_objects)
+        }], self.model_index)
 
         return panel_version_genes
 
@@ -975,8 +999,23 @@ class CaseAttributeManager(object):
             if tool.tool_name == 'genome_build':
                 genome_assembly = tool
 
-        genes = self.case.attribute_managers[Gene].case_model.case_models
+        # index the case's genes by HGNC ID
+        genes = {}
+        for gene in self.case.attribute_managers[Gene].case_model.case_models:
+            genes.setdefault(gene.entry.hgnc_id, []).append(gene.entry)
         case_transcripts = self.case.transcripts
+        # fetch the preferred transcripts of all the genes at once
+        preferred_transcripts = {}
+        if self.case.json['sample_type'] == 'raredisease':
+            matched_genes = set(
+                gene for transcript in case_transcripts if transcript.gene_hgnc_id
+                for gene in genes.get(transcript.gene_hgnc_id, []))
+            if matched_genes:
+                preferred_transcripts = dict(
+                    (preferred_transcript.gene_id, preferred_transcript)
+                    for preferred_transcript in PreferredTranscript.objects.filter(
+                        gene__in=matched_genes, genome_assembly=genome_assembly
+                    ).select_related('transcript'))
         # for each transcript, add an FK to the gene with matching ensg ID
         for transcript in case_transcripts:
             # convert canonical to bools:
@@ -987,18 +1026,15 @@ class CaseAttributeManager(object):
                 # if the transcript has no recognised gene associated
                 continue  # don't bother checking genes
             transcript.gene_model = None
-            for gene in genes:
-                if gene.entry.hgnc_id == transcript.gene_hgnc_id:
-                    transcript.gene_model = gene.entry
-                    if self.case.json['sample_type'] == 'raredisease':
-                        preferred_transcript = PreferredTranscript.objects.filter(gene=gene.entry,
-                                                                                  genome_assembly=genome_assembly)
-                        if preferred_transcript:
-                            preferred_transcript = preferred_transcript.first()
-                            if preferred_transcript.transcript.name == transcript.transcript_name:
-                                transcript.selected = True
-                        else:
-                            transcript.selected = transcript.transcript_canonical == "YES"
+            for gene in genes.get(transcript.gene_hgnc_id, []):
+                transcript.gene_model = gene
+                if self.case.json['sample_type'] == 'raredisease':
+                    preferred_transcript = preferred_transcripts.get(gene.pk)
+                    if preferred_transcript:
+                        if preferred_transcript.transcript.name == transcript.transcript_name:
+                            transcript.selected = True
+                    else:
+                        transcript.selected = transcript.transcript_canonical == "YES"
 
         transcripts = ManyCaseModel(Transcript, [{
             "gene": transcript.gene_model,
@@ -1007,7 +1043,7 @@ class CaseAttributeManager(object):
             "strand": transcript.transcript_strand,
             'genome_assembly': genome_assembly
             # add all transcripts except those without associated genes
-        } for transcript in case_transcripts if transcript.gene_model], self.model_objects)
+        } for transcript in case_transcripts if transcript.gene_model], self.model_index)
 
         return transcripts
 
@@ -1022,7 +1058,7 @@ class CaseAttributeManager(object):
             "cip": self.case.json["cip"],
             "ir_family_id": self.case.request_id,
             "priority": self.case.json["case_priority"]
-        }, self.model_objects)
+        }, self.model_index)
         return ir_family
 
     def get_ir_family_panel(self):
@@ -1062,9 +1098,9 @@ class CaseAttributeManager(object):
             } for panel in self.case.attribute_managers[PanelVersion].case_model.case_models if "entry" in vars(panel) and
                 panel.entry.panel.panelapp_id in self.case.ir_obj.genePanelsCoverage and
                 'SUMMARY' in self.case.ir_obj.genePanelsCoverage[panel.entry.panel.panelapp_id]],
-                self.model_objects)
+                self.model_index)
         else:
-            ir_family_panels = ManyCaseModel(InterpretationReportFamilyPanel, [], self.model_objects)
+            ir_family_panels = ManyCaseModel(InterpretationReportFamilyPanel, [], self.model_index)
 
         return ir_family_panels
 
@@ -1123,7 +1159,7 @@ class CaseAttributeManager(object):
             'tumour_content': tumour_content,
             "has_germline_variant": has_germline_variant,
             "case_status": 'N',  # initialised to not started? (N)
-        }, self.model_objects)
+        }, self.model_index)
         return ir
 
     def get_variants(self):
@@ -1193,7 +1229,7 @@ class CaseAttributeManager(object):
             "db_snp_id": variant["db_snp_id"],
             "reference": variant["reference"],
             "position": variant["position"],
-        } for variant in cleaned_variant_list], self.model_objects)
+        } for variant in cleaned_variant_list], self.model_index)
 
         return variants
 
@@ -1216,50 +1252,38 @@ class CaseAttributeManager(object):
 
         case_attribute_managers = self.case.attribute_managers
         transcript_manager = case_attribute_managers[Transcript].case_model
-        transcript_entries = [transcript.entry
-                              for transcript in transcript_manager.case_models]
         variant_manager = case_attribute_managers[Variant].case_model
-        variant_entries = [variant.entry
-                           for variant in variant_manager.case_models]
+
+        # index the case's variants by (case_id, variant_count), and the
+        # Variant and Transcript entries by their natural keys
+        case_variants = {}
+        for variant in self.case.variants:
+            case_variants.setdefault((variant.case_id, variant.variant_count), variant)
+        variant_entries = dict(
+            (variant_key(variant.entry), variant.entry)
+            for variant in variant_manager.case_models)
+        transcript_entries = {}
+        for transcript in transcript_manager.case_models:
+            transcript_entries.setdefault(
+                (transcript.entry.name, transcript.entry.genome_assembly_id), transcript.entry)
+        genome_assembly_id = genome_assembly.pk if genome_assembly else None
 
         # for each CaseTranscript (which contains necessary info):
         for case_transcript in self.case.transcripts:
             # get information to hook up transcripts with variants
-            case_id = case_transcript.case_id
-            variant_id = case_transcript.variant_count
-            for variant in self.case.variants:
-                if (
-                    case_id == variant.case_id and
-                    variant_id == variant.variant_count
-                ):
-                    case_variant = variant
-                    break
-
-            # name to hook up CaseTranscript with Transcript
-            transcript_name = case_transcript.transcript_name
+            case_variant = case_variants[(case_transcript.case_id, case_transcript.variant_count)]
 
             # add the corresponding Variant entry
-            for variant_entry in variant_entries:
-                # find the matching variant entry
-                if (
-                    variant_entry.chromosome == case_variant.chromosome and
-                    variant_entry.position == case_variant.position and
-                    variant_entry.reference == case_variant.ref and
-                    variant_entry.alternate == case_variant.alt
-                ):
-                    # add match to the case_transcript
-                    case_transcript.variant_entry = variant_entry
-
-            # add the corresponding Transcript entry
-            for transcript_entry in transcript_entries:
-                found = False
-                if transcript_entry.name == transcript_name and transcript_entry.genome_assembly == genome_assembly:
-                    case_transcript.transcript_entry = transcript_entry
-                    found = True
-                    break
-                if not found:
-                    # we don't make entries for tx with no Gene
-                    case_transcript.transcript_entry = None
+            variant_entry = variant_entries.get((
+                case_variant.chromosome, case_variant.position,
+                case_variant.ref, case_variant.alt))
+            if variant_entry is not None:
+                case_transcript.variant_entry = variant_entry
+
+            # add the corresponding Transcript entry; we don't make entries
+            # for tx with no Gene
+            case_transcript.transcript_entry = transcript_entries.get(
+                (case_transcript.transcript_name, genome_assembly_id))
 
         # use the updated CaseTranscript instances to create an MCM
         transcript_variants = ManyCaseModel(TranscriptVariant, [{
@@ -1272,7 +1296,7 @@ class CaseAttributeManager(object):
             "sift": transcript.variant_sift,
             "polyphen": transcript.variant_polyphen,
         } for transcript in self.case.transcripts
-            if transcript.transcript_entry], self.model_objects)
+            if transcript.transcript_entry], self.model_index)
 
         return transcript_variants
 
@@ -1283,11 +1307,11 @@ class CaseAttributeManager(object):
         """
         proband_manager = self.case.attribute_managers[Proband]
 
-        variant_entries = [
-            variant.entry
+        variant_entries = dict(
+            (variant_key(variant.entry), variant.entry)
             for variant
             in self.case.attribute_managers[Variant].case_model.case_models
-        ]
+        )
         raw_proband_variants = []
         processed_proband_variants = []
         for ig_obj in self.case.ig_objs:
@@ -1304,35 +1328,31 @@ class CaseAttributeManager(object):
             # some json_variants won't have an entry (T3), so:
             ig_variant.somatic = False
             ig_variant.variant_entry = None
-            # for those that do, fetch from list of entries:
+            # for those that do, fetch from the entries:
             # variant in json matches variant entry
-            for variant in variant_entries:
-                if (
-                        ig_variant.variantCoordinates.chromosome == variant.chromosome and
-                        ig_variant.variantCoordinates.position == variant.position and
-                        ig_variant.variantCoordinates.reference == variant.reference and
-                        ig_variant.variantCoordinates.alternate == variant.alternate
-                ):
-                    # variant in json matches variant entry
-                    ig_variant.variant_entry = variant
-                ig_variant.zygosity = 'unknown'
-                ig_variant.maternal_zygosity = 'unknown'
-                ig_variant.paternal_zygosity = 'unknown'
-
-                for call in ig_variant.variantCalls:
-                    if call.participantId == proband_manager.case_model.entry.gel_id:
-                        if call.zygosity != 'na':
-                            ig_variant.zygosity = call.zygosity
-                    elif call.participantId == self.case.mother.get("gel_id", None):
-                        if call.zygosity != 'na':
-                            ig_variant.maternal_zygosity = call.zygosity
-                    elif call.participantId == self.case.father.get("gel_id", None):
-                        if call.zygosity != 'na':
-                            ig_variant.paternal_zygosity = call.zygosity
-
-                    if call:
-                        if ig_variant.variantAttributes.alleleOrigins[0] == 'somatic_variant':
-                            ig_variant.somatic = True
+            ig_variant.variant_entry = variant_entries.get((
+                ig_variant.variantCoordinates.chromosome,
+                ig_variant.variantCoordinates.position,
+                ig_variant.variantCoordinates.reference,
+                ig_variant.variantCoordinates.alternate))
+            ig_variant.zygosity = 'unknown'
+            ig_variant.maternal_zygosity = 'unknown'
+            ig_variant.paternal_zygosity = 'unknown'
+
+            for call in ig_variant.variantCalls:
+                if call.participantId == proband_manager.case_model.entry.gel_id:
+                    if call.zygosity != 'na':
+                        ig_variant.zygosity = call.zygosity
+                elif call.participantId == self.case.mother.get("gel_id", None):
+                    if call.zygosity != 'na':
+                        ig_variant.maternal_zygosity = call.zygosity
+                elif call.participantId == self.case.father.get("gel_id", None):
+                    if call.zygosity != 'na':
+                        ig_variant.paternal_zygosity = call.zygosity
+
+                if call:
+                    if ig_variant.variantAttributes.alleleOrigins[0] == 'somatic_variant':
+                        ig_variant.somatic = True
 
         for ig_variant in raw_proband_variants:
             proband_variant = {
@@ -1348,12 +1368,12 @@ class CaseAttributeManager(object):
 
         # remove duplicate variants
         uniq_proband_variants = []
-        seen_variants = []
+        seen_variants = set()
 
         for variant in processed_proband_variants:
             if variant['variant'] not in seen_variants:
                 uniq_proband_variants.append(variant)
-                seen_variants.append(variant['variant'])
+                seen_variants.add(variant['variant'])
 
         return uniq_proband_variants
 
@@ -1375,7 +1395,7 @@ class CaseAttributeManager(object):
             "paternal_zygosity": variant['paternal_zygosity'],
             "inheritance": self.determine_variant_inheritance(variant['variant_obj']),
             "somatic": variant["somatic"]
-        } for variant in tiered_and_cip_proband_variants], self.model_objects)
+        } for variant in tiered_and_cip_proband_variants], self.model_index)
 
         return proband_variants
 
@@ -1405,34 +1425,35 @@ class CaseAttributeManager(object):
         return inheritance
 
     def get_pv_flags(self):
-        proband_variants = [proband_variant.entry for proband_variant
-                            in self.case.attribute_managers[ProbandVariant].case_model.case_models]
+        # the first ProbandVariant of each Variant
+        proband_variants = {}
+        for proband_variant in self.case.attribute_managers[ProbandVariant].case_model.case_models:
+            proband_variants.setdefault(proband_variant.entry.variant_id, proband_variant.entry)
         pv_flags = []
         for interpreted_genome in self.case.ig_objs:
             if interpreted_genome.variants:
                 for variant in interpreted_genome.variants:
-                    if variant.case_variant:
-                        for proband_variant in proband_variants:
-                            if proband_variant.variant == variant.variant_entry:
-                                variant.proband_variant = proband_variant
-                                variant.company = interpreted_genome.interpretationService
-                                pv_flags.append(variant)
-                                break
+                    if variant.case_variant and variant.variant_entry:
+                        proband_variant = proband_variants.get(variant.variant_entry.pk)
+                        if proband_variant:
+                            variant.proband_variant = proband_variant
+                            variant.company = interpreted_genome.interpretationService
+                            pv_flags.append(variant)
 
         for clinical_report in self.case.clinical_report_objs:
             if clinical_report.variants:
                 for variant in clinical_report.variants:
-                    for proband_variant in proband_variants:
-                        if proband_variant.variant == variant.variant_entry:
+                    if variant.variant_entry:
+                        proband_variant = proband_variants.get(variant.variant_entry.pk)
+                        if proband_variant:
                             variant.proband_variant = proband_variant
                             variant.company = 'Clinical Report'
                             pv_flags.append(variant)
-                            break
 
         pv_flags = ManyCaseModel(PVFlag, [{
             "proband_variant": variant.proband_variant,
             'flag_name': variant.company
-        } for variant in pv_flags], self.model_objects)
+        } for variant in pv_flags], self.model_index)
 
         return pv_flags
 
@@ -1441,29 +1462,36 @@ class CaseAttributeManager(object):
         Get the ProbandTranscriptVariants associated with this case and return
         a MCM containing them.
         """
-        # associat a proband_variant with a transcript
-        proband_variants = [proband_variant.entry for proband_variant
-                            in self.case.attribute_managers[ProbandVariant].case_model.case_models]
+        # associat a proband_variant with a transcript, taking the last
+        # ProbandVariant of each Variant
+        proband_variants = dict(
+            (proband_variant.entry.variant_id, proband_variant.entry)
+            for proband_variant
+            in self.case.attribute_managers[ProbandVariant].case_model.case_models)
 
         for transcript in self.case.transcripts:
-            for proband_variant in proband_variants:
-                if proband_variant.variant == transcript.variant_entry:
+            if transcript.variant_entry:
+                proband_variant = proband_variants.get(transcript.variant_entry.pk)
+                if proband_variant:
                     transcript.proband_variant_entry = proband_variant
 
         if self.case.json['sample_type'] == 'cancer':
+            # the interpreted genome variants of each Variant
+            ig_variants = {}
+            for ig_obj in self.case.ig_objs:
+                if ig_obj.variants:
+                    for variant in ig_obj.variants:
+                        if variant.case_variant:
+                            ig_variants.setdefault(variant.variant_entry, []).append(variant)
             for transcript in self.case.transcripts:
                 if transcript.transcript_entry:
-                    for ig_obj in self.case.ig_objs:
-                        if ig_obj.variants:
-                            for variant in ig_obj.variants:
-                                if variant.case_variant:
-                                    if variant.variant_entry == transcript.variant_entry:
-                                        for reportevent in variant.reportEvents:
-                                            for en in reportevent.genomicEntities:
-                                                if transcript.transcript_name == en.ensemblId:
-                                                    transcript.selected = True
-                                                else:
-                                                    transcript.selected = False
+                    for variant in ig_variants.get(transcript.variant_entry, []):
+                        for reportevent in variant.reportEvents:
+                            for en in reportevent.genomicEntities:
+                                if transcript.transcript_name == en.ensemblId:
+                                    transcript.selected = True
+                                else:
+                                    transcript.selected = False
 
         proband_transcript_variants = ManyCaseModel(ProbandTranscriptVariant, [{
             "transcript": transcript.transcript_entry,
@@ -1474,7 +1502,7 @@ class CaseAttributeManager(object):
         } for transcript
             in self.case.transcripts
             if transcript.transcript_entry
-            and transcript.proband_variant_entry], self.model_objects)
+            and transcript.proband_variant_entry], self.model_index)
 
         return proband_transcript_variants
 
@@ -1485,7 +1513,7 @@ class CaseAttributeManager(object):
         tools_and_assemblies = ManyCaseModel(ToolOrAssemblyVersion, [{
             "tool_name": tool,
             "version_number": version
-        }for tool, version in self.case.tools_and_versions.items()], self.model_objects)
+        }for tool, version in self.case.tools_and_versions.items()], self.model_index)
 
         return tools_and_assemblies
 
@@ -1515,7 +1543,7 @@ class CaseAttributeManager(object):
                         }
                         sv_region_list.append(tiered_variant)
 
-        sv_regions = ManyCaseModel(SVRegion, sv_region_list, self.model_objects)
+        sv_regions = ManyCaseModel(SVRegion, sv_region_list, self.model_index)
         return sv_regions
 
     def get_svs(self):
@@ -1550,7 +1578,7 @@ class CaseAttributeManager(object):
                                 'sv_region2': variant.sv_region2_entry,
                                 'variant_type': variant.variantType
                             })
-        svs = ManyCaseModel(SV, sv_list, self.model_objects)
+        svs = ManyCaseModel(SV, sv_list, self.model_index)
         return svs
 
     def get_proband_svs(self):
@@ -1595,7 +1623,7 @@ class CaseAttributeManager(object):
                                 'cnv_af': variant.cnv_af,
                                 'cnv_auc': variant.cnv_auc
                             })
-        sample_svs = ManyCaseModel(ProbandSV, proband_sv_list, self.model_objects)
+        sample_svs = ManyCaseModel(ProbandSV, proband_sv_list, self.model_index)
         return sample_svs
 
     def get_proband_sv_genes(self):
@@ -1646,7 +1674,7 @@ class CaseAttributeManager(object):
                                 'proband_sv': variant.proband_sv_entry,
                                 'selected': variant.genes[gene_key]
                             })
-        proband_sv_genes = ManyCaseModel(ProbandSVGene, proband_sv_gene_list, self.model_objects)
+        proband_sv_genes = ManyCaseModel(ProbandSVGene, proband_sv_gene_list, self.model_index)
         return proband_sv_genes
 
     def get_str_variants(self):
@@ -1677,7 +1705,7 @@ class CaseAttributeManager(object):
                         }
                         str_variant_list.append(tiered_variant)
 
-        str_variants = ManyCaseModel(STRVariant, str_variant_list, self.model_objects)
+        str_variants = ManyCaseModel(STRVariant, str_variant_list, self.model_index)
         return str_variants
 
     def get_proband_strs(self):
@@ -1723,7 +1751,7 @@ class CaseAttributeManager(object):
                                 'mode_of_inheritance': variant.mode_of_inheritance,
                                 'segregation_pattern': variant.segregation_pattern
                             })
-        proband_strs = ManyCaseModel(ProbandSTR, proband_str_list, self.model_objects)
+        proband_strs = ManyCaseModel(ProbandSTR, proband_str_list, self.model_index)
         return proband_strs
 
     def get_proband_str_genes(self):
@@ -1768,7 +1796,7 @@ class CaseAttributeManager(object):
                                 'proband_str': variant.proband_str_entry,
                                 'selected': variant.genes[gene_key]
                             })
-        proband_str_genes = ManyCaseModel(ProbandSTRGene, proband_str_gene_list, self.model_objects)
+        proband_str_genes = ManyCaseModel(ProbandSTRGene, proband_str_gene_list, self.model_index)
         return proband_str_genes
 
 class CaseModel(object):
@@ -1776,364 +1804,29 @@ class CaseModel(object):
     A handler for an instance of a model that belongs to a case. Holds an
     instance of a model (pre-creation or post-creation) and whether it
     requires creation in the database.
+
+    entry is None until the CaseModel has been looked up, then either the
+    matching database entry or False if there isn't one. MCA looks up every
+    CaseModel of a type in a bin together in their NaturalKeyIndex.
     """
-    def __init__(self, model_type, model_attributes, model_objects):
+    def __init__(self, model_type, model_attributes, model_index):
         self.model_type = model_type
 
         self.model_attributes = model_attributes.copy()
-        self.escaped_model_attributes = model_attributes.copy()
-        self.string_escape_model_attributes()  # prevent sql injection
-
-        self.model_objects = model_objects
-        self.entry = self.check_found_in_db(self.model_objects)
-
-    def string_escape_model_attributes(self):
-        # string escape ' characters in model attributes for use with raw sql
-        for k, v in self.escaped_model_attributes.items():
-            if isinstance(self.escaped_model_attributes[k], str):
-                self.escaped_model_attributes[k] = self.escaped_model_attributes[k].replace(
-                    "'", "''"  # psql takes '' when ' is used in string to avoid term
-                )
 
-    def set_sql_cmd(self):
-        # set raw sql to run against database to fetch matching record
-        if self.model_type == Clinician:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM Clinician'
-                cmd = ''.join([
-                    " WHERE BINARY name = '{name}'",
-                    " AND BINARY hospital = '{hospital}'",
-                    " AND BINARY email = '{email}'"
-                ]).format(
-                    name=self.escaped_model_attributes["name"],
-                    hospital=self.escaped_model_attributes["hospital"],
-                    email=self.escaped_model_attributes["email"]
-                )
-            else:
-                table = 'SELECT * FROM "Clinician"'
-                cmd = ''.join([
-                    " WHERE name = '{name}'",
-                    " AND hospital = '{hospital}'",
-                    " AND email = '{email}'"
-                ]).format(
-                    name=self.escaped_model_attributes["name"],
-                    hospital=self.escaped_model_attributes["hospital"],
-                    email=self.escaped_model_attributes["email"]
-                )
-        elif self.model_type == Proband:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM Proband'
-            else:
-                table = 'SELECT * FROM "Proband"'
-            cmd = ''.join([
-                " WHERE gel_id = '{gel_id}'"
-            ]).format(
-                gel_id=self.escaped_model_attributes["gel_id"]
-            )
-        elif self.model_type == Family:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM Family'
-            else:
-                table = 'SELECT * FROM "Family"'
-            cmd = ''.join([
-                " WHERE gel_family_id = '{gel_family_id}'"
-            ]).format(
-                gel_family_id=self.escaped_model_attributes["gel_family_id"]
-            )
-        elif self.model_type == Relative:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM Relative'
-            else:
-                table = 'SELECT * FROM "Relative"'
-            cmd = ''.join([
-                " WHERE gel_id = '{gel_id}'",
-                " AND proband_id = {proband_id}"
-            ]).format(
-                gel_id=self.escaped_model_attributes["gel_id"],
-                proband_id=self.escaped_model_attributes["proband"].id
-            )
-        elif self.model_type == Phenotype:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM Phenotype'
-            else:
-                table = 'SELECT * FROM "Phenotype"'
-            cmd = ''.join([
-                " WHERE hpo_terms = '{hpo_terms}'"
-            ]).format(
-                hpo_terms=self.escaped_model_attributes["hpo_terms"]
-            )
-        elif self.model_type == InterpretationReportFamily:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM InterpretationReportFamily'
-            else:
-                table = 'SELECT * FROM "InterpretationReportFamily"'
-            cmd = ''.join([
-                " WHERE ir_family_id = '{ir_family_id}'",
-            ]).format(
-                ir_family_id=self.escaped_model_attributes["ir_family_id"]
-            )
-        elif self.model_type == Panel:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM Panel'
-            else:
-                table = 'SELECT * FROM "Panel"'
-            cmd = ''.join([
-                " WHERE panelapp_id = '{panelapp_id}'",
-            ]).format(
-                panelapp_id=self.escaped_model_attributes["panelapp_id"]
-            )
-        elif self.model_type == PanelVersion:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM PanelVersion'
-            else:
-                table = 'SELECT * FROM "PanelVersion"'
-            cmd = ''.join([
-                " WHERE panel_id = '{panel_id}'",
-                " AND version_number = '{version_number}'"
-            ]).format(
-                panel_id=self.escaped_model_attributes["panel"].id,
-                version_number=self.escaped_model_attributes["version_number"]
-            )
-        elif self.model_type == InterpretationReportFamilyPanel:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM gel2mdt_interpretationreportfamilypanel'
-            else:
-                table = 'SELECT * FROM "gel2mdt_interpretationreportfamilypanel"'
-            cmd = ''.join([
-                " WHERE ir_family_id = {ir_family_id}",  # no ' because FKID
-                " AND panel_id = {panel_id}"
-            ]).format(
-                ir_family_id=self.escaped_model_attributes["ir_family"].id,
-                panel_id=self.escaped_model_attributes["panel"].id
-            )
-        elif self.model_type == Gene:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM Gene'
-            else:
-                table = 'SELECT * FROM "Gene"'
-            cmd = ''.join([
-                " WHERE hgnc_id = '{hgnc_id}'",
-            ]).format(
-                hgnc_id=self.escaped_model_attributes["hgnc_id"]
-            )
-        elif self.model_type == Transcript:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM Transcript'
-            else:
-                table = 'SELECT * FROM "Transcript"'
-            cmd = ''.join([
-                " WHERE name = '{name}'",
-                " AND genome_assembly_id = {genome_assembly_id}"
-            ]).format(
-                name=self.escaped_model_attributes["name"],
-                genome_assembly_id=self.escaped_model_attributes["genome_assembly"].id
-            )
-        elif self.model_type == GELInterpretationReport:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM GELInterpretationReport'
-            else:
-                table = 'SELECT * FROM "GELInterpretationReport"'
-            cmd = ''.join([
-                " WHERE sha_hash = '{sha_hash}'",
-            ]).format(
-                sha_hash=self.escaped_model_attributes["sha_hash"]
-            )
-        elif self.model_type == Variant:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM Variant'
-            else:
-                table = 'SELECT * FROM "Variant"'
-            cmd = ''.join([
-                " WHERE chromosome = '{chromosome}'",
-                " AND position = {position}"
-                " AND reference = '{reference}'"
-                " AND alternate = '{alternate}'"
-                " AND genome_assembly_id = {genome_assembly_id}"
-            ]).format(
-                chromosome=self.escaped_model_attributes["chromosome"],
-                position=self.escaped_model_attributes["position"],
-                reference=self.escaped_model_attributes["reference"],
-                alternate=self.escaped_model_attributes["alternate"],
-                genome_assembly_id=self.escaped_model_attributes["genome_assembly"].id
-            )
-        elif self.model_type == TranscriptVariant:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM TranscriptVariant'
-            else:
-                table = 'SELECT * FROM "TranscriptVariant"'
-            cmd = ''.join([
-                " WHERE transcript_id = {transcript_id}",
-                " AND variant_id = {variant_id}"
-            ]).format(
-                transcript_id=self.escaped_model_attributes["transcript"].id,
-                variant_id=self.escaped_model_attributes["variant"].id
-            )
-        elif self.model_type == ProbandVariant:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM ProbandVariant'
-            else:
-                table = 'SELECT * FROM "ProbandVariant"'
-            cmd = ''.join([
-                " WHERE variant_id = {variant_id}",
-                " AND interpretation_report_id = {interpretation_report_id}"
-            ]).format(
-                variant_id=self.escaped_model_attributes["variant"].id,
-                interpretation_report_id=self.escaped_model_attributes["interpretation_report"].id
-            )
-        elif self.model_type == PVFlag:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM PVFlag'
-            else:
-                table = 'SELECT * FROM "PVFlag"'
-            cmd = ''.join([
-                " WHERE proband_variant_id = {proband_variant_id}",
-                " AND flag_name = '{flag_name}'"
-            ]).format(
-                proband_variant_id=self.escaped_model_attributes["proband_variant"].id,
-                flag_name=self.escaped_model_attributes["flag_name"]
-            )
-        elif self.model_type == ProbandTranscriptVariant:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM ProbandTranscriptVariant'
-            else:
-                table = 'SELECT * FROM "ProbandTranscriptVariant"'
-            cmd = ''.join([
-                " WHERE transcript_id = {transcript_id}",
-                " AND proband_variant_id = {proband_variant_id}"
-            ]).format(
-                transcript_id=self.escaped_model_attributes["transcript"].id,
-                proband_variant_id=self.escaped_model_attributes["proband_variant"].id
-            )
-        elif self.model_type == ReportEvent:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM ReportEvent'
-            else:
-                table = 'SELECT * FROM "ReportEvent"'
-            cmd = ''.join([
-                " WHERE re_id = '{re_id}'",
-                " AND proband_variant_id = {proband_variant_id}"
-            ]).format(
-                re_id=self.escaped_model_attributes["re_id"],
-                proband_variant_id=self.escaped_model_attributes["proband_variant"].id
-            )
-        elif self.model_type == ToolOrAssemblyVersion:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM ToolOrAssemblyVersion'
-            else:
-                table = 'SELECT * FROM "ToolOrAssemblyVersion"'
-            cmd = ''.join([
-                " WHERE tool_name = '{tool_name}'",
-                " AND version_number = '{version_number}'"
-            ]).format(
-                tool_name=self.escaped_model_attributes["tool_name"],
-                version_number=self.escaped_model_attributes["version_number"]
-            )
-        elif self.model_type == SVRegion:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM SVRegion'
-            else:
-                table = 'SELECT * FROM "SVRegion"'
-            cmd = ''.join([
-                f" WHERE chromosome = '{self.escaped_model_attributes['chromosome']}'",
-                f" AND sv_start = {self.escaped_model_attributes['sv_start']}"
-                f" AND sv_end = '{self.escaped_model_attributes['sv_end']}'"
-                f" AND genome_assembly_id = {self.escaped_model_attributes['genome_assembly'].id}"])
-        elif self.model_type == SV:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM SV'
-            else:
-                table = 'SELECT * FROM "SV"'
-            if self.escaped_model_attributes['sv_region2'] is None:
-                cmd = ''.join([
-                    f" WHERE sv_region1_id = {self.escaped_model_attributes['sv_region1'].id}",
-                    f" AND variant_type = '{self.escaped_model_attributes['variant_type']}'"
-                ])
-            else:
-                cmd = ''.join([
-                    f" WHERE sv_region1_id = {self.escaped_model_attributes['sv_region1'].id}",
-                    f" WHERE sv_region2_id = {self.escaped_model_attributes['sv_region2'].id}",
-                    f" AND variant_type = '{self.escaped_model_attributes['variant_type']}'"
-                ])
-        elif self.model_type == ProbandSV:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM ProbandSV'
-            else:
-                table = 'SELECT * FROM "ProbandSV"'
-            cmd = ''.join([
-                f" WHERE interpretation_report_id = {self.escaped_model_attributes['interpretation_report'].id}",
-                f" AND sv_id = {self.escaped_model_attributes['sv'].id}",
-            ])
-        elif self.model_type == ProbandSVGene:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM ProbandSVGene'
-            else:
-                table = 'SELECT * FROM "ProbandSVGene"'
-            cmd = ''.join([
-                f" WHERE proband_sv_id = {self.escaped_model_attributes['proband_sv'].id}",
-                f" AND gene_id = '{self.escaped_model_attributes['gene'].id}'"
-            ])
-        elif self.model_type == STRVariant:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM STRVariant'
-            else:
-                table = 'SELECT * FROM "STRVariant"'
-            cmd = ''.join([
-                f" WHERE chromosome = '{self.escaped_model_attributes['chromosome']}'",
-                f" AND str_start = '{self.escaped_model_attributes['str_start']}'"
-                f" AND str_end = '{self.escaped_model_attributes['str_end']}'"
-                f" AND repeated_sequence = '{self.escaped_model_attributes['repeated_sequence']}'"
-                f" AND normal_threshold = '{self.escaped_model_attributes['normal_threshold']}'"
-                f" AND pathogenic_threshold = '{self.escaped_model_attributes['pathogenic_threshold']}'"
-                f" AND genome_assembly_id = {self.escaped_model_attributes['genome_assembly'].id}"])
-        elif self.model_type == ProbandSTR:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM ProbandSTR'
-            else:
-                table = 'SELECT * FROM "ProbandSTR"'
-            cmd = ''.join([
-                f" WHERE interpretation_report_id = {self.escaped_model_attributes['interpretation_report'].id}",
-                f" AND str_variant_id = {self.escaped_model_attributes['str_variant'].id}",
-            ])
-        elif self.model_type == ProbandSTRGene:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM ProbandSTRGene'
-            else:
-                table = 'SELECT * FROM "ProbandSTRGene"'
-            cmd = ''.join([
-                f" WHERE proband_str_id = {self.escaped_model_attributes['proband_str'].id}",
-                f" AND gene_id = '{self.escaped_model_attributes['gene'].id}'"
-            ])
-
-        sql =  ''.join([
-            table,
-            cmd
-        ])
-        return sql
-
-    def check_found_in_db(self, queryset):
+        self.model_index = model_index
+        self.entry = None
+
+    def check_found_in_db(self):
         """
-        Queries the database for a model of the given type with the given
-        attributes. Returns True if found, False if not.
+        Looks up a model of the given type with the given attributes in
+        model_index, or the database if there is no index. Returns the entry
+        if found, False if not.
         """
-        sql_cmd = self.set_sql_cmd()
-
-        entry = [
-            db_obj for db_obj in self.model_type.objects.raw(sql_cmd)
-        ]
-        # tqdm.write(sql_cmd + "\t>>>\t" + str(entry))
-
-        if len(entry) == 1:
-            entry = entry[0]
-            # also need to set self.entry here as it may not be called in init
-            self.entry = entry
-        elif len(entry) == 0:
-            entry = False
-            self.entry = entry
-        else:
-            print(entry)
-            raise ValueError("Multiple entries found for same object.")
-
-        return entry
+        self.entry = None
+        model_index = self.model_index or NaturalKeyIndex(self.model_type)
+        model_index.resolve([self])
+        return self.entry
 
 
 class ManyCaseModel(object):
@@ -2142,16 +1835,19 @@ class ManyCaseModel(object):
     for ManyToMany field population, as the bulk update must be handled using
     'through' tables.
     """
-    def __init__(self, model_type, model_attributes_list, model_objects):
+    def __init__(self, model_type, model_attributes_list, model_index):
         self.model_type = model_type
         self.model_attributes_list = model_attributes_list
-        self.model_objects = model_objects
+        self.model_index = model_index
 
         self.case_models = [
-            CaseModel(model_type, model_attributes, model_objects)
+            CaseModel(model_type, model_attributes, model_index)
             for model_attributes in model_attributes_list
         ]
-        self.entries = self.get_entry_list()
+
+    @property
+    def entries(self):
+        return self.get_entry_list()
 
     def get_entry_list(self):
         entries = []
@@ -0,0 +1,179 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+from django.db import connection, models
+
+from ..models import *
+from .natural_keys import CONFLICT_TARGETS
+
+
+def copy_value(value):
+    """
+    Returns value as a field of PostgreSQL's COPY text format.
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace(
+        "\n", "\\n").replace("\r", "\\r")
+
+
+class RowStream(object):
+    """
+    File-like object from which COPY ... FROM STDIN reads, encoding lines
+    from an iterator as they are asked for so that the rows are never held
+    in memory as one block of text.
+    """
+    def __init__(self, lines):
+        self.lines = iter(lines)
+        self.buffer = bytearray()
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.lines).encode("utf-8")
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+class CopyLoader(object):
+    """
+    Writes new rows of one of the high volume models on PostgreSQL by
+    streaming them into a temporary staging table with COPY, then merging
+    them into the real table with one INSERT ... SELECT which skips the
+    natural keys already there. The rows for every key staged, new or
+    existing, are read back with one join and added to the NaturalKeyIndex.
+
+    The number of statements is the same however many rows there are, so
+    it pays off for the very large bins of TranscriptVariants and
+    ProbandTranscriptVariants in cancer and pullt3 updates. Other databases
+    use NaturalKeyIndex.upsert or bulk_create instead.
+
+    Attributes:
+        model_index (NaturalKeyIndex): index for the model being written.
+    """
+    models = (
+        Variant, Transcript, TranscriptVariant, ProbandVariant,
+        ProbandTranscriptVariant)
+
+    def __init__(self, model_index):
+        self.model_index = model_index
+        self.model_type = model_index.model_type
+        self.meta = self.model_type._meta
+        self.fields = [
+            field for field in self.meta.concrete_fields if not field.primary_key]
+
+    @classmethod
+    def supports(cls, model_index):
+        """
+        Returns whether rows of model_index's model can be copied in, which
+        needs PostgreSQL and a unique constraint on the natural key.
+        """
+        return (
+            connection.vendor == 'postgresql' and
+            model_index.model_type in cls.models and
+            model_index.can_upsert())
+
+    def lines(self, objs):
+        for obj in objs:
+            yield "\t".join(
+                copy_value(field.get_db_prep_save(field.pre_save(obj, True), connection))
+                for field in self.fields) + "\n"
+
+    def key_join(self, table, keys):
+        """
+        Returns the join condition between table and keys on the natural
+        key. TEXT columns are also compared by md5, so that the unique
+        index on md5s (see CONFLICT_TARGETS) can be used.
+        """
+        quote = connection.ops.quote_name
+        conditions = []
+        for field in self.model_index.fields:
+            column = quote(field.column)
+            conditions.append("{table}.{column} = {keys}.{column}".format(
+                table=table, keys=keys, column=column))
+            if isinstance(field, models.TextField):
+                conditions.append("md5({table}.{column}) = md5({keys}.{column})".format(
+                    table=table, keys=keys, column=column))
+        return " AND ".join(conditions)
+
+    def load(self, objs):
+        """
+        Copies objs into the model's table, skipping those whose natural key
+        is already there.
+
+        Returns:
+            list: the rows for objs, new or existing.
+        """
+        if any(None in self.model_index.key({
+                field.name: getattr(obj, field.attname)
+                for field in self.model_index.fields}) for obj in objs):
+            # NULLs never conflict, so these can't be merged on the key
+            return self.model_index.upsert(objs)
+
+        quote = connection.ops.quote_name
+        table = quote(self.meta.db_table)
+        staging = quote("staging_" + self.meta.db_table.lower())
+        columns = ", ".join(quote(field.column) for field in self.fields)
+        key_columns = ", ".join(quote(field.column) for field in self.model_index.fields)
+        conflict_target = CONFLICT_TARGETS.get(self.model_type) or key_columns
+        with connection.cursor() as cursor:
+            # a staging table left by a load which failed outside a
+            # transaction lasts as long as the connection
+            cursor.execute("DROP TABLE IF EXISTS {staging}".format(staging=staging))
+            cursor.execute(
+                "CREATE TEMPORARY TABLE {staging} AS SELECT {columns} FROM {table} WITH NO DATA".format(
+                    staging=staging, columns=columns, table=table))
+            cursor.copy_expert(
+                "COPY {staging} ({columns}) FROM STDIN".format(
+                    staging=staging, columns=columns),
+                RowStream(self.lines(objs)))
+            # without statistics the planner takes the staging table to be
+            # tiny, and joins it to the real table by scanning the table
+            cursor.execute("ANALYZE {staging}".format(staging=staging))
+            cursor.execute(
+                "INSERT INTO {table} ({columns}) "
+                "SELECT DISTINCT ON ({key_columns}) {columns} FROM {staging} "
+                "ON CONFLICT ({conflict_target}) DO NOTHING".format(
+                    table=table, columns=columns, key_columns=key_columns,
+                    staging=staging, conflict_target=conflict_target))
+            cursor.execute(
+                "SELECT {row_columns} FROM {table} JOIN "
+                "(SELECT DISTINCT {key_columns} FROM {staging}) AS staged "
+                "ON {join}".format(
+                    row_columns=", ".join(
+                        "{}.{}".format(table, quote(field.column))
+                        for field in self.meta.concrete_fields),
+                    table=table, key_columns=key_columns, staging=staging,
+                    join=self.key_join(table, "staged")))
+            attnames = [field.attname for field in self.meta.concrete_fields]
+            rows = [
+                self.model_type.from_db(connection.alias, attnames, values)
+                for values in cursor.fetchall()]
+            cursor.execute("DROP TABLE {staging}".format(staging=staging))
+        self.model_index.add(rows)
+        return rows
@@ -22,13 +22,23 @@ SOFTWARE.
 import os
 import traceback
 import json
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from ..models import *
-from ..api_utils.poll_api import PollAPI
+from ..api_utils.poll_api import PollAPI, set_host_concurrency
+from ..api_utils.http_client import get_http_client
 from ..api_utils.cip_utils import InterpretationList
 from ..vep_utils.run_vep_batch import generate_transcripts
 from .case_handler import Case, CaseAttributeManager
+from .archive_store import ArchiveStore
+from .natural_keys import NaturalKeyIndex
+from .copy_loader import CopyLoader
+from .update_planner import UpdatePlanner
 from ..config import load_config
+from django.db import transaction
+from django.db.models import Exists, OuterRef
 import pprint
 import logging
 import time
@@ -48,7 +58,9 @@ class MultipleCaseAdder(object):
     """
     def __init__(self, sample_type, head=None, test_data=False,
                  skip_demographics=False, sample=None, pullt3=True,
-                 bins=None):
+                 bins=None, workers=None, host_concurrency=None,
+                 force_full=False, retry_quarantined=False, plan_only=False,
+                 plan_file=None):
         """
         Initiliase an instance of a MultipleCaseAdder to start managing
         a database update. This will get the list of cases available to
@@ -57,6 +69,18 @@ class MultipleCaseAdder(object):
         :param test_data: Boolean. Use test data or not. Default = False
         :param sample: If you want to add a single sample, set this the GELID
         :param pullt3: Boolean to pull t3 variants
+        :param workers: Number of case JSONs (and case list pages) to download
+            at once. Defaults to cip_api_workers in config.txt, or 1
+            (sequential) if not set
+        :param host_concurrency: Maximum requests in flight to CIP-API at
+            once. Defaults to cip_api_host_concurrency in config.txt
+        :param force_full: Boolean. Download every case, even those whose
+            listing entry is unchanged since they were last ingested
+        :param retry_quarantined: Boolean. Only poll the cases in
+            QuarantinedCase, i.e. those which failed in earlier updates
+        :param plan_only: Boolean. Only work out which cases would be added,
+            updated, skipped and blocked, print it, and change nothing
+        :param plan_file: Path to write the plan to as JSON, if plan_only
         """
         print("Initialising a MultipleCaseAdder.")
 
@@ -76,6 +100,28 @@ class MultipleCaseAdder(object):
         self.pullt3 = pullt3
         # get the config file for datadumps
         self.config = load_config.LoadConfig().load()
+        # how many case jsons to download at once, and cap on CIP-API requests
+        self.workers = int(workers or self.config.get('cip_api_workers', 1))
+        if host_concurrency is None:
+            host_concurrency = self.config.get('cip_api_host_concurrency', None)
+        if host_concurrency is not None:
+            set_host_concurrency(PollAPI("cip_api", "").host, int(host_concurrency))
+        # refill the budget of API retries for this run
+        get_http_client().start_run()
+        # 'canonical' hashes match those of existing GELInterpretationReports;
+        # 'raw' hashes the response bytes, which is cheaper but makes every
+        # case look changed once when switched on
+        self.case_hash_mode = self.config.get('case_hash_mode', 'canonical')
+        if self.case_hash_mode not in Case.hash_modes:
+            raise ValueError('{mode} is not a valid entry for "case_hash_mode"; please enter either "canonical" or "raw".'.format(mode=self.case_hash_mode))
+        # on PostgreSQL, write bins of at least copy_loader_min_rows new rows
+        # of the high volume models with COPY through a staging table
+        self.copy_loader = self.config.get('copy_loader', 'False') == 'True'
+        self.copy_loader_min_rows = int(self.config.get('copy_loader_min_rows') or 5000)
+        # cases which could not be fetched or parsed, with their tracebacks
+        self.failed_cases = []
+        # listing entries by ir_id, recorded as ListingSnapshots on success
+        self.listing_entries = {}
 
         # instantiate a PanelManager for the Case classes to use
         self.panel_manager = PanelManager()
@@ -83,6 +129,9 @@ class MultipleCaseAdder(object):
         self.variant_manager = VariantManager()
         self.gene_manager = GeneManager()
         self.sample_type = sample_type
+        # works out which cases to add, update, skip and block
+        self.planner = UpdatePlanner(sample_type)
+        self.plan = None
 
         if self.test_data:
             print("Fetching test data.")
@@ -95,9 +144,13 @@ class MultipleCaseAdder(object):
             self.cases_to_skip = []
             self.update_database()
         elif sample:
-            interpretation_list_poll = InterpretationList(sample_type=sample_type, sample=sample)
+            interpretation_list_poll = InterpretationList(sample_type=sample_type, sample=sample, workers=self.workers)
             self.cases_to_poll = interpretation_list_poll.cases_to_poll
+            self.set_listing_entries(self.cases_to_poll)
             self.blocked_cases = interpretation_list_poll.blocked_cases
+            if plan_only:
+                self.plan_update(self.cases_to_poll, self.cases_to_poll, bins, plan_file)
+                return
             self.block_cases()
             self.list_of_cases = self.fetch_api_data()
             self.cases_to_update = self.list_of_cases
@@ -109,18 +162,28 @@ class MultipleCaseAdder(object):
             # set list_of_cases to cases of interest from API
             print("Fetching live API data.")
             print("Polling for list of available cases...")
-            interpretation_list_poll = InterpretationList(sample_type=sample_type)
+            interpretation_list_poll = InterpretationList(sample_type=sample_type, workers=self.workers)
             self.blocked_cases = interpretation_list_poll.blocked_cases
-            self.block_cases()
+            if not plan_only:
+                self.block_cases()
             cases_fetched = len(interpretation_list_poll.cases_to_poll)
             print("Fetched", cases_fetched, "available cases")
 
             print("Determining which cases to poll...")
             # reverse update, do the newest first!
             self.total_cases_to_poll = interpretation_list_poll.cases_to_poll[::-1]
+            self.set_listing_entries(self.total_cases_to_poll)
+            if retry_quarantined:
+                self.total_cases_to_poll = self.quarantined_only(self.total_cases_to_poll)
+            elif not force_full:
+                self.total_cases_to_poll = self.skip_unchanged_cases(self.total_cases_to_poll)
             if head:
                 self.total_cases_to_poll = self.total_cases_to_poll[:head]
             self.num_cases_to_poll = len(self.total_cases_to_poll)
+            if plan_only:
+                self.plan_update(interpretation_list_poll.cases_to_poll,
+                                 self.total_cases_to_poll, bins, plan_file)
+                return
 
             if bins:
                 bin_size = int(bins)
@@ -150,13 +213,8 @@ class MultipleCaseAdder(object):
                         # take a certain number of cases off the top
                         self.list_of_cases = self.list_of_cases[:head]
                     print("Fetched all required CIP API data.")
-                    print("Checking which cases to add.")
-                    self.cases_to_add = self.check_cases_to_add()
-                    print("Checking which cases require updating.")
-                    self.cases_to_update = self.check_cases_to_update()
-                    self.cases_to_skip = set(self.list_of_cases) - \
-                        set(self.cases_to_add) - \
-                        set(self.cases_to_update)
+                    print("Checking which cases to add or update.")
+                    self.classify_cases()
                     self.update_database()
 
                     for case in self.cases_to_add:
@@ -176,13 +234,8 @@ class MultipleCaseAdder(object):
                     # take a certain number of cases off the top
                     self.list_of_cases = self.list_of_cases[:head]
                 print("Fetched all required CIP API data.")
-                print("Checking which cases to add.")
-                self.cases_to_add = self.check_cases_to_add()
-                print("Checking which cases require updating.")
-                self.cases_to_update = self.check_cases_to_update()
-                self.cases_to_skip = set(self.list_of_cases) - \
-                    set(self.cases_to_add) - \
-                    set(self.cases_to_update)
+                print("Checking which cases to add or update.")
+                self.classify_cases()
                 self.update_database()
 
     def update_database(self):
@@ -191,53 +244,201 @@ class MultipleCaseAdder(object):
         error = None
         added_cases = []
         updated_cases = []
+        # (case, latest report) for each case committed in this bin
+        self.written_cases = []
+        # (ir_id, 'write', traceback) for each case rolled back from the bin
+        self.quarantined_cases = []
+        committed = False
         try:
-            logger.info("Adding cases from cases_to_add.")
-            print("Adding", len(self.cases_to_add), "cases")
-            added_cases = self.add_cases()
-            print("Updating", len(self.cases_to_update), "cases")
-            updated_cases = self.add_cases(update=True)
+            # VEP and LabKey lookups are done before the transaction opens
+            logger.info("Preparing cases from cases_to_add and cases_to_update.")
+            self.prepare_cases(self.cases_to_add)
+            self.prepare_cases(self.cases_to_update)
+            with transaction.atomic():
+                logger.info("Adding cases from cases_to_add.")
+                print("Adding", len(self.cases_to_add), "cases")
+                added_cases = self.add_cases()
+                print("Updating", len(self.cases_to_update), "cases")
+                updated_cases = self.add_cases(update=True)
+            committed = True
+            # archive only once the reports they belong to are committed
+            self.archive_cases(self.written_cases)
             success = True
         except Exception as e:
             print("Encountered error:", e)
             error = traceback.format_exc()
             print(error)
             success = False
+            if not committed:
+                # the whole bin was rolled back
+                added_cases = []
+                updated_cases = []
+                self.quarantined_cases = []
         finally:
             print("Recording update")
+            failures = [
+                (ir_id, 'fetch', fetch_error) for ir_id, fetch_error in self.failed_cases
+            ] + self.quarantined_cases
+            if failures:
+                # cases which couldn't be fetched or written don't fail the
+                # update, but we still want them visible in the ListUpdate
+                failure_errors = "\n".join(
+                    "Failed to {stage} {ir_id}:\n{error}".format(
+                        stage=stage, ir_id=ir_id, error=failure_error)
+                    for ir_id, stage, failure_error in failures)
+                error = failure_errors if error is None else error + "\n" + failure_errors
+                QuarantinedCase.record(self.sample_type, failures)
+                self.failed_cases = []
+            # hosts which failed badly enough for their circuit to open
+            open_circuits = "\n".join(
+                "{host} opened at {time} after {failures} consecutive failures".format(
+                    host=host,
+                    time=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(opened_at)),
+                    failures=failures)
+                for host, opened_at, failures in get_http_client().pop_circuit_events())
             # record the update in ListUpdate
             listupdate = ListUpdate.objects.create(
                 update_time=timezone.now(),
                 success=success,
-                cases_added=len(self.cases_to_add),
-                cases_updated=len(self.cases_to_update),
+                cases_added=len(added_cases),
+                cases_updated=len(updated_cases),
                 sample_type=self.sample_type,
-                error=error
+                error=error,
+                open_circuits=open_circuits or None
             )
             listupdate.reports_added.add(*added_cases)
             listupdate.reports_updated.add(*updated_cases)
 
+            if success:
+                quarantined = set(ir_id for ir_id, stage, failure_error in self.quarantined_cases)
+                ingested_cases = [
+                    case for case in
+                    list(self.cases_to_add) +
+                    list(self.cases_to_update) +
+                    list(self.cases_to_skip)
+                    if case.request_id not in quarantined]
+                self.record_listing_snapshots(ingested_cases)
+                QuarantinedCase.objects.filter(interpretation_request_id__in=[
+                    case.request_id for case in ingested_cases]).delete()
+
             if self.sample_type == 'raredisease':
-                self.deselect_ensembl_transcripts(added_cases)
-                self.deselect_ensembl_transcripts(updated_cases)
+                self.deselect_ensembl_transcripts(added_cases + updated_cases)
+
+    def set_listing_entries(self, listed_cases):
+        """
+        Keep the InterpretationList entry of each listed case so that a
+        ListingSnapshot can be recorded once it has been ingested.
+        """
+        self.listing_entries = {
+            case["interpretation_request_id"]: case for case in listed_cases}
+
+    def skip_unchanged_cases(self, listed_cases):
+        """
+        Drop the cases whose listing entry matches the ListingSnapshot taken
+        when they were last ingested, so their jsons aren't downloaded again.
+        Cases no longer in the database are always kept.
+        """
+        ir_ids = [case["interpretation_request_id"] for case in listed_cases]
+        snapshots = {}
+        database_cases = set()
+        chunk_size = 500
+        for i in range(0, len(ir_ids), chunk_size):
+            chunk = ir_ids[i:i + chunk_size]
+            for snapshot in ListingSnapshot.objects.filter(interpretation_request_id__in=chunk):
+                snapshots[snapshot.interpretation_request_id] = snapshot
+            database_cases.update(InterpretationReportFamily.objects.filter(
+                ir_family_id__in=chunk).values_list('ir_family_id', flat=True))
+
+        changed_cases = []
+        for case in listed_cases:
+            ir_id = case["interpretation_request_id"]
+            snapshot = snapshots.get(ir_id)
+            if snapshot and ir_id in database_cases and snapshot.matches(case):
+                continue
+            changed_cases.append(case)
+
+        print("Skipping", len(listed_cases) - len(changed_cases),
+              "cases unchanged since they were last ingested.")
+        return changed_cases
+
+    def quarantined_only(self, listed_cases):
+        """
+        Keep only the listed cases which are in QuarantinedCase.
+        """
+        quarantined = set(QuarantinedCase.objects.filter(
+            sample_type=self.sample_type
+        ).values_list('interpretation_request_id', flat=True))
+        retry_cases = [
+            case for case in listed_cases
+            if case["interpretation_request_id"] in quarantined]
+        print("Retrying", len(retry_cases), "quarantined cases.")
+        return retry_cases
+
+    def record_listing_snapshots(self, cases):
+        """
+        Record the listing entry of each successfully ingested case, so that
+        later runs can skip it while its entry stays the same.
+        """
+        ir_ids = [case.request_id for case in cases
+                  if case.request_id in self.listing_entries]
+        existing = {
+            snapshot.interpretation_request_id: snapshot
+            for snapshot in ListingSnapshot.objects.filter(interpretation_request_id__in=ir_ids)}
+
+        new_snapshots = []
+        now = timezone.now()
+        for ir_id in ir_ids:
+            entry = self.listing_entries[ir_id]
+            values = ListingSnapshot.values_from_listing(entry)
+            values["last_status"] = values["last_status"] or ""
+            values["sample_type"] = entry["sample_type"]
+            values["ingested_at"] = now
+            if ir_id in existing:
+                snapshot = existing[ir_id]
+                if all(getattr(snapshot, field) == value for field, value in values.items()
+                       if field != "ingested_at"):
+                    continue
+                ListingSnapshot.objects.filter(
+                    interpretation_request_id=ir_id).update(**values)
+            else:
+                new_snapshots.append(ListingSnapshot(
+                    interpretation_request_id=ir_id, **values))
+        ListingSnapshot.objects.bulk_create(new_snapshots)
 
-    def deselect_ensembl_transcripts(self, cases):
+    def deselect_ensembl_transcripts(self, cases, batch_size=500):
         """
-        Deselects canonical ensembl transcripts which leaves just the refseq transcripts for RD cases
+        Deselects canonical ensembl transcripts which leaves just the refseq transcripts for RD cases.
+        Every selected ENST ProbandTranscriptVariant of the cases' proband
+        variants which also has a selected RefSeq (N*) transcript is
+        deselected, except on the mitochondrial chromosome, in one query
+        to find them and one UPDATE per batch_size rows.
         :param cases: List of RD cases which have been updated/added
-        :return:
+        :return: The number of ProbandTranscriptVariants deselected
         """
-        for case in cases:
-            proband_variants = case.probandvariant_set.all()
-            for pv in proband_variants:
-                ptvs = pv.probandtranscriptvariant_set.filter(selected=True)
-                for ptv in ptvs:
-                    if not ptv.proband_variant.variant.chromosome.startswith('M'):
-                        one_refseq = [probandtv for probandtv in ptvs if probandtv.transcript.name.startswith("N")]
-                        if one_refseq and len(ptvs) >= 2:
-                            if ptv.transcript.name.startswith('ENST'):
-                                ptv.selected = False
-                                ptv.save()
+        report_ids = [case.id for case in cases]
+        refseq_selected = ProbandTranscriptVariant.objects.filter(
+            proband_variant=OuterRef('proband_variant'),
+            selected=True,
+            transcript__name__startswith='N')
+        ptv_ids = []
+        for start in range(0, len(report_ids), batch_size):
+            ptv_ids += ProbandTranscriptVariant.objects.annotate(
+                refseq_selected=Exists(refseq_selected)
+            ).filter(
+                proband_variant__interpretation_report_id__in=report_ids[start:start + batch_size],
+                selected=True,
+                transcript__name__startswith='ENST',
+                refseq_selected=True
+            ).exclude(
+                proband_variant__variant__chromosome__startswith='M'
+            ).values_list('id', flat=True)
+
+        deselected = 0
+        for start in range(0, len(ptv_ids), batch_size):
+            deselected += ProbandTranscriptVariant.objects.filter(
+                id__in=ptv_ids[start:start + batch_size]).update(selected=False)
+        print("Deselected", deselected, "ensembl transcripts")
+        return deselected
 
     def fetch_test_data(self):
         """
@@ -255,8 +456,9 @@ class MultipleCaseAdder(object):
   
             if filename.endswith('.json'):
                 logger.info("Found case json at " + file_path + " for testing.")
-                with open(file_path) as json_file:
-                    json_data = json.load(json_file)
+                with open(file_path, 'rb') as json_file:
+                    raw_json = json_file.read()
+                    json_data = json.loads(raw_json.decode('utf-8'))
                     if json_data['sample_type'] == self.sample_type:
                         list_of_cases.append(Case(
                             case_json=json_data,
@@ -264,93 +466,138 @@ class MultipleCaseAdder(object):
                             variant_manager=self.variant_manager,
                             gene_manager=self.gene_manager,
                             skip_demographics=self.skip_demographics,
-                            pullt3=self.pullt3))
+                            pullt3=self.pullt3,
+                            raw_json=raw_json,
+                            hash_mode=self.case_hash_mode))
         logger.info("Found " + str(len(list_of_cases)) +  " test cases.")
         return list_of_cases
 
     def fetch_api_data(self):
+        """
+        Download the json for every case in self.cases_to_poll and create a
+        Case for each. Cases come back in the same order as cases_to_poll
+        regardless of how many workers are used. A case which fails to
+        download or parse is recorded in self.failed_cases and skipped, so
+        it doesn't stop the rest of the bin.
+        """
         list_of_cases = []
-        # list comprehension, calling self.get_case_json each time for poll
-        for case in tqdm(self.cases_to_poll):
-            tqdm.write("Polling for: {case}".format(case=case["interpretation_request_id"]))
-
-            c = Case(
-                # instatiate a new case with the polled json
-                case_json=self.get_case_json(case["interpretation_request_id"]),
-                panel_manager=self.panel_manager,
-                variant_manager=self.variant_manager,
-                gene_manager=self.gene_manager,
-                skip_demographics=self.skip_demographics,
-                pullt3=self.pullt3
-            )
-            list_of_cases.append(c)
+        fetched_jsons = self.fetch_case_jsons(self.cases_to_poll)
+        for case, case_data, fetch_error in tqdm(fetched_jsons, total=len(self.cases_to_poll)):
+            ir_id = case["interpretation_request_id"]
+            tqdm.write("Polling for: {case}".format(case=ir_id))
+            if fetch_error is None:
+                try:
+                    c = Case(
+                        # instatiate a new case with the polled json
+                        panel_manager=self.panel_manager,
+                        variant_manager=self.variant_manager,
+                        gene_manager=self.gene_manager,
+                        skip_demographics=self.skip_demographics,
+                        pullt3=self.pullt3,
+                        hash_mode=self.case_hash_mode,
+                        **case_data
+                    )
+                    list_of_cases.append(c)
+                except Exception:
+                    fetch_error = traceback.format_exc()
+            if fetch_error is not None:
+                tqdm.write("Failed to fetch {case}, skipping".format(case=ir_id))
+                logger.error("Failed to fetch " + ir_id + ":\n" + fetch_error)
+                self.failed_cases.append((ir_id, fetch_error))
 
         print("Successfully fetched", len(list_of_cases), "cases from CIP API.")
+        client = get_http_client()
+        for host, stats in client.connection_stats().items():
+            logger.info(
+                "{host}: {requests} requests, {opened} connections opened, "
+                "{reused} reused".format(host=host, **stats))
+        logger.info("CIP-API tokens minted: " + str(client.tokens_minted))
+        if client.rate_limiter is not None:
+            for host, metrics in client.rate_limiter.metrics.items():
+                logger.info(
+                    "{host}: waited {waited:.1f}s for the rate limit over "
+                    "{requests} requests (longest wait {max_wait:.2f}s)".format(
+                        host=host, **metrics))
         return list_of_cases
 
+    def fetch_case_jsons(self, cases):
+        """
+        Generator which downloads the json for each case in cases, yielding
+        (case, case_data, error) tuples in the order of cases, where
+        case_data is as returned by get_case_json. error is None on success,
+        otherwise the traceback and case_data is None.
+
+        If self.workers > 1 the jsons are downloaded by a pool of threads,
+        with at most 2 * workers downloads queued ahead of the case being
+        yielded so that memory use stays bounded on large bins.
+        """
+        if self.workers <= 1:
+            for case in cases:
+                try:
+                    yield case, self.get_case_json(case["interpretation_request_id"]), None
+                except Exception:
+                    yield case, None, traceback.format_exc()
+            return
+
+        # prompt for credentials up front rather than from a worker thread
+        PollAPI("cip_api", "").get_credentials()
+        case_iter = iter(cases)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque(
+                (case, executor.submit(self.get_case_json, case["interpretation_request_id"]))
+                for case in itertools.islice(case_iter, self.workers * 2))
+            while pending:
+                case, future = pending.popleft()
+                next_case = next(case_iter, None)
+                if next_case is not None:
+                    pending.append((next_case, executor.submit(
+                        self.get_case_json, next_case["interpretation_request_id"])))
+                try:
+                    yield case, future.result(), None
+                except Exception:
+                    yield case, None, traceback.format_exc()
+
     def get_case_json(self, interpretation_request_id):
         """
         Take an interpretation request ID, then get the json for that case
         using the PollAPI class defined in .database_utils
         :param interpretation_request_id: an IR ID of the format XXXX-X
-        :returns: A case json associated with the given IR ID from CIP-API
+        :returns: A dict of Case keyword arguments for the json associated
+            with the given IR ID from CIP-API: case_json with raw_json (the
+            response body)
         """
         request_poll = PollAPI(
             # instantiate a poll of CIP API for a given case json
             "cip_api", "interpretation-request/{id}/{version}?reports_v6=true".format(
                 id=interpretation_request_id.split("-")[0],
                 version=interpretation_request_id.split("-")[1]))
-        response = request_poll.get_json_response()
-        return response
+        raw_json = request_poll.get_json_response(content=True)
+        return {
+            'case_json': json.loads(raw_json.decode('utf-8')),
+            'raw_json': raw_json}
 
-    def check_cases_to_add(self):
+    def plan_update(self, listed_cases, cases_to_poll, bins, plan_file):
         """
-        Go through list of cases and check family ID against database
-        entries for IRfamily. Return the list of cases for which no IRfamily
-        exists.
+        Work out what an update of cases_to_poll would do and print it,
+        writing it to plan_file as JSON too if given, without downloading
+        or changing anything.
         """
-        database_cases = InterpretationReportFamily.objects.all().values_list(
-            'ir_family_id', flat=True
-        )
-
-        cases_to_add = []
-        for case in self.list_of_cases:
-            if case.request_id not in list(database_cases):
-                cases_to_add.append(case)
-        return cases_to_add
-
-    def check_cases_to_update(self):
+        self.plan = self.planner.plan(
+            listed_cases, cases_to_poll, self.blocked_cases,
+            bin_size=int(bins) if bins else None)
+        print(self.plan.summary())
+        if plan_file:
+            self.plan.export(plan_file)
+            print("Wrote update plan to", plan_file)
+
+    def classify_cases(self):
         """
-        Go through list of cases that _do not_ need to be added and check
-        hashes against the latest case stored for corresponding IRfamily
-        entries.
+        Split list_of_cases into cases_to_add, whose IRfamily isn't in the
+        database, cases_to_update, whose hash differs from the latest stored
+        report of their IRfamily, and cases_to_skip.
         """
-        cases_to_update = []
-        # use set subtraction to get only cases that haven't already been added
-        cases_to_check = set(self.list_of_cases) - set(self.cases_to_add)
-        all_latest_reports = GELInterpretationReport.objects.latest_cases_by_sample_type(sample_type=self.sample_type)
-        try:
-            latest_report_list = []
-            for case in cases_to_check:
-                for report in all_latest_reports:
-                    if case.request_id == report.ir_family.ir_family_id:
-                        latest_report_list.append(report)
-
-            latest_hashes = {
-                ir.ir_family.ir_family_id: ir.sha_hash
-                for ir in latest_report_list
-            }
-
-            for case in cases_to_check:
-                latest_hash = latest_hashes.get(case.request_id, None)
-                if not latest_hash or case.json_hash != latest_hash:
-                    cases_to_update.append(case)
-
-        except GELInterpretationReport.DoesNotExist as e:
-            # no such cases.
-            pass
-
-        return cases_to_update
+        self.cases_to_add, self.cases_to_update, self.cases_to_skip = \
+            self.planner.classify(self.list_of_cases)
 
     def block_cases(self):
         """
@@ -358,58 +605,19 @@ class MultipleCaseAdder(object):
         to have their status updated in the database
         """
         print('Attempting to block cases that need blocking...')
-        all_latest_reports = GELInterpretationReport.objects.latest_cases_by_sample_type(sample_type=self.sample_type)
-        latest_report_list = []
-        for case in self.blocked_cases:
-            for report in all_latest_reports:
-                if case['interpretation_request_id'] == report.ir_family.ir_family_id:
-                    latest_report_list.append(report)
-        for report in latest_report_list:
-            if report.status != 'blocked':
-                print('Blocking case:', report)
-                report.status = 'blocked'
-                report.save(overwrite=True)
-
+        reports_to_block = self.planner.reports_to_block(self.blocked_cases)
+        for report in reports_to_block:
+            print('Blocking case:', report)
+            report.status = 'blocked'
+        GELInterpretationReport.objects.bulk_rollover(reports_to_block, overwrite=True)
 
-    def add_cases(self, update=False):
+    def prepare_cases(self, cases):
         """
-        Adds the cases to the database which required adding.
+        Fetches the transcripts for the variants of cases from VEP and looks
+        up their demographics, both of which are done for the whole bin at
+        once. Nothing is written to the database, so this is done before the
+        bin's transaction is opened.
         """
-        update_order = (
-            # tuple of tuples to preserve update order. each sub-tuple is the
-            # key to access the attribute manager and whether is has many objs
-            (Clinician, False),
-            (Family, False),
-            (Phenotype, True),
-            (Panel, True),
-            (PanelVersion, True),
-            (Gene, True),
-            (ToolOrAssemblyVersion, True),
-            (Transcript, True),
-            (Variant, True),
-            (Proband, False),
-            (Relative, True),
-            (InterpretationReportFamily, False),
-            (InterpretationReportFamilyPanel, True),
-            (GELInterpretationReport, False),
-            (ProbandVariant, True),
-            (PVFlag, True),
-            (TranscriptVariant, True),
-            (ProbandTranscriptVariant, True),
-            (SVRegion, True),
-            (SV, True),
-            (ProbandSV, True),
-            (ProbandSVGene, True),
-            (STRVariant, True),
-            (ProbandSTR, True),
-            (ProbandSTRGene, True),
-            #(ReportEvent, True)
-        )
-
-        if update:
-            cases = self.cases_to_update
-        elif not update:
-            cases = self.cases_to_add
         if cases:
             # we need vep results for all cases, which needs to be done in batch
             variants = []
@@ -427,9 +635,8 @@ class MultipleCaseAdder(object):
                 self.transcript_manager.add_transcript(transcript, case.tools_and_versions['genome_build'] )
 
             # assign transcripts
-            i = 0
-            while i < len(transcripts):  # keep going until no transcripts left
-                transcript = transcripts.pop(0) # check to see if transcript already exists in transcript manager
+            for transcript in transcripts:
+                # check to see if transcript already exists in transcript manager
                 case_id = transcript.case_id
                 case = case_id_map[case_id]
                 fetched_transcript = self.transcript_manager.fetch_transcript(transcript)
@@ -467,25 +674,121 @@ class MultipleCaseAdder(object):
                     case.clinicians = clinicians
                     case.diagnosis = diagnosis
 
+    def add_cases(self, update=False):
+        """
+        Adds the cases to the database which required adding (or updating).
+
+        The cases are written together where possible. If that fails, they
+        are written again one at a time, each under its own savepoint, so
+        that a case which can't be written is rolled back and quarantined
+        while the rest of the bin goes in. Returns the latest
+        GELInterpretationReport of each case written.
+        """
+        if update:
+            cases = self.cases_to_update
+        elif not update:
+            cases = self.cases_to_add
+
+        case_reports = []
+        for case in self.write_isolated(cases, self.write_cases):
+            ir_family = case.attribute_managers[InterpretationReportFamily].case_model.entry
+            latest_case = GELInterpretationReport.objects.filter(
+                ir_family=ir_family
+            ).latest('polled_at_datetime')
+            case_reports.append(latest_case)
+            self.written_cases.append((case, latest_case))
+        return case_reports
+
+    def write_isolated(self, cases, write):
+        """
+        Calls write(cases) under a savepoint. If it raises, the savepoint is
+        rolled back and write([case]) is called for each case under a
+        savepoint of its own; cases which still raise are added to
+        self.quarantined_cases with their traceback.
+
+        Returns:
+            list: the cases which were written.
+        """
+        if not cases:
+            return []
+        try:
+            with transaction.atomic():
+                write(cases)
+            return list(cases)
+        except Exception:
+            if len(cases) == 1:
+                failed_case_errors = [(cases[0], traceback.format_exc())]
+                cases = []
+            else:
+                logger.error("Failed to write bin, retrying its cases one at a time:\n" +
+                             traceback.format_exc())
+                print("Failed to write bin, retrying its cases one at a time")
+                failed_case_errors = []
+
+        written = []
+        for case in cases:
+            try:
+                with transaction.atomic():
+                    write([case])
+                written.append(case)
+            except Exception:
+                failed_case_errors.append((case, traceback.format_exc()))
+        for case, write_error in failed_case_errors:
+            tqdm.write("Failed to write {case}, quarantining".format(case=case.request_id))
+            logger.error("Failed to write " + case.request_id + ":\n" + write_error)
+            self.quarantined_cases.append((case.request_id, 'write', write_error))
+        return written
+
+    def write_cases(self, cases):
+        """
+        Writes the entries for cases to the database, a model type at a time
+        for all of the cases together.
+        """
+        update_order = (
+            # tuple of tuples to preserve update order. each sub-tuple is the
+            # key to access the attribute manager and whether is has many objs
+            (Clinician, False),
+            (Family, False),
+            (Phenotype, True),
+            (Panel, True),
+            (PanelVersion, True),
+            (Gene, True),
+            (ToolOrAssemblyVersion, True),
+            (Transcript, True),
+            (Variant, True),
+            (Proband, False),
+            (Relative, True),
+            (InterpretationReportFamily, False),
+            (InterpretationReportFamilyPanel, True),
+            (GELInterpretationReport, False),
+            (ProbandVariant, True),
+            (PVFlag, True),
+            (TranscriptVariant, True),
+            (ProbandTranscriptVariant, True),
+            (SVRegion, True),
+            (SV, True),
+            (ProbandSV, True),
+            (ProbandSVGene, True),
+            (STRVariant, True),
+            (ProbandSTR, True),
+            (ProbandSTRGene, True),
+            #(ReportEvent, True)
+        )
+
         # ------------------- #
         # BULK UPDATE PROCESS #
         # ------------------- #
         for model_type, many in update_order:
 
-            # prefetch database entries for check_found_in_db()
-            lookups = self.get_prefetch_lookups(model_type)
-            if lookups:
-                model_objects = model_type.objects.all().values(*lookups)
-            elif not lookups:
-                model_objects = model_type.objects.all()
+            # index of the entries for this bin, filled as they are looked
+            # up and created
+            model_index = NaturalKeyIndex(model_type)
             for case in tqdm(cases, desc="Parsing {model_type} into DB".format(model_type=model_type.__name__)):
-                # create a CaseAttributeManager for the case
+                # create a CaseAttributeManager for the case, which sets the
+                # case models
                 tqdm.write(case.request_id)
                 case.attribute_managers[model_type] = CaseAttributeManager(
-                    case, model_type, model_objects)
-                # use thea attribute manager to set the case models
-                attribute_manager = case.attribute_managers[model_type]
-                attribute_manager.get_case_model()
+                    case, model_type, model_index)
 
             if not many:
                 # get a list of CaseModels
@@ -502,51 +805,45 @@ class MultipleCaseAdder(object):
                     for case_model in tqdm(many_case_model.case_models, desc=case.request_id):
                         model_list.append(case_model)
 
+            # find existing entries for the whole bin at once
+            model_index.resolve(model_list)
+
             # now create the required new Model instances from CaseModel lists
             if model_type == GELInterpretationReport:
-                # GEL_IR is a special case, preprocessing version no. means
-                # Model.objects.bulk_create() is not available
-                self.save_new(model_type, model_list)
+                # GEL_IR is a special case, version numbers and carried over
+                # fields come from the previous report, see bulk_rollover
+                created = self.save_new(model_type, model_list)
             else:
                 print("attempting to bulk create", model_type)
-                self.bulk_create_new(model_type, model_list)
-
-            # refresh CaseAttributeManagers with new CaseModels
-            lookups = self.get_prefetch_lookups(model_type)
-            if lookups:
-                model_objects = model_type.objects.all().values(*lookups)
-            elif not lookups:
-                model_objects = model_type.objects.all()
-            for model in model_list:
-                if model.entry is False:
-                    model.check_found_in_db(model_objects)
-
-        # finally, save jsons to disk storage
-        cip_api_storage = self.config['cip_api_storage']
-        case_reports = []
-        for case in cases:
-            ir_family = case.attribute_managers[InterpretationReportFamily].case_model.entry
-            latest_case = GELInterpretationReport.objects.filter(
-                ir_family=ir_family
-            ).latest('polled_at_datetime')
-            case_reports.append(latest_case)
+                created = self.bulk_create_new(model_type, model_list, model_index)
 
-            with open(
-                    os.path.join(
-                        cip_api_storage,
-                        '{}.json'.format(
-                            case.request_id + "-" + str(latest_case.archived_version)
-                        )), 'w') as f:
-                json.dump(case.raw_json, f)
-        return case_reports
+            # refresh CaseAttributeManagers with the entries just created
+            model_index.add(created)
+            model_index.resolve(model_list)
 
+    def archive_cases(self, written_cases):
+        """
+        Saves the jsons of written_cases, a list of (case, latest report)
+        pairs, to the archive.
+        """
+        archive = ArchiveStore(
+            self.config['cip_api_storage'],
+            codec=self.config.get('archive_codec') or None)
+        for case, latest_case in written_cases:
+            archive.put(
+                case.request_id,
+                latest_case.archived_version,
+                case.json["proband"],
+                case.json_hash,
+                case.raw_json)
 
     def save_new(self, model_type, model_list):
         """
         Takes a list of CaseModel isntances of a given type, then saves any
         that are new into the database. This function is for models such as
         GELInterpretationReport which require preprocessing and so cannot be
-        bulk created (which does not call the object.save() function)
+        bulk created (which does not call the object.save() function).
+        GELInterpretationReports are versioned together with bulk_rollover.
         """
         # get the attribute dicts for ModelCases which have no database entry
         new_attributes = [
@@ -562,18 +859,20 @@ class MultipleCaseAdder(object):
                 for attribute_dict
                 in new_attributes])]
         # save database entries from the list of unique new attributes
-
-
-        for attributes in new_attributes:
-            obj = model_type(**attributes)
+        created = [model_type(**attributes) for attributes in new_attributes]
+        if model_type == GELInterpretationReport:
+            return model_type.objects.bulk_rollover(created)
+        for obj in created:
             obj.save()
+        return created
 
-    def bulk_create_new(self, model_type, model_list):
+    def bulk_create_new(self, model_type, model_list, model_index=None):
         """
         Takes a list of CaseModel instances of a given model_type, then creates
         a list of unique attribute sets for that particular list of instances.
         This list of unique attributes can then be passed to a bulk_create
-        function to update the database.
+        function to update the database, or upserted through model_index for
+        the models with a unique natural key.
         """
 
         # get the attribute dicts for ModelCases which have no database entry
@@ -590,50 +889,19 @@ class MultipleCaseAdder(object):
                 for attribute_dict
                 in new_attributes])]
 
-
-        model_type.objects.bulk_create([
-            model_type(**attributes)
-            for attributes in new_attributes])
-
-    def get_prefetch_lookups(self, model_type):
-        """
-        Takes a model type and returns list of the ForeignKey fields which
-        need to be passed to prefetch_related() when creating a QuerySet to
-        quickly get related items.
-
-        When adding new tables to the database, add their FKs here.
-        """
-        lookup_dict = {
-            Clinician: ['id','name', 'hospital', 'email'],
-            Phenotype: ['id','hpo_terms'],
-            Family: ['id',"gel_family_id"],
-            FamilyPhenotype: ['id',"family", "phenotype"],
-            Gene: ['id','hgnc_id'],
-            Panel: ['id','panelapp_id'],
-            PanelVersion: ['id',"panel", 'version_number'],
-            PanelVersionGene: ['id',"panel_version", "gene"],
-            ToolOrAssemblyVersion: ['id','tool_name','version_number'],
-            InterpretationReportFamily: ['id',"ir_family_id"],
-            InterpretationReportFamilyPanel: ['id',"ir_family", "panel"],
-            GELInterpretationReport: ['id',"sha_hash"],
-            Proband: ['id',"gel_id"],
-            Relative: ['id',"gel_id", "proband"],
-            Variant: ['id','chromosome', 'position', 'reference', 'alternate', "genome_assembly"],
-            Transcript: ['id',"name", 'genome_assembly'],
-            TranscriptVariant: ['id',"transcript", "variant"],
-            ProbandVariant: ['id',"variant", "interpretation_report", 'max_tier'],
-            PVFlag: ['id', "proband_variant", "flag_name"],
-            ProbandTranscriptVariant: ['id',"transcript", "proband_variant"],
-            ReportEvent: ['id',"proband_variant", "re_id"],
-            SVRegion: ['id', 'chromosome', 'sv_start', 'sv_end', "genome_assembly"],
-            SV: ['id', 'sv_region1', 'sv_region2', 'variant_type'],
-            ProbandSV: ['id', "sv", "interpretation_report"],
-            ProbandSVGene: ['id', "proband_sv", 'gene'],
-            STRVariant: ['id', 'chromosome', 'str_start', 'str_end', "genome_assembly", "repeated_sequence", "normal_threshold", "pathogenic_threshold"],
-            ProbandSTR: ['id', "str_variant", "interpretation_report"],
-            ProbandSTRGene: ['id', "proband_str", 'gene'],
-        }
-        return lookup_dict[model_type]
+        new_objs = [model_type(**attributes) for attributes in new_attributes]
+        if (self.copy_loader and model_index is not None and
+                len(new_objs) >= self.copy_loader_min_rows and
+                CopyLoader.supports(model_index)):
+            print("copying", len(new_objs), model_type, "through a staging table")
+            return CopyLoader(model_index).load(new_objs)
+        if model_index is not None and model_index.can_upsert():
+            # rows written concurrently since the bin was resolved are
+            # returned rather than duplicated
+            return model_index.upsert(new_objs)
+
+        # returns the new instances, which have ids on PostgreSQL
+        return model_type.objects.bulk_create(new_objs)
 
     def update_cases(self):
         """
@@ -0,0 +1,284 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+from functools import reduce
+import operator
+
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.db.models import Q
+
+from ..models import *
+
+# fields which identify an existing row for each model MultipleCaseAdder
+# writes, i.e. the attributes a CaseModel is matched on
+NATURAL_KEYS = {
+    Clinician: ('name', 'hospital', 'email'),
+    Phenotype: ('hpo_terms',),
+    Family: ('gel_family_id',),
+    FamilyPhenotype: ('family', 'phenotype'),
+    Gene: ('hgnc_id',),
+    Panel: ('panelapp_id',),
+    PanelVersion: ('panel', 'version_number'),
+    PanelVersionGene: ('panel_version', 'gene'),
+    ToolOrAssemblyVersion: ('tool_name', 'version_number'),
+    InterpretationReportFamily: ('ir_family_id',),
+    InterpretationReportFamilyPanel: ('ir_family', 'panel'),
+    GELInterpretationReport: ('sha_hash',),
+    Proband: ('gel_id',),
+    Relative: ('gel_id', 'proband'),
+    Variant: ('chromosome', 'position', 'reference', 'alternate', 'genome_assembly'),
+    Transcript: ('name', 'genome_assembly'),
+    TranscriptVariant: ('transcript', 'variant'),
+    ProbandVariant: ('variant', 'interpretation_report'),
+    PVFlag: ('proband_variant', 'flag_name'),
+    ProbandTranscriptVariant: ('transcript', 'proband_variant'),
+    ReportEvent: ('proband_variant', 're_id'),
+    SVRegion: ('chromosome', 'sv_start', 'sv_end', 'genome_assembly'),
+    SV: ('sv_region1', 'sv_region2', 'variant_type'),
+    ProbandSV: ('sv', 'interpretation_report'),
+    ProbandSVGene: ('proband_sv', 'gene'),
+    STRVariant: ('chromosome', 'str_start', 'str_end', 'genome_assembly',
+                 'repeated_sequence', 'normal_threshold', 'pathogenic_threshold'),
+    ProbandSTR: ('str_variant', 'interpretation_report'),
+    ProbandSTRGene: ('proband_str', 'gene'),
+}
+
+# high volume models whose new rows are written with a single upsert per
+# batch, relying on a unique constraint over the natural key. All but
+# Variant have it in unique_together; Variant's reference and alternate are
+# TEXT, so its index is made by migration 0025 (on md5s of them in
+# PostgreSQL, and not at all in MySQL, which can't index whole TEXT columns)
+UPSERT_MODELS = (
+    Variant, Transcript, TranscriptVariant, ProbandVariant,
+    ProbandTranscriptVariant, PVFlag, SVRegion, SV, STRVariant)
+UNIQUE_INDEXES = {
+    Variant: 'variant_natural_key',
+}
+CONFLICT_TARGETS = {
+    Variant: 'chromosome, position, md5(reference), md5(alternate), genome_assembly_id',
+}
+
+
+class NaturalKeyIndex(object):
+    """
+    In-memory index of the database rows for the CaseModels of one model
+    type in a bin, hashed on their natural keys.
+
+    Rather than each CaseModel querying for itself, MultipleCaseAdder
+    collects every CaseModel of a type across the bin and resolves them
+    together. Only the keys which occur in the bin are fetched, in batches
+    of OR'd filters, so both the number of queries and the size of the
+    index depend on the bin rather than on the size of the table. Rows
+    created by the update are added to the index as they are made.
+
+    Attributes:
+        model_type (Model): the model being looked up.
+        fields (list): the model's natural key fields.
+        index (dict): natural key -> row, for the keys found so far.
+        queried (set): natural keys already looked up, found or not.
+    """
+    # keep the parameters of one query under SQLite's limit of 999
+    max_params = 900
+
+    def __init__(self, model_type):
+        self.model_type = model_type
+        self.fields = [
+            model_type._meta.get_field(name) for name in NATURAL_KEYS[model_type]]
+        self.batch_size = max(1, self.max_params // len(self.fields))
+        self.index = {}
+        self.queried = set()
+        self._can_upsert = None
+
+    def key(self, attributes):
+        """
+        Returns the natural key of a CaseModel's model_attributes, with
+        foreign keys as ids and other values converted to the field's type
+        so that they compare equal to the values read from the database.
+        """
+        values = []
+        for field in self.fields:
+            value = attributes.get(field.name)
+            if field.is_relation:
+                value = getattr(value, 'pk', value)
+            elif value is not None:
+                try:
+                    value = field.to_python(value)
+                except ValidationError:
+                    pass
+            values.append(value)
+        return tuple(values)
+
+    def row_key(self, row):
+        return tuple(getattr(row, field.attname) for field in self.fields)
+
+    def key_filter(self, key):
+        conditions = {}
+        for field, value in zip(self.fields, key):
+            if value is None:
+                conditions[field.attname + '__isnull'] = True
+            else:
+                conditions[field.attname] = value
+        return Q(**conditions)
+
+    def add(self, rows):
+        """
+        Adds rows to the index. Rows without a pk (bulk_create only sets
+        them on PostgreSQL) can't be indexed, so their keys are marked to be
+        looked up again instead.
+        """
+        for row in rows:
+            row_key = self.row_key(row)
+            if row.pk is None:
+                self.queried.discard(row_key)
+                continue
+            if row_key in self.index and self.index[row_key].pk != row.pk:
+                print(self.index[row_key], row)
+                raise ValueError("Multiple entries found for same object.")
+            self.index[row_key] = row
+            self.queried.add(row_key)
+
+    def fetch(self, keys):
+        """
+        Looks up keys in the database, adding the rows found to the index.
+        """
+        keys = list(keys)
+        for start in range(0, len(keys), self.batch_size):
+            batch = keys[start:start + self.batch_size]
+            if len(self.fields) == 1 and None not in batch:
+                query = Q(**{self.fields[0].attname + '__in': [key[0] for key in batch]})
+            else:
+                query = reduce(operator.or_, (self.key_filter(key) for key in batch))
+            self.add(self.model_type.objects.filter(query))
+            self.queried.update(batch)
+
+    def resolve(self, case_models):
+        """
+        Sets entry on each of case_models which doesn't have one yet, to its
+        database row or False if there isn't one. Only keys which haven't
+        been looked up already are queried for.
+        """
+        pending = {}
+        for case_model in case_models:
+            if not case_model.entry:
+                pending.setdefault(self.key(case_model.model_attributes), []).append(case_model)
+        self.fetch(key for key in pending if key not in self.queried)
+        for key, key_case_models in pending.items():
+            entry = self.index.get(key, False)
+            for case_model in key_case_models:
+                case_model.entry = entry
+
+    def can_upsert(self):
+        """
+        Returns whether new rows of the model can be written with upsert(),
+        i.e. whether the database has a unique constraint on its natural key
+        and a form of INSERT which skips rows violating it.
+        """
+        if self._can_upsert is None:
+            self._can_upsert = (
+                self.model_type in UPSERT_MODELS and
+                connection.vendor in ('postgresql', 'mysql', 'sqlite'))
+            if self._can_upsert:
+                # unique_together is only in the database if its migration
+                # has been made and applied
+                key_columns = set(field.column for field in self.fields)
+                with connection.cursor() as cursor:
+                    constraints = connection.introspection.get_constraints(
+                        cursor, self.model_type._meta.db_table)
+                self._can_upsert = (
+                    UNIQUE_INDEXES.get(self.model_type) in constraints or
+                    any(constraint['unique'] and set(constraint['columns']) == key_columns
+                        for constraint in constraints.values()))
+        return self._can_upsert
+
+    def upsert(self, objs):
+        """
+        Inserts objs, leaving alone any whose natural key is already in the
+        table (e.g. written by a concurrent update since the bin was
+        resolved), and adds the rows for all of their keys to the index.
+
+        On PostgreSQL each batch is one INSERT ... ON CONFLICT DO NOTHING
+        RETURNING, which returns the new rows without rewriting or locking
+        the existing ones, followed by one fetch of the keys which were
+        already there. MySQL and SQLite can't return the rows, so each batch
+        is followed by one fetch of all its keys. Keys are inserted in sorted
+        order so that concurrent updates writing overlapping keys take their
+        locks in the same order rather than deadlocking.
+
+        Objects with a null in their natural key are bulk created as before,
+        since NULLs never conflict in a unique constraint.
+
+        Returns:
+            list: the rows for objs, new or existing.
+        """
+        unique_objs = {}
+        nullable_objs = []
+        for obj in objs:
+            row_key = self.key({
+                field.name: getattr(obj, field.attname) for field in self.fields})
+            if None in row_key:
+                nullable_objs.append(obj)
+            else:
+                unique_objs.setdefault(row_key, obj)
+        rows = self.model_type.objects.bulk_create(nullable_objs)
+
+        meta = self.model_type._meta
+        fields = [field for field in meta.concrete_fields if not field.primary_key]
+        quote = connection.ops.quote_name
+        insert = "INSERT INTO {table} ({columns}) VALUES ".format(
+            table=quote(meta.db_table),
+            columns=", ".join(quote(field.column) for field in fields))
+        placeholder = "({})".format(", ".join(["%s"] * len(fields)))
+        if connection.vendor == 'postgresql':
+            conflict = " ON CONFLICT ({target}) DO NOTHING RETURNING {columns}".format(
+                target=CONFLICT_TARGETS.get(self.model_type) or ", ".join(
+                    quote(field.column) for field in self.fields),
+                columns=", ".join(quote(field.column) for field in meta.concrete_fields))
+        elif connection.vendor == 'mysql':
+            conflict = " ON DUPLICATE KEY UPDATE {pk} = {pk}".format(pk=quote(meta.pk.column))
+        else:
+            conflict = " ON CONFLICT DO NOTHING"
+
+        # compared as strings so that any mix of values still sorts
+        keys = sorted(unique_objs, key=lambda row_key: tuple(str(value) for value in row_key))
+        batch_size = max(1, self.max_params // len(fields))
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            params = []
+            for row_key in batch:
+                params.extend(
+                    field.get_db_prep_save(field.pre_save(unique_objs[row_key], True), connection)
+                    for field in fields)
+            sql = insert + ", ".join([placeholder] * len(batch)) + conflict
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                if connection.vendor == 'postgresql':
+                    attnames = [field.attname for field in meta.concrete_fields]
+                    self.add(
+                        self.model_type.from_db(connection.alias, attnames, values)
+                        for values in cursor.fetchall())
+            # the rows which were already there, e.g. written by a concurrent
+            # update since the bin was resolved
+            existing = [row_key for row_key in batch if row_key not in self.index]
+            self.queried.difference_update(existing)
+            self.fetch(existing)
+            rows.extend(self.index[row_key] for row_key in batch if row_key in self.index)
+        return rows
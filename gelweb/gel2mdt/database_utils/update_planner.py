@@ -0,0 +1,228 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import json
+import math
+
+from django.db.models import FilteredRelation, Q
+
+from ..models import *
+
+
+class UpdatePlan(object):
+    """
+    What a batch update will do with each listed case, worked out from the
+    CIP-API case list and the database without downloading any case jsons.
+
+    Attributes:
+        sample_type (str): raredisease or cancer.
+        cases (dict): interpretation request ids by action. Cases to add
+            aren't in the database; cases to update are, but their listing
+            entry has changed so their json will be downloaded and written
+            if its hash differs from their latest report's; cases to skip
+            are unchanged; cases to block have a latest report which isn't
+            blocked yet.
+        carried_variants (int): ProbandVariants on the latest reports of
+            the cases to update, which move to the new reports.
+        bin_size (int): cases downloaded and written at once, or None.
+    """
+    actions = ('add', 'update', 'skip', 'block')
+
+    def __init__(self, sample_type, bin_size=None):
+        self.sample_type = sample_type
+        self.cases = dict((action, []) for action in self.actions)
+        self.carried_variants = 0
+        self.bin_size = bin_size
+
+    @property
+    def downloads(self):
+        return len(self.cases['add']) + len(self.cases['update'])
+
+    @property
+    def bins(self):
+        if not self.downloads:
+            return 0
+        if not self.bin_size:
+            return 1
+        return int(math.ceil(self.downloads / float(self.bin_size)))
+
+    def as_dict(self):
+        return {
+            'sample_type': self.sample_type,
+            'counts': dict((action, len(self.cases[action])) for action in self.actions),
+            'downloads': self.downloads,
+            'bins': self.bins,
+            'carried_variants': self.carried_variants,
+            'cases': self.cases,
+        }
+
+    def summary(self):
+        return "\n".join([
+            "Update plan for {sample_type} cases:".format(sample_type=self.sample_type),
+            "    {count} to add".format(count=len(self.cases['add'])),
+            "    {count} to update if their json has changed".format(count=len(self.cases['update'])),
+            "    {count} to skip".format(count=len(self.cases['skip'])),
+            "    {count} to block".format(count=len(self.cases['block'])),
+            "    {downloads} case jsons to download in {bins} bins".format(
+                downloads=self.downloads, bins=self.bins),
+            "    {count} proband variants to carry over to new reports".format(
+                count=self.carried_variants),
+        ])
+
+    def export(self, path):
+        with open(path, 'w') as plan_file:
+            json.dump(self.as_dict(), plan_file, indent=4)
+
+
+class UpdatePlanner(object):
+    """
+    Works out which cases a batch update needs to add, update, skip and
+    block. Each case's family and the hash and status of its latest report
+    are looked up together, joining on the is_latest flag, with one query
+    per batch_size cases rather than checking every case against every
+    report.
+    """
+    def __init__(self, sample_type, batch_size=500):
+        self.sample_type = sample_type
+        self.batch_size = batch_size
+
+    def family_states(self, ir_ids):
+        """
+        Finds the latest report of this sample type for each case.
+
+        Returns:
+            dict: (report id, sha_hash, status) of the latest report by
+            ir_family_id, or (None, None, None) if the family has no report
+            of this sample type. Cases not in the database are left out.
+        """
+        ir_ids = list(set(ir_ids))
+        states = {}
+        for start in range(0, len(ir_ids), self.batch_size):
+            rows = InterpretationReportFamily.objects.filter(
+                ir_family_id__in=ir_ids[start:start + self.batch_size]
+            ).annotate(latest_report=FilteredRelation(
+                'gelinterpretationreport',
+                condition=Q(gelinterpretationreport__is_latest=True)
+            )).values_list(
+                'ir_family_id',
+                'latest_report__id',
+                'latest_report__sha_hash',
+                'latest_report__status',
+                'latest_report__sample_type')
+            for ir_family_id, report_id, sha_hash, status, sample_type in rows:
+                if report_id is None or sample_type != self.sample_type:
+                    states[ir_family_id] = (None, None, None)
+                else:
+                    states[ir_family_id] = (report_id, sha_hash, status)
+        return states
+
+    def classify(self, cases):
+        """
+        Splits fetched Cases into those to add, those whose json hash
+        differs from their latest report's, and those to skip.
+
+        Returns:
+            (list, list, list): cases to add, update and skip, in the
+            order they were given.
+        """
+        states = self.family_states([case.request_id for case in cases])
+        cases_to_add = []
+        cases_to_update = []
+        cases_to_skip = []
+        for case in cases:
+            if case.request_id not in states:
+                cases_to_add.append(case)
+            elif case.json_hash != states[case.request_id][1]:
+                cases_to_update.append(case)
+            else:
+                cases_to_skip.append(case)
+        return cases_to_add, cases_to_update, cases_to_skip
+
+    def block_report_ids(self, blocked_cases, states=None):
+        """
+        Returns the ids of the latest reports of the blocked InterpretationList
+        entries which aren't blocked yet.
+        """
+        ir_ids = [case['interpretation_request_id'] for case in blocked_cases]
+        if states is None:
+            states = self.family_states(ir_ids)
+        report_ids = []
+        for ir_id in ir_ids:
+            report_id, sha_hash, status = states.get(ir_id, (None, None, None))
+            if report_id is not None and status != 'blocked':
+                report_ids.append(report_id)
+        return report_ids
+
+    def reports_to_block(self, blocked_cases):
+        """
+        Returns the latest GELInterpretationReports of the blocked
+        InterpretationList entries which aren't blocked yet.
+        """
+        report_ids = self.block_report_ids(blocked_cases)
+        reports = []
+        for start in range(0, len(report_ids), self.batch_size):
+            reports += GELInterpretationReport.objects.filter(
+                id__in=report_ids[start:start + self.batch_size]
+            ).select_related('ir_family')
+        return reports
+
+    def plan(self, listed_cases, cases_to_poll, blocked_cases, bin_size=None):
+        """
+        Plans an update from the InterpretationList entries, without
+        downloading or writing anything.
+
+        Args:
+            listed_cases (list): every entry in the case list.
+            cases_to_poll (list): the entries whose jsons would be
+                downloaded, i.e. those left after unchanged cases are dropped.
+            blocked_cases (list): the blocked entries in the case list.
+            bin_size (int): cases downloaded and written at once, if binned.
+
+        Returns:
+            UpdatePlan
+        """
+        update_plan = UpdatePlan(self.sample_type, bin_size=bin_size)
+        polled_ids = [case['interpretation_request_id'] for case in cases_to_poll]
+        states = self.family_states(
+            polled_ids + [case['interpretation_request_id'] for case in blocked_cases])
+
+        latest_report_ids = []
+        for ir_id in polled_ids:
+            if ir_id in states:
+                update_plan.cases['update'].append(ir_id)
+                if states[ir_id][0] is not None:
+                    latest_report_ids.append(states[ir_id][0])
+            else:
+                update_plan.cases['add'].append(ir_id)
+        polled = set(polled_ids)
+        update_plan.cases['skip'] = [
+            case['interpretation_request_id'] for case in listed_cases
+            if case['interpretation_request_id'] not in polled]
+        block_ids = set(self.block_report_ids(blocked_cases, states))
+        update_plan.cases['block'] = [
+            case['interpretation_request_id'] for case in blocked_cases
+            if states.get(case['interpretation_request_id'], (None, None, None))[0] in block_ids]
+
+        for start in range(0, len(latest_report_ids), self.batch_size):
+            update_plan.carried_variants += ProbandVariant.objects.filter(
+                interpretation_report_id__in=latest_report_ids[start:start + self.batch_size]
+            ).count()
+        return update_plan
@@ -0,0 +1,94 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import os
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from gel2mdt.api_utils.json_stream import load_sections
+from gel2mdt.database_utils.archive_store import ArchiveStore
+from gel2mdt.config import load_config
+
+FLAT_FILE = re.compile(r'^(?P<ir_family_id>\d+-\d+)-(?P<archived_version>\d+)\.json$')
+
+
+class Command(BaseCommand):
+    help = """Move the flat <ir>-<version>-<archived version>.json files in
+    cip_api_storage into the compressed, deduplicated archive store."""
+
+    def add_arguments(self, parser):
+        """Gather options for the migration."""
+        parser.add_argument('--directory', default=None,
+                            help='Directory of flat json files. Default:'
+                            ' cip_api_storage in config.txt.')
+        parser.add_argument('--codec', default=None, choices=['gzip', 'zstd'],
+                            help='Compression for the archive. Default:'
+                            ' archive_codec in config.txt, or zstd if'
+                            ' installed, else gzip.')
+        parser.add_argument('--keep', action='store_true',
+                            help='Leave the flat files in place once archived.')
+
+    def handle(self, *args, **options):
+        """Archive each flat json, then remove it unless --keep is given."""
+        config_dict = load_config.LoadConfig().load()
+        directory = options['directory'] or config_dict.get('cip_api_storage')
+        if not directory or not os.path.isdir(directory):
+            raise CommandError('{} is not a directory.'.format(directory))
+        try:
+            archive = ArchiveStore(
+                directory, codec=options['codec'] or config_dict.get('archive_codec') or None)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        migrated = deduplicated = failed = flat_size = 0
+        for filename in sorted(os.listdir(directory)):
+            match = FLAT_FILE.match(filename)
+            if not match:
+                continue
+            path = os.path.join(directory, filename)
+            try:
+                # hash the same way as Case does, without loading the whole
+                # json at once
+                sections, sha_hash = load_sections(path, keep=['proband'])
+                new = archive.put(
+                    match.group('ir_family_id'),
+                    match.group('archived_version'),
+                    sections.get('proband'),
+                    sha_hash,
+                    path)
+            except ValueError as e:
+                self.stderr.write('Skipping {}: {}'.format(filename, e))
+                failed += 1
+                continue
+            migrated += 1
+            deduplicated += not new
+            flat_size += os.path.getsize(path)
+            if not options['keep']:
+                os.remove(path)
+
+        stats = archive.stats()
+        self.stdout.write(
+            'Archived {migrated} jsons ({deduplicated} duplicates, {failed}'
+            ' unreadable) totalling {flat_size:.1f}MB. The archive holds'
+            ' {cases} cases in {objects} objects, {size:.1f}MB compressed.'.format(
+                migrated=migrated, deduplicated=deduplicated, failed=failed,
+                flat_size=flat_size / 1e6, cases=stats['cases'],
+                objects=stats['objects'], size=stats['size'] / 1e6))
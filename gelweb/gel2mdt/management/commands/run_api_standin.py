@@ -0,0 +1,86 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from gel2mdt.api_utils.replay import ReplayStore
+from gel2mdt.api_utils.standin_server import StandinServer
+from gel2mdt.config import load_config
+
+
+class Command(BaseCommand):
+    help = """Serve recorded CIP-API, PanelApp and genenames responses from a
+    local stand-in server. Point PollAPI at it with api_standin_url in
+    config.txt."""
+
+    def add_arguments(self, parser):
+        """Gather options for the stand-in server."""
+        parser.add_argument('--directory', default=None,
+                            help='Directory of recorded responses. Default:'
+                            ' api_replay_dir in config.txt.')
+        parser.add_argument('--host', default='127.0.0.1',
+                            help='Address to listen on. Default: 127.0.0.1')
+        parser.add_argument('--port', type=int, default=8800,
+                            help='Port to listen on. Default: 8800')
+        parser.add_argument('--latency', type=float, default=0.0,
+                            help='Seconds to wait before each response.')
+        parser.add_argument('--jitter', type=float, default=0.0,
+                            help='Vary the latency by up to this many seconds.')
+        parser.add_argument('--error-rate', type=float, default=0.0,
+                            help='Fraction of requests to answer with an'
+                            ' error, between 0 and 1.')
+        parser.add_argument('--error-status', type=int, default=503,
+                            help='HTTP status of injected errors. Default: 503')
+        parser.add_argument('--seed', type=int, default=None,
+                            help='Seed for latency jitter and error injection,'
+                            ' to make runs repeatable.')
+        parser.add_argument('--verbose', action='store_true',
+                            help='Log every request.')
+
+    def handle(self, *args, **options):
+        """Run the stand-in server until interrupted."""
+        directory = options['directory'] or load_config.LoadConfig().load().get('api_replay_dir')
+        if not directory:
+            raise CommandError('No recordings directory given; use --directory'
+                               ' or set api_replay_dir in config.txt.')
+        if not 0 <= options['error_rate'] <= 1:
+            raise CommandError('--error-rate must be between 0 and 1.')
+
+        server = StandinServer(ReplayStore(directory),
+                               host=options['host'],
+                               port=options['port'],
+                               latency=options['latency'],
+                               jitter=options['jitter'],
+                               error_rate=options['error_rate'],
+                               error_status=options['error_status'],
+                               seed=options['seed'],
+                               verbose=options['verbose'])
+        self.stdout.write('Serving recordings from {directory} at {url}'.format(
+            directory=directory, url=server.url))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write('Served {requests} requests ({errors} injected'
+                              ' errors)'.format(requests=server.requests_served,
+                                                errors=server.errors_injected))
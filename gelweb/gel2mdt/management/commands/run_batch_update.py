@@ -49,13 +49,48 @@ class Command(BaseCommand):
                             help='Whether to bin cases, and size of bins to'
                             'use. This increases update time but reduces RAM'
                             'usage for less powerful servers.')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Number of case JSONs to download from the'
+                            ' CIP-API at once. Default: cip_api_workers in'
+                            ' config.txt, or 1.')
+        parser.add_argument('--host-concurrency', type=int, default=None,
+                            help='Maximum number of requests in flight to the'
+                            ' CIP-API at once. Default:'
+                            ' cip_api_host_concurrency in config.txt.')
+        parser.add_argument('--force-full', action='store_true',
+                            help='Download every case, including those whose'
+                            ' entry in the CIP-API case list has not changed'
+                            ' since they were last added.')
+        parser.add_argument('--retry-quarantined', action='store_true',
+                            help='Only retry the cases which failed to be'
+                            ' fetched or written in earlier updates, as'
+                            ' listed in QuarantinedCase.')
+        parser.add_argument('--plan-only', action='store_true',
+                            help='Only print how many cases would be added,'
+                            ' updated, skipped and blocked, and how much'
+                            ' would be downloaded, without changing'
+                            ' anything.')
+        parser.add_argument('--plan-file', default=None,
+                            help='Write the plan to this file as JSON.'
+                            ' Implies --plan-only.')
 
     def handle(self, *args, **options):
         """Run the MultipleCaseAdder with the supplied options."""
+        plan_only = options['plan_only'] or options['plan_file'] is not None
+        if plan_only and options['test_data']:
+            raise CommandError('--plan-only plans updates from the CIP-API'
+                               ' case list, so cannot be used with'
+                               ' --test-data.')
         mca = MultipleCaseAdder(sample_type=options['sample_type'],
                                 sample=options['sample'],
                                 head=options['case_count'],
                                 test_data=options['test_data'],
                                 skip_demographics=options['skip_demographics'],
                                 pullt3=options['pullt3'],
-                                bins=options['bins'])
+                                bins=options['bins'],
+                                workers=options['workers'],
+                                host_concurrency=options['host_concurrency'],
+                                force_full=options['force_full'],
+                                retry_quarantined=options['retry_quarantined'],
+                                plan_only=plan_only,
+                                plan_file=options['plan_file'])
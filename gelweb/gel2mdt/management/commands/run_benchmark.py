@@ -0,0 +1,71 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from gel2mdt.benchmarks import BENCHMARKS, RATE_BENCHMARKS
+
+
+class Command(BaseCommand):
+    help = """Run a micro-benchmark, printing the CPU time and peak memory, or
+    for ingest_write, latest_reports and case_joins the rows handled per
+    second, of each approach or size it compares."""
+
+    def add_arguments(self, parser):
+        """Gather options for the benchmark."""
+        parser.add_argument('benchmark', choices=sorted(BENCHMARKS),
+                            help='Benchmark to run.')
+        parser.add_argument('--file', dest='file_path',
+                            help='Case json to benchmark with, e.g. one from'
+                            ' cip_api_storage. Needed for case_json.')
+        parser.add_argument('--repeat', type=int, default=None,
+                            help='Number of timed runs of each approach.'
+                            ' Default: 5, or 1 for vep_parse')
+        parser.add_argument('--rows', type=int, default=None,
+                            help='Number of rows for ingest_write to write'
+                            ' with each approach, or of reports for'
+                            ' latest_reports to search (default: 50000), or'
+                            ' variants in the largest case for case_joins'
+                            ' (default: 8000), or variants in the VEP vcf'
+                            ' for vep_parse (default: 500000).')
+
+    def handle(self, *args, **options):
+        """Run the benchmark and print a row per approach."""
+        if options['benchmark'] == 'case_json' and not options['file_path']:
+            raise CommandError('case_json needs a case json given with --file')
+        for option in ('rows', 'repeat'):
+            if options[option] is None:
+                del options[option]
+        results = BENCHMARKS[options['benchmark']](**options)
+        if options['benchmark'] in RATE_BENCHMARKS:
+            self.stdout.write('{:<24}{:>14}{:>16}'.format('approach', 'seconds', 'rows/sec'))
+            for name, seconds, rate in results:
+                self.stdout.write('{:<24}{:>14.2f}{:>16.0f}  ({:.1f}x {})'.format(
+                    name, seconds, rate, rate / results[0][2], results[0][0]))
+            return
+        baseline_cpu, baseline_peak = results[0][1:]
+        self.stdout.write('{:<24}{:>14}{:>16}'.format('approach', 'CPU ms', 'peak memory MB'))
+        for name, cpu, peak in results:
+            self.stdout.write('{:<24}{:>14.2f}{:>16.2f}  ({:.0%} CPU, {:.0%} memory of {})'.format(
+                name, cpu * 1000, peak / 1e6,
+                cpu / baseline_cpu if baseline_cpu else 1,
+                peak / baseline_peak if baseline_peak else 1,
+                results[0][0]))
@@ -0,0 +1,80 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from gel2mdt.config import load_config
+from gel2mdt.vep_utils.run_vep_batch import vep_command
+from gel2mdt.vep_utils.vep_worker import VEPWorkerServer
+
+
+class Command(BaseCommand):
+    help = """Run long-lived VEP processes, one per assembly, which annotate
+    single variants and small batches (such as variants added from the
+    proband page) sent to vep_worker_socket in config.txt, without waiting
+    for VEP to load its cache."""
+
+    def add_arguments(self, parser):
+        """Gather options for the VEP workers."""
+        parser.add_argument('--socket', default=None,
+                            help='UNIX socket to listen on. Default:'
+                            ' vep_worker_socket in config.txt.')
+        parser.add_argument('--assemblies', default='GRCh37,GRCh38',
+                            help='Comma separated assemblies to run VEP for.'
+                            ' Default: GRCh37,GRCh38')
+        parser.add_argument('--no-warm-up', action='store_true',
+                            help='Start VEP on the first request rather than'
+                            ' straight away.')
+
+    def handle(self, *args, **options):
+        """Run the VEP workers until interrupted."""
+        config_dict = load_config.LoadConfig().load()
+        socket_path = options['socket'] or config_dict.get('vep_worker_socket')
+        if not socket_path:
+            raise CommandError('No socket given; use --socket or set'
+                               ' vep_worker_socket in config.txt.')
+        if config_dict['remoteVEP'] == 'True':
+            raise CommandError('VEP workers run VEP locally, so need remoteVEP=False.')
+        assemblies = options['assemblies'].split(',')
+        for assembly in assemblies:
+            if assembly not in ('GRCh37', 'GRCh38'):
+                raise CommandError('{} is not GRCh37 or GRCh38.'.format(assembly))
+
+        # VEP reads VCF lines from its stdin, and handles one variant at a time
+        commands = dict(
+            (assembly, vep_command(None, 'STDOUT', assembly, config_dict, 1) +
+             ' --buffer_size 1 --no_stats')
+            for assembly in assemblies)
+        server = VEPWorkerServer(
+            socket_path, commands,
+            timeout=float(config_dict.get('vep_worker_timeout') or 60),
+            max_variants=int(config_dict.get('vep_worker_max_variants') or 50))
+        if not options['no_warm_up']:
+            server.warm_up()
+        self.stdout.write('VEP workers for {assemblies} listening on {socket}'.format(
+            assemblies=', '.join(assemblies), socket=socket_path))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write('Annotated {requests} requests'.format(
+                requests=server.requests_served))
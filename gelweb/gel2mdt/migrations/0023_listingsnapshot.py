@@ -0,0 +1,31 @@
+# Generated by Django 2.0.13 on 2026-10-18 09:12
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gel2mdt', '0022_auto_20190228_0803'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ListingSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('interpretation_request_id', models.CharField(max_length=200, unique=True)),
+                ('sample_type', models.CharField(max_length=25)),
+                ('version', models.CharField(blank=True, max_length=50, null=True)),
+                ('last_status', models.CharField(max_length=200)),
+                ('last_modified', models.CharField(blank=True, max_length=200, null=True)),
+                ('cip_version', models.CharField(blank=True, max_length=200, null=True)),
+                ('ingested_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'db_table': 'ListingSnapshot',
+                'managed': True,
+            },
+        ),
+    ]
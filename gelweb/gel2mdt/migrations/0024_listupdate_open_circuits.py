@@ -0,0 +1,18 @@
+# Generated by Django 2.0.13 on 2026-10-18 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gel2mdt', '0023_listingsnapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='listupdate',
+            name='open_circuits',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,110 @@
+# Generated by Django 2.0.13 on 2026-10-18 11:20
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+# natural keys which get a unique constraint in this migration, in the order
+# duplicates are merged: each model after those its key refers to, since
+# merging those can leave it with new duplicates
+NATURAL_KEYS = (
+    ('Variant', ('chromosome', 'position', 'reference', 'alternate', 'genome_assembly')),
+    ('TranscriptVariant', ('transcript', 'variant')),
+    ('ProbandVariant', ('variant', 'interpretation_report')),
+    ('PVFlag', ('proband_variant', 'flag_name')),
+    ('ProbandTranscriptVariant', ('transcript', 'proband_variant')),
+)
+
+
+def merge_duplicates(apps, schema_editor):
+    """
+    Merge rows sharing a natural key, which earlier concurrent updates could
+    create, so that the constraints can be added. The row with the lowest id
+    is kept, rows referring to the others are repointed to it and the others
+    are deleted. A one to one row, e.g. the RareDiseaseReport of a
+    ProbandVariant, is only moved if the row kept has none; otherwise it is
+    deleted along with its duplicate.
+    """
+    for model_name, fields in NATURAL_KEYS:
+        model = apps.get_model('gel2mdt', model_name)
+        relations = [
+            relation for relation in model._meta.related_objects
+            if not relation.many_to_many]
+        duplicates = list(model.objects.values(*fields).annotate(
+            keep=Min('id'), copies=Count('id')).filter(copies__gt=1).order_by())
+        merged = 0
+        for duplicate in duplicates:
+            keep = duplicate.pop('keep')
+            duplicate.pop('copies')
+            duplicate_ids = list(model.objects.filter(**duplicate).exclude(
+                id=keep).values_list('id', flat=True))
+            for relation in relations:
+                related_objects = relation.related_model.objects
+                field_name = relation.field.name
+                if relation.one_to_one:
+                    if related_objects.filter(**{field_name: keep}).exists():
+                        continue
+                    moved = related_objects.filter(
+                        **{field_name + '__in': duplicate_ids}).order_by('id').first()
+                    if moved is not None:
+                        related_objects.filter(id=moved.id).update(**{field_name: keep})
+                else:
+                    related_objects.filter(
+                        **{field_name + '__in': duplicate_ids}).update(**{field_name: keep})
+            model.objects.filter(id__in=duplicate_ids).delete()
+            merged += len(duplicate_ids)
+        if merged:
+            print("Merged {merged} duplicate {model} rows into {keys} rows".format(
+                merged=merged, model=model_name, keys=len(duplicates)))
+    if schema_editor.connection.vendor == 'postgresql':
+        # check the deferred foreign keys of the rows changed now, as
+        # PostgreSQL won't alter a table with checks still pending
+        schema_editor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+
+def add_variant_key(apps, schema_editor):
+    # reference and alternate are TEXT, so can't go in unique_together:
+    # PostgreSQL indexes their md5s to stay under its index row size, and
+    # MySQL can't index whole TEXT columns so is left without the constraint
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE UNIQUE INDEX variant_natural_key ON "Variant" '
+            '(chromosome, position, md5(reference), md5(alternate), genome_assembly_id)')
+    elif vendor == 'sqlite':
+        schema_editor.execute(
+            'CREATE UNIQUE INDEX variant_natural_key ON "Variant" '
+            '(chromosome, position, reference, alternate, genome_assembly_id)')
+
+
+def remove_variant_key(apps, schema_editor):
+    if schema_editor.connection.vendor in ('postgresql', 'sqlite'):
+        schema_editor.execute('DROP INDEX variant_natural_key')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gel2mdt', '0024_listupdate_open_circuits'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='transcriptvariant',
+            unique_together={('transcript', 'variant')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='probandvariant',
+            unique_together={('variant', 'interpretation_report')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='pvflag',
+            unique_together={('proband_variant', 'flag_name')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='probandtranscriptvariant',
+            unique_together={('transcript', 'proband_variant')},
+        ),
+        migrations.RunPython(add_variant_key, remove_variant_key),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.0.13 on 2026-10-18 12:40
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gel2mdt', '0025_natural_key_constraints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuarantinedCase',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('interpretation_request_id', models.CharField(max_length=200, unique=True)),
+                ('sample_type', models.CharField(max_length=25)),
+                ('stage', models.CharField(choices=[('fetch', 'Fetch'), ('write', 'Write')], max_length=10)),
+                ('error', models.TextField()),
+                ('attempts', models.IntegerField(default=1)),
+                ('first_failed', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_failed', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'db_table': 'QuarantinedCase',
+                'managed': True,
+            },
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 2.0.13 on 2026-10-18 15:40
+
+from django.db import migrations, models
+from django.db.models import Exists, OuterRef, Q
+
+
+def backfill_is_latest(apps, schema_editor):
+    """
+    Every report starts flagged as latest; unflag those with a newer version
+    in their family, i.e. a higher archived_version, or the same one and a
+    higher id.
+    """
+    GELInterpretationReport = apps.get_model('gel2mdt', 'GELInterpretationReport')
+    newer_reports = GELInterpretationReport.objects.filter(
+        Q(archived_version__gt=OuterRef('archived_version')) |
+        Q(archived_version=OuterRef('archived_version'), id__gt=OuterRef('id')),
+        ir_family_id=OuterRef('ir_family_id'))
+    old_ids = list(GELInterpretationReport.objects.annotate(
+        has_newer=Exists(newer_reports)
+    ).filter(has_newer=True).values_list('id', flat=True))
+    batch_size = 1000
+    for start in range(0, len(old_ids), batch_size):
+        GELInterpretationReport.objects.filter(
+            id__in=old_ids[start:start + batch_size]).update(is_latest=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gel2mdt', '0026_quarantinedcase'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gelinterpretationreport',
+            name='is_latest',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.RunPython(backfill_is_latest, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='gelinterpretationreport',
+            index=models.Index(fields=['is_latest', 'sample_type'], name='gelir_latest_idx'),
+        ),
+    ]
@@ -19,11 +19,10 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
 from django.conf import settings
 from django.contrib.auth.models import User, Group
-import pandas as pd
 from .api_utils.poll_api import PollAPI
 from .model_utils.choices import ChoiceEnum
 from .config import load_config
@@ -43,6 +42,8 @@ class ListUpdate(models.Model):
     reports_updated = models.ManyToManyField('GELInterpretationReport', related_name='reports_updated')
     sample_type = models.CharField(max_length=25, blank=True, null=True)
     error = models.TextField(null=True)
+    # hosts whose circuit breaker opened during the update
+    open_circuits = models.TextField(null=True, blank=True)
 
     class Meta:
         managed = True
@@ -50,6 +51,104 @@ class ListUpdate(models.Model):
         app_label= 'gel2mdt'
 
 
+class ListingSnapshot(models.Model):
+    """
+    The entry for a case in the CIP-API interpretation request list as it was
+    when the case was last successfully ingested. If the entry is unchanged in
+    a later listing, the case's json doesn't need downloading again.
+    """
+    # listing fields compared to decide whether a case has changed
+    listing_fields = ('version', 'last_status', 'last_modified', 'cip_version')
+    # listing fields which change whenever the case data changes; at least one
+    # must be present before a case is trusted to be unchanged
+    change_fields = ('last_modified', 'cip_version')
+
+    interpretation_request_id = models.CharField(max_length=200, unique=True)
+    sample_type = models.CharField(max_length=25)
+    version = models.CharField(max_length=50, null=True, blank=True)
+    last_status = models.CharField(max_length=200)
+    last_modified = models.CharField(max_length=200, null=True, blank=True)
+    cip_version = models.CharField(max_length=200, null=True, blank=True)
+    ingested_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return self.interpretation_request_id
+
+    @classmethod
+    def values_from_listing(cls, listing_entry):
+        """
+        Returns the listing fields of an InterpretationList entry as strings
+        (or None), in the form they are stored in the snapshot.
+        """
+        values = {}
+        for field in cls.listing_fields:
+            value = listing_entry.get(field)
+            values[field] = None if value is None else str(value)
+        return values
+
+    def matches(self, listing_entry):
+        """
+        True if listing_entry shows no change since this snapshot was taken.
+        """
+        values = self.values_from_listing(listing_entry)
+        if not any(values[field] for field in self.change_fields):
+            # status alone can't tell us the case data hasn't changed
+            return False
+        return all(
+            getattr(self, field) == value for field, value in values.items())
+
+    class Meta:
+        managed = True
+        db_table = 'ListingSnapshot'
+        app_label= 'gel2mdt'
+
+
+class QuarantinedCase(models.Model):
+    """
+    A case which failed to be fetched or written during a batch update, and
+    was left out so that the rest of its bin could be committed. Cases here
+    have no ListingSnapshot so every update tries them again, and they can
+    be retried on their own with run_batch_update --retry-quarantined. The
+    entry is removed once the case is added successfully.
+    """
+    stages = (
+        ('fetch', 'Fetch'),
+        ('write', 'Write'),
+    )
+
+    interpretation_request_id = models.CharField(max_length=200, unique=True)
+    sample_type = models.CharField(max_length=25)
+    stage = models.CharField(max_length=10, choices=stages)
+    error = models.TextField()
+    attempts = models.IntegerField(default=1)
+    first_failed = models.DateTimeField(default=timezone.now)
+    last_failed = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return self.interpretation_request_id
+
+    @classmethod
+    def record(cls, sample_type, failures):
+        """
+        Records failures, a list of (interpretation request id, stage,
+        traceback), counting another attempt for cases already quarantined.
+        """
+        now = timezone.now()
+        for ir_id, stage, error in failures:
+            updated = cls.objects.filter(interpretation_request_id=ir_id).update(
+                stage=stage, error=error, attempts=models.F('attempts') + 1,
+                last_failed=now)
+            if not updated:
+                cls.objects.create(
+                    interpretation_request_id=ir_id, sample_type=sample_type,
+                    stage=stage, error=error, first_failed=now, last_failed=now)
+
+    class Meta:
+        managed = True
+        db_table = 'QuarantinedCase'
+        app_label= 'gel2mdt'
+
+
 class ToolOrAssemblyVersion(models.Model):
     """
     Represents a tool used or genome build and version used in several use cases
@@ -259,20 +358,7 @@ class InterpretationReportFamilyPanel(models.Model):
 
 class GELInterpretationReportQuerySet(models.QuerySet):
     def latest_cases_by_sample_type(self, sample_type):
-        qs = self.filter(sample_type=sample_type)
-        if qs:
-            # cases present
-            qs_df = pd.DataFrame(list(qs.values())).sort_values(
-                by=["ir_family_id", "archived_version"]
-            )
-            rm_dup_old = qs_df.drop_duplicates(
-                subset=["ir_family_id"],
-                keep="last"
-            )
-            ids_of_latest_cases = rm_dup_old["id"].tolist()
-            return self.filter(id__in=ids_of_latest_cases)
-        else:
-            return qs
+        return self.filter(sample_type=sample_type, is_latest=True)
 
     def latest_cases_by_sample_type_and_user(self, sample_type, username):
         admin = False
@@ -283,36 +369,119 @@ class GELInterpretationReportQuerySet(models.QuerySet):
                 admin = True
             for gmc in group.grouppermissions.gmc.all():
                 allowed_gmcs.append(gmc)
-        qs = self.filter(sample_type=sample_type).prefetch_related('ir_family__participant_family__proband')
-        if qs:
-            # cases present
-            qs_df = pd.DataFrame(list(qs.values())).sort_values(
-                by=["ir_family_id", "archived_version"]
-            )
-            rm_dup_old = qs_df.drop_duplicates(
-                subset=["ir_family_id"],
-                keep="last"
-            )
-            ids_of_latest_cases = rm_dup_old["id"].tolist()
-            if admin:
-                return self.filter(id__in=ids_of_latest_cases)
-            else:
-                return self.filter(id__in=ids_of_latest_cases).filter(
-                    ir_family__participant_family__proband__gmc__in=allowed_gmcs)
-        else:
+        qs = self.latest_cases_by_sample_type(sample_type).prefetch_related(
+            'ir_family__participant_family__proband')
+        if admin:
             return qs
+        else:
+            return qs.filter(
+                ir_family__participant_family__proband__gmc__in=allowed_gmcs)
 
     def latest_cases_by_user(self, username):
-        qs = self.all()
-        qs_df = pd.DataFrame(list(qs.values())).sort_values(
-            by=["ir_family_id", "archived_version"]
-        )
-        rm_dup_old = qs_df.drop_duplicates(
-            subset=["ir_family_id"],
-            keep="last"
-        )
-        ids_of_latest_cases = rm_dup_old["id"].tolist()
-        return self.filter(id__in=ids_of_latest_cases, assigned_user__username=username)
+        return self.filter(is_latest=True, assigned_user__username=username)
+
+    def bulk_rollover(self, reports, overwrite=False, batch_size=500):
+        """
+        Saves new GELInterpretationReports as save(overwrite) does, but for
+        many reports at once, taking a fixed number of queries per batch of
+        reports instead of several per report and per child row.
+
+        The latest existing report of every family is the one flagged
+        is_latest, or else the one with the highest (archived_version, id),
+        as in save() and the is_latest backfill; they are found with one
+        query per batch of families.
+        For families without one, the report is version 1. Otherwise, with
+        overwrite the report's fields are copied onto the latest report;
+        without it the report becomes the next version, keeping the latest
+        report's carried_over_fields, and takes over is_latest and the
+        MDTReports, ProbandVariants and CaseComments of the latest report
+        with one UPDATE per model. New reports are bulk created. It is all
+        done in one transaction.
+
+        Returns:
+            list: the saved reports, with the latest reports in place of
+            those copied onto them when overwrite is set.
+        """
+        model = self.model
+        now = timezone.now()
+        attnames = dict(
+            (name, model._meta.get_field(name).attname)
+            for name in model.overwritten_fields)
+
+        with transaction.atomic():
+            latest_reports = {}
+            family_ids = list(set(report.ir_family_id for report in reports))
+            for start in range(0, len(family_ids), batch_size):
+                for report in model.objects.filter(
+                        ir_family_id__in=family_ids[start:start + batch_size],
+                        is_latest=True
+                ).order_by('archived_version', 'id'):
+                    latest_reports[report.ir_family_id] = report
+            # families with reports but none flagged fall back to the newest
+            unflagged_ids = [
+                family_id for family_id in family_ids
+                if family_id not in latest_reports]
+            for start in range(0, len(unflagged_ids), batch_size):
+                for report in model.objects.filter(
+                        ir_family_id__in=unflagged_ids[start:start + batch_size]
+                ).order_by('archived_version', 'id'):
+                    latest_reports[report.ir_family_id] = report
+
+            saved = []
+            new_reports = []
+            rollovers = []
+            for report in reports:
+                latest_report = latest_reports.get(report.ir_family_id)
+                if latest_report is None:
+                    report.archived_version = 1
+                    report.is_latest = True
+                    new_reports.append(report)
+                elif overwrite:
+                    values = dict(
+                        (attnames[name], getattr(report, attnames[name]))
+                        for name in model.overwritten_fields)
+                    values['polled_at_datetime'] = now
+                    for attname, value in values.items():
+                        setattr(latest_report, attname, value)
+                    model.objects.filter(pk=latest_report.pk).update(**values)
+                    saved.append(latest_report)
+                else:
+                    for name in model.carried_over_fields:
+                        setattr(report, attnames[name], getattr(latest_report, attnames[name]))
+                    report.polled_at_datetime = now
+                    report.archived_version = latest_report.archived_version + 1
+                    report.is_latest = True
+                    latest_report.is_latest = False
+                    new_reports.append(report)
+                    rollovers.append((latest_report, report))
+
+            model.objects.bulk_create(new_reports, batch_size=batch_size)
+            if any(report.pk is None for report in new_reports):
+                # only PostgreSQL sets the ids in bulk_create
+                new_ids = {}
+                new_family_ids = [report.ir_family_id for report in new_reports]
+                for start in range(0, len(new_family_ids), batch_size):
+                    for report_id, family_id, version in model.objects.filter(
+                            ir_family_id__in=new_family_ids[start:start + batch_size]
+                    ).values_list('id', 'ir_family_id', 'archived_version'):
+                        new_ids[(family_id, version)] = report_id
+                for report in new_reports:
+                    report.pk = new_ids[(report.ir_family_id, report.archived_version)]
+            saved.extend(new_reports)
+
+            for start in range(0, len(rollovers), batch_size):
+                batch = rollovers[start:start + batch_size]
+                new_report_id = models.Case(
+                    *[models.When(interpretation_report_id=latest_report.pk, then=models.Value(report.pk))
+                      for latest_report, report in batch],
+                    output_field=models.IntegerField())
+                latest_ids = [latest_report.pk for latest_report, report in batch]
+                model.objects.filter(id__in=latest_ids).update(is_latest=False)
+                for child_model in (MDTReport, ProbandVariant, CaseComment):
+                    child_model.objects.filter(
+                        interpretation_report_id__in=latest_ids
+                    ).update(interpretation_report_id=new_report_id)
+        return saved
 
 
 class GELInterpretationReport(models.Model):
@@ -341,6 +510,9 @@ class GELInterpretationReport(models.Model):
     # sha hash to allow quick determination of differences each update
     sha_hash = models.CharField(max_length=200)
     polled_at_datetime = models.DateTimeField(default=timezone.now)
+    # set on the newest version of each family by save() and bulk_rollover,
+    # so the latest reports can be found without comparing versions
+    is_latest = models.BooleanField(default=True)
 
     case_sent = models.BooleanField(default=False)
 
@@ -378,72 +550,64 @@ class GELInterpretationReport(models.Model):
         related_name='second_check_user'
     )
 
+    # fields copied onto the latest report by save(overwrite=True)
+    overwritten_fields = (
+        'status', 'updated', 'sample_type', 'sample_id', 'max_tier', 'assembly',
+        'sha_hash', 'assigned_user', 'first_check', 'second_check', 'mdt_status',
+        'case_sent', 'case_status', 'pilot_case', 'tumour_content', 'user',
+        'no_primary_findings', 'archived_version', 'has_germline_variant',
+        'case_code')
+    # fields set by users, which a new version keeps from the latest report
+    carried_over_fields = (
+        'assigned_user', 'first_check', 'second_check', 'mdt_status',
+        'case_sent', 'case_status', 'pilot_case', 'user', 'no_primary_findings',
+        'case_code')
+
     def save(self, overwrite=False, *args, **kwargs):
         """
         Overwrite the model's save method to auto-increment versions for
         duplicate ir_familys. Pass in a InterpretationReportFamily entry.
+        The latest report is the one flagged is_latest, or else the one with
+        the highest (archived_version, id).
+        The new version is flagged is_latest in place of the one before it,
+        in the same transaction. To save many reports at once use
+        GELInterpretationReport.objects.bulk_rollover.
         """
-        archived_reports = GELInterpretationReport.objects.filter(
-            ir_family=self.ir_family)
-        if archived_reports:
-            latest_report = archived_reports.latest('polled_at_datetime')
-            if overwrite:
-                latest_report.status = self.status
-                latest_report.updated = self.updated
-                latest_report.sample_type = self.sample_type
-                latest_report.sample_id = self.sample_id
-                latest_report.max_tier = self.max_tier
-                latest_report.assembly = self.assembly
-                latest_report.sha_hash = self.sha_hash
-                latest_report.assigned_user = self.assigned_user
-                latest_report.first_check = self.first_check
-                latest_report.second_check = self.second_check
-                latest_report.mdt_status = self.mdt_status
-                latest_report.case_sent = self.case_sent
-                latest_report.case_status = self.case_status
-                latest_report.pilot_case = self.pilot_case
-                latest_report.tumour_content = self.tumour_content
-                latest_report.polled_at_datetime = timezone.now()
-                latest_report.user = self.user
-                latest_report.no_primary_findings = self.no_primary_findings
-                latest_report.archived_version = self.archived_version
-                latest_report.has_germline_variant = self.has_germline_variant
-                latest_report.case_code = self.case_code
-                super(GELInterpretationReport, latest_report).save(*args, **kwargs)
+        with transaction.atomic():
+            archived_reports = GELInterpretationReport.objects.filter(
+                ir_family=self.ir_family)
+            if archived_reports:
+                try:
+                    latest_report = archived_reports.filter(is_latest=True).get()
+                except (GELInterpretationReport.DoesNotExist,
+                        GELInterpretationReport.MultipleObjectsReturned):
+                    latest_report = archived_reports.order_by(
+                        'archived_version', 'id').last()
+                if overwrite:
+                    for field in self.overwritten_fields:
+                        setattr(latest_report, field, getattr(self, field))
+                    latest_report.polled_at_datetime = timezone.now()
+                    super(GELInterpretationReport, latest_report).save(*args, **kwargs)
+                else:
+                    for field in self.carried_over_fields:
+                        setattr(self, field, getattr(latest_report, field))
+                    self.polled_at_datetime = timezone.now()
+                    # update the latest saved version.
+                    self.archived_version = latest_report.archived_version + 1
+                    self.is_latest = True
+                    super(GELInterpretationReport, self).save(*args, **kwargs)
+                    # only the newest version of a family is flagged as latest
+                    archived_reports.filter(is_latest=True).exclude(
+                        pk=self.pk).update(is_latest=False)
+                    for child_model in (MDTReport, ProbandVariant, CaseComment):
+                        for child in child_model.objects.filter(interpretation_report=latest_report):
+                            child.interpretation_report = self
+                            child.save()
+
             else:
-                self.assigned_user = latest_report.assigned_user
-                self.first_check = latest_report.first_check
-                self.second_check = latest_report.second_check
-                self.mdt_status = latest_report.mdt_status
-                self.case_sent = latest_report.case_sent
-                self.case_status = latest_report.case_status
-                self.pilot_case = latest_report.pilot_case
-                self.polled_at_datetime = timezone.now()
-                self.user = latest_report.user
-                self.no_primary_findings = latest_report.no_primary_findings
-                self.case_code = latest_report.case_code
-                # update the latest saved version.
-                self.archived_version = latest_report.archived_version + 1
+                self.archived_version = 1
+                self.is_latest = True
                 super(GELInterpretationReport, self).save(*args, **kwargs)
-                mdt_report = MDTReport.objects.filter(interpretation_report=latest_report)
-                if mdt_report:
-                    for report in mdt_report:
-                        report.interpretation_report = self
-                        report.save()
-                proband_variants = ProbandVariant.objects.filter(interpretation_report=latest_report)
-                if proband_variants:
-                    for pv in proband_variants:
-                        pv.interpretation_report = self
-                        pv.save()
-                case_comments = CaseComment.objects.filter(interpretation_report=latest_report)
-                if case_comments:
-                    for comment in case_comments:
-                        comment.interpretation_report = self
-                        comment.save()
-
-        else:
-            self.archived_version = 1
-            super(GELInterpretationReport, self).save(*args, **kwargs)
 
     def __str__(self):
         return str(self.ir_family.ir_family_id + " v" + str(self.archived_version))
@@ -452,6 +616,9 @@ class GELInterpretationReport(models.Model):
         managed = True
         db_table = 'GELInterpretationReport'
         app_label= 'gel2mdt'
+        indexes = [
+            models.Index(fields=['is_latest', 'sample_type'], name='gelir_latest_idx'),
+        ]
 
 
 class ClinicalScientist(models.Model):
@@ -616,6 +783,7 @@ class TranscriptVariant(models.Model):
     class Meta:
         managed = True
         db_table = 'TranscriptVariant'
+        unique_together = (('transcript', 'variant'),)
         app_label= 'gel2mdt'
 
 
@@ -752,6 +920,7 @@ class ProbandVariant(models.Model):
     class Meta:
         managed = True
         db_table = 'ProbandVariant'
+        unique_together = (('variant', 'interpretation_report'),)
         app_label= 'gel2mdt'
 
 
@@ -765,6 +934,7 @@ class PVFlag(models.Model):
     class Meta:
         managed = True
         db_table = 'PVFlag'
+        unique_together = (('proband_variant', 'flag_name'),)
         app_label = 'gel2mdt'
 
 
@@ -834,6 +1004,7 @@ class ProbandTranscriptVariant(models.Model):
     class Meta:
         managed = True
         db_table = 'ProbandTranscriptVariant'
+        unique_together = (('transcript', 'proband_variant'),)
         app_label= 'gel2mdt'
 
 # classes for choice
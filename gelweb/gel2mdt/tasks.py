@@ -26,6 +26,7 @@ from .api_utils.poll_api import PollAPI
 from .vep_utils import run_vep_batch
 from .models import *
 from .database_utils.multiple_case_adder import GeneManager, MultipleCaseAdder
+from .database_utils.archive_store import ArchiveStore
 from celery import task
 import json
 from json import JSONDecodeError
@@ -337,14 +338,15 @@ def listupdate_email():
     :return:
     '''
     send = False
-    bioinfo_content = 'Sample Type\tUpdate Time\tNo. Cases Added\tNo. Cases Updated\tError\n'
+    bioinfo_content = 'Sample Type\tUpdate Time\tNo. Cases Added\tNo. Cases Updated\tError\tOpen Circuits\n'
     for i, sample_type in enumerate(['raredisease', 'cancer']):
         listupdates = ListUpdate.objects.filter(update_time__gte=date.today()).filter(sample_type=sample_type)
         if listupdates:
             send = True
         for update in listupdates:
             bioinfo_content += f'{update.sample_type}\t{update.update_time}' \
-                               f'\t{update.cases_added}\t{update.cases_updated}\t{update.error}\n'
+                               f'\t{update.cases_added}\t{update.cases_updated}\t{update.error}' \
+                               f'\t{update.open_circuits}\n'
     if send:
         subject, from_email, to = 'GeL2MDT ListUpdate', 'gel2mdt.technicalsupport@nhs.net', \
                                   'bioinformatics@gosh.nhs.uk'
@@ -656,6 +658,8 @@ class UpdaterFromStorage:
         )
         config_dict = load_config.LoadConfig().load()
         self.cip_api_storage = config_dict['cip_api_storage']
+        self.archive = ArchiveStore(
+            self.cip_api_storage, codec=config_dict.get('archive_codec') or None)
         for report in self.reports:
             self.json = self.load_json_data(report)
             if self.json:
@@ -674,12 +678,7 @@ class UpdaterFromStorage:
         '''
         :return: Dict with key as CIPid and value as value_of_interest
         '''
-        json_path = os.path.join(self.cip_api_storage, '{}.json'.format(report.ir_family.ir_family_id +  "-" +  str(report.archived_version)))
-        if os.path.isfile(json_path):
-            with open(json_path, 'r') as f:
-                return json.load(f)
-        else:
-            return None
+        return self.archive.load(report.ir_family.ir_family_id, report.archived_version)
 
     def get_proband_json(self):
         """
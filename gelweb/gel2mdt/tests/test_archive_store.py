@@ -0,0 +1,59 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import json
+import os
+import shutil
+import tempfile
+from django.test import TestCase
+from ..database_utils.archive_store import ArchiveStore
+
+
+class ArchiveStoreTestCase(TestCase):
+    case_json = {"interpretation_request_id": 1234, "version": 1, "proband": "111"}
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.archive = ArchiveStore(self.directory, codec='gzip')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_identical_jsons_stored_once(self):
+        self.assertTrue(self.archive.put("1234-1", 1, "111", "ab12cd", self.case_json))
+        # an unchanged json re-archived under a new version, from a file
+        json_path = os.path.join(self.directory, "incoming.json")
+        with open(json_path, "w") as json_file:
+            json.dump(self.case_json, json_file)
+        self.assertFalse(self.archive.put("1234-1", 2, "111", "ab12cd", json_path))
+
+        self.assertEqual(self.archive.load("1234-1", 1), self.case_json)
+        self.assertEqual(self.archive.load("1234-1", 2), self.case_json)
+        self.assertEqual(self.archive.lookup("1234-1", 2)["path"],
+                         os.path.join("objects", "ab", "12", "ab12cd.json.gz"))
+        stats = self.archive.stats()
+        self.assertEqual((stats['cases'], stats['objects']), (2, 1))
+
+    def test_flat_files_still_read(self):
+        with open(os.path.join(self.directory, "1234-1-3.json"), "w") as json_file:
+            json.dump(self.case_json, json_file)
+        self.assertEqual(self.archive.load("1234-1", 3), self.case_json)
+        self.assertIsNone(self.archive.load("1234-1", 4))
@@ -21,17 +21,30 @@ SOFTWARE.
 """
 import unittest
 from django.test import TestCase
+from django.db import connection
 
 from ..database_utils.multiple_case_adder import MultipleCaseAdder
-from ..database_utils.case_handler import Case, CaseModel, ManyCaseModel
+from ..database_utils.case_handler import Case, CaseModel, ManyCaseModel, CaseAttributeManager
+from ..vep_utils.run_vep_batch import CaseVariant, CaseTranscript
+from ..database_utils.natural_keys import NaturalKeyIndex
+from ..database_utils.copy_loader import CopyLoader, RowStream, copy_value
+from ..database_utils.update_planner import UpdatePlanner
+from ..api_utils.http_client import HTTPClient, set_http_client
+from ..api_utils.replay import ReplayStore, make_response
 from ..models import *
+from ..factories import *
 
 import re
 import os
 import json
+import shutil
+import tempfile
+import threading
+import time
 import hashlib
 import pprint
-from datetime import datetime
+from types import SimpleNamespace
+from datetime import datetime, timedelta
 from django.utils import timezone
 
 
@@ -291,12 +304,12 @@ class TestCaseModel(TestCase):
         """
         Return created=False when a Clinician is not known to the db.
         """
-        clinician_objects = Clinician.objects.all()
         clinician = CaseModel(Clinician, {
             "name": "test",
             "email": "test",
             "hospital": "test"
-        }, clinician_objects)
+        }, None)
+        clinician.check_found_in_db()
         print(clinician.entry)
         assert clinician.entry is False  # checking for a literal False
 
@@ -312,12 +325,532 @@ class TestCaseModel(TestCase):
         archived_clinician = Clinician.objects.create(
             **clinician_attributes
         )
-        clinician_objects = Clinician.objects.all()
-
-        test_clinician = CaseModel(Clinician, clinician_attributes, clinician_objects)
+        test_clinician = CaseModel(Clinician, clinician_attributes, None)
+        test_clinician.check_found_in_db()
         assert test_clinician.entry.id == archived_clinician.id
 
 
+class TestNaturalKeyIndex(TestCase):
+    """
+    Test that NaturalKeyIndex matches CaseModels to existing entries with a
+    number of queries which doesn't grow with the number of CaseModels, and
+    holds only the entries for the keys in the bin.
+    """
+    def setUp(self):
+        self.assembly = ToolOrAssemblyVersion.objects.create(
+            tool_name="genome_build", version_number="GRCh38")
+        Transcript.objects.bulk_create([
+            Transcript(name="ENST{}".format(i), strand="+", genome_assembly=self.assembly)
+            for i in range(0, 400, 2)])
+        self.case_models = [
+            CaseModel(Transcript, {
+                "name": "ENST{}".format(i % 400),
+                "strand": "+",
+                "genome_assembly": self.assembly
+            }, None) for i in range(800)]
+
+    def test_resolve_in_one_query(self):
+        with self.assertNumQueries(1):
+            NaturalKeyIndex(Transcript).resolve(self.case_models)
+        found = [case_model for case_model in self.case_models if case_model.entry]
+        self.assertEqual(len(found), 400)
+        for case_model in found:
+            self.assertEqual(case_model.entry.name, case_model.model_attributes["name"])
+        self.assertTrue(all(
+            case_model.entry is False for case_model in self.case_models
+            if case_model not in found))
+
+    def test_index_scoped_to_bin(self):
+        model_index = NaturalKeyIndex(Transcript)
+        model_index.resolve(self.case_models[:10])
+        self.assertEqual(len(model_index.index), 5)
+
+    def test_created_entries_added_without_query(self):
+        model_index = NaturalKeyIndex(Transcript)
+        model_index.resolve(self.case_models)
+        created = Transcript.objects.create(name="ENST1", strand="+", genome_assembly=self.assembly)
+        model_index.add([created])
+        with self.assertNumQueries(0):
+            model_index.resolve(self.case_models)
+        self.assertEqual(
+            len([case_model for case_model in self.case_models if case_model.entry]), 402)
+
+        # rows created without an id are looked up again
+        model_index.add([Transcript(name="ENST3", strand="+", genome_assembly=self.assembly)])
+        Transcript.objects.create(name="ENST3", strand="+", genome_assembly=self.assembly)
+        with self.assertNumQueries(1):
+            model_index.resolve(self.case_models)
+        self.assertEqual(
+            len([case_model for case_model in self.case_models if case_model.entry]), 404)
+
+    def row_versions(self):
+        # where each row version is stored, which moves when it is rewritten;
+        # PostgreSQL only
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT id, ctid FROM "{}"'.format(Transcript._meta.db_table))
+            return dict(cursor.fetchall())
+
+    def test_upsert_keeps_existing_rows(self):
+        model_index = NaturalKeyIndex(Transcript)
+        self.assertTrue(model_index.can_upsert())
+        if connection.vendor == "postgresql":
+            existing_versions = self.row_versions()
+        # half of these were written since the bin was resolved
+        rows = model_index.upsert([
+            Transcript(name="ENST{}".format(i), strand="+", genome_assembly=self.assembly)
+            for i in range(400)][::-1])
+        if connection.vendor == "postgresql":
+            # the existing rows are left alone rather than rewritten
+            versions = self.row_versions()
+            self.assertEqual(
+                dict((pk, versions[pk]) for pk in existing_versions), existing_versions)
+        self.assertEqual(len(rows), 400)
+        self.assertTrue(all(row.pk for row in rows))
+        self.assertEqual(Transcript.objects.count(), 400)
+        with self.assertNumQueries(0):
+            model_index.resolve(self.case_models)
+        self.assertTrue(all(case_model.entry for case_model in self.case_models))
+
+
+
+class TestCopyLoader(TestCase):
+    """
+    Test the COPY text encoding of rows, and that other databases are left
+    to the ORM write paths.
+    """
+    def test_copy_value(self):
+        self.assertEqual(copy_value(None), "\\N")
+        self.assertEqual(copy_value(True), "t")
+        self.assertEqual(copy_value(12), "12")
+        self.assertEqual(copy_value("a\tb\\c\nd"), "a\\tb\\\\c\\nd")
+
+    def test_row_stream(self):
+        lines = ["{}\tvalue\n".format(i) for i in range(1000)]
+        stream = RowStream(iter(lines))
+        chunks = []
+        chunk = stream.read(100)
+        while chunk:
+            self.assertLessEqual(len(chunk), 100)
+            chunks.append(chunk)
+            chunk = stream.read(100)
+        self.assertEqual(b"".join(chunks).decode("utf-8"), "".join(lines))
+
+    def test_supports(self):
+        model_index = NaturalKeyIndex(TranscriptVariant)
+        self.assertEqual(
+            CopyLoader.supports(model_index), connection.vendor == "postgresql")
+        self.assertFalse(CopyLoader.supports(NaturalKeyIndex(Clinician)))
+
+
+class TestWriteIsolated(TestCase):
+    """
+    Test that a case which fails to be written is rolled back and quarantined
+    without losing the rest of its bin.
+    """
+    def setUp(self):
+        self.case_adder = MultipleCaseAdder.__new__(MultipleCaseAdder)
+        self.case_adder.quarantined_cases = []
+        self.cases = [SimpleNamespace(request_id="{}-1".format(i)) for i in range(3)]
+
+    def write(self, cases):
+        for case in cases:
+            Clinician.objects.create(
+                name=case.request_id, hospital="GOSH", email="clinician@gosh.nhs.uk")
+        for case in cases:
+            if case.request_id == "1-1":
+                raise ValueError("malformed case")
+
+    def test_bad_case_quarantined(self):
+        written = self.case_adder.write_isolated(self.cases, self.write)
+        self.assertEqual([case.request_id for case in written], ["0-1", "2-1"])
+        self.assertEqual(
+            sorted(Clinician.objects.values_list("name", flat=True)), ["0-1", "2-1"])
+        (ir_id, stage, error), = self.case_adder.quarantined_cases
+        self.assertEqual((ir_id, stage), ("1-1", "write"))
+        self.assertIn("malformed case", error)
+
+    def test_quarantine_recorded(self):
+        QuarantinedCase.record("raredisease", [("1-1", "fetch", "first traceback")])
+        QuarantinedCase.record("raredisease", [("1-1", "write", "second traceback")])
+        quarantined_case = QuarantinedCase.objects.get(interpretation_request_id="1-1")
+        self.assertEqual(quarantined_case.attempts, 2)
+        self.assertEqual(quarantined_case.stage, "write")
+        self.assertEqual(quarantined_case.error, "second traceback")
+
+
+class TestSkipUnchangedCases(TestCase):
+    """
+    Test that cases are only skipped when their listing entry matches the
+    ListingSnapshot taken when they were last ingested.
+    """
+    def setUp(self):
+        self.case_adder = MultipleCaseAdder.__new__(MultipleCaseAdder)
+        self.case_adder.sample_type = "raredisease"
+        self.ir_ids = [
+            InterpretationReportFamilyFactory(ir_family_id="{}-1".format(i)).ir_family_id
+            for i in range(1000, 1003)]
+        self.listed_cases = [self.listing_entry(ir_id) for ir_id in self.ir_ids]
+        self.case_adder.set_listing_entries(self.listed_cases)
+        self.case_adder.record_listing_snapshots(
+            [SimpleNamespace(request_id=ir_id) for ir_id in self.ir_ids])
+
+    def listing_entry(self, ir_id, **changes):
+        entry = {
+            "interpretation_request_id": ir_id,
+            "sample_type": "raredisease",
+            "last_status": "sent_to_gmcs",
+            "version": 1,
+            "last_modified": "2018-06-01T12:00:00Z",
+            "cip_version": 2}
+        entry.update(changes)
+        return entry
+
+    def test_unchanged_skipped(self):
+        self.assertEqual(ListingSnapshot.objects.count(), 3)
+        self.assertEqual(self.case_adder.skip_unchanged_cases(self.listed_cases), [])
+
+    def test_changed_fetched(self):
+        for field, value in (
+                ("last_status", "report_sent"),
+                ("version", 2),
+                ("last_modified", "2018-06-02T12:00:00Z"),
+                ("cip_version", 3)):
+            listed_cases = [
+                self.listing_entry(self.ir_ids[0], **{field: value})
+            ] + self.listed_cases[1:]
+            self.assertEqual(
+                self.case_adder.skip_unchanged_cases(listed_cases), listed_cases[:1], field)
+
+    def test_missing_change_fields_not_trusted(self):
+        entry = self.listing_entry(
+            "2000-1", last_modified=None, cip_version=None)
+        InterpretationReportFamilyFactory(ir_family_id="2000-1")
+        self.case_adder.set_listing_entries([entry])
+        self.case_adder.record_listing_snapshots([SimpleNamespace(request_id="2000-1")])
+        snapshot = ListingSnapshot.objects.get(interpretation_request_id="2000-1")
+        self.assertFalse(snapshot.matches(entry))
+        self.assertFalse(snapshot.matches({
+            "interpretation_request_id": "2000-1", "last_status": "sent_to_gmcs", "version": 1}))
+        self.assertEqual(self.case_adder.skip_unchanged_cases([entry]), [entry])
+
+    def test_case_not_in_database_fetched(self):
+        InterpretationReportFamily.objects.filter(ir_family_id=self.ir_ids[0]).delete()
+        self.assertTrue(ListingSnapshot.objects.filter(
+            interpretation_request_id=self.ir_ids[0]).exists())
+        self.assertEqual(
+            self.case_adder.skip_unchanged_cases(self.listed_cases), self.listed_cases[:1])
+
+    def test_quarantined_case_not_snapshotted(self):
+        case_adder = MultipleCaseAdder.__new__(MultipleCaseAdder)
+        case_adder.sample_type = "raredisease"
+        case_adder.config = {
+            "cip_api_storage": tempfile.mkdtemp(), "archive_codec": "gzip"}
+        self.addCleanup(shutil.rmtree, case_adder.config["cip_api_storage"])
+        case_adder.failed_cases = []
+        cases = [SimpleNamespace(request_id=ir_id) for ir_id in ("3000-1", "3001-1")]
+        case_adder.cases_to_add = cases
+        case_adder.cases_to_update = []
+        case_adder.cases_to_skip = []
+        case_adder.list_of_cases = cases
+        case_adder.set_listing_entries(
+            [self.listing_entry(case.request_id) for case in cases])
+
+        def add_cases(update=False):
+            # the second case fails to be written and is quarantined
+            if not update:
+                case_adder.quarantined_cases.append(("3001-1", "write", "traceback"))
+            return []
+        case_adder.add_cases = add_cases
+        # nothing to look up in VEP or LabKey
+        case_adder.prepare_cases = lambda cases: None
+        case_adder.update_database()
+
+        self.assertTrue(ListingSnapshot.objects.filter(
+            interpretation_request_id="3000-1").exists())
+        self.assertFalse(ListingSnapshot.objects.filter(
+            interpretation_request_id="3001-1").exists())
+        self.assertEqual(
+            list(QuarantinedCase.objects.values_list("interpretation_request_id", flat=True)),
+            ["3001-1"])
+
+
+class TestFetchCaseJsons(TestCase):
+    """
+    Test that case jsons downloaded by a pool of workers come back in the
+    order of the cases, that a case which fails doesn't stop the rest, and
+    that only a bounded number of downloads are queued ahead.
+    """
+    case_url = "https://cipapi.genomicsengland.nhs.uk/api/2/interpretation-request/{id}/1?reports_v6=true"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        store = ReplayStore(self.directory)
+        self.cases = [
+            {"interpretation_request_id": "{}-1".format(i)} for i in range(1000, 1012)]
+        # nothing is recorded for the fourth case, so its download fails
+        self.failing_case = self.cases[3]["interpretation_request_id"]
+        for case in self.cases:
+            ir_id = case["interpretation_request_id"]
+            if ir_id != self.failing_case:
+                url = self.case_url.format(id=ir_id.split("-")[0])
+                store.record(url, make_response(url, 200, json.dumps({
+                    "interpretation_request_id": ir_id}).encode()))
+        self.previous_client = set_http_client(
+            HTTPClient(replay_mode='replay', replay_dir=self.directory))
+
+        self.case_adder = MultipleCaseAdder.__new__(MultipleCaseAdder)
+        self.started = 0
+        started_lock = threading.Lock()
+        get_case_json = self.case_adder.get_case_json
+
+        def counted_get_case_json(interpretation_request_id):
+            with started_lock:
+                self.started += 1
+            return get_case_json(interpretation_request_id)
+        self.case_adder.get_case_json = counted_get_case_json
+
+    def tearDown(self):
+        set_http_client(self.previous_client)
+        shutil.rmtree(self.directory)
+
+    def check_fetched(self, fetched):
+        self.assertEqual([case for case, case_data, error in fetched], self.cases)
+        for case, case_data, error in fetched:
+            ir_id = case["interpretation_request_id"]
+            if ir_id == self.failing_case:
+                self.assertIsNone(case_data)
+                self.assertIn("RecordingNotFound", error)
+            else:
+                self.assertIsNone(error)
+                self.assertEqual(case_data["case_json"]["interpretation_request_id"], ir_id)
+
+    def test_sequential(self):
+        self.case_adder.workers = 1
+        self.check_fetched(list(self.case_adder.fetch_case_jsons(self.cases)))
+
+    def test_workers(self):
+        self.case_adder.workers = 2
+        fetched = []
+        in_flight = []
+        for result in self.case_adder.fetch_case_jsons(self.cases):
+            fetched.append(result)
+            # give the workers time to start everything they've been given
+            time.sleep(0.05)
+            in_flight.append(self.started - len(fetched))
+        self.check_fetched(fetched)
+        self.assertEqual(max(in_flight), self.case_adder.workers * 2)
+
+
+class TestBulkRollover(TestCase):
+    """
+    Test that bulk_rollover versions reports as GELInterpretationReport.save
+    does, moving the child rows of the previous version onto the new one.
+    """
+    def setUp(self):
+        self.reports = [GELInterpretationReportFactory() for _ in range(3)]
+        self.proband_variants = [
+            ProbandVariantFactory(interpretation_report=report) for report in self.reports]
+
+    def new_report(self, ir_family, assembly):
+        return GELInterpretationReport(
+            ir_family=ir_family, status="report_sent", updated=timezone.now(),
+            sample_type="raredisease", assembly=assembly, user="new user",
+            sha_hash="new hash")
+
+    def test_new_versions(self):
+        new_family = InterpretationReportFamilyFactory()
+        new_reports = [
+            self.new_report(report.ir_family, report.assembly) for report in self.reports
+        ] + [self.new_report(new_family, self.reports[0].assembly)]
+        saved = GELInterpretationReport.objects.bulk_rollover(new_reports)
+
+        self.assertEqual([report.archived_version for report in saved], [2, 2, 2, 1])
+        for report, new_report, proband_variant in zip(
+                self.reports, saved, self.proband_variants):
+            new_report.refresh_from_db()
+            self.assertEqual(new_report.ir_family_id, report.ir_family_id)
+            self.assertEqual(new_report.sha_hash, "new hash")
+            self.assertEqual(new_report.user, report.user)
+            self.assertEqual(new_report.mdt_status, report.mdt_status)
+            proband_variant.refresh_from_db()
+            self.assertEqual(proband_variant.interpretation_report_id, new_report.pk)
+        self.assertEqual(saved[3].user, "new user")
+        self.assertEqual(
+            set(GELInterpretationReport.objects.latest_cases_by_sample_type("raredisease")),
+            set(saved))
+
+    def test_save_moves_latest(self):
+        report = self.reports[0]
+        new_report = self.new_report(report.ir_family, report.assembly)
+        new_report.save()
+        report.refresh_from_db()
+        self.assertFalse(report.is_latest)
+        self.assertTrue(new_report.is_latest)
+        self.assertEqual(
+            list(GELInterpretationReport.objects.filter(
+                ir_family=report.ir_family, is_latest=True)),
+            [new_report])
+
+    def test_latest_report_choice(self):
+        """
+        save() and bulk_rollover both roll over from the report flagged
+        is_latest, or else the highest (archived_version, id), not the most
+        recently polled.
+        """
+        for report in self.reports[:2]:
+            report.refresh_from_db()
+            newer = self.new_report(report.ir_family, report.assembly)
+            newer.save()
+            GELInterpretationReport.objects.filter(pk=report.pk).update(
+                polled_at_datetime=timezone.now() + timedelta(days=1))
+        GELInterpretationReport.objects.filter(
+            ir_family=self.reports[1].ir_family).update(is_latest=False)
+
+        for report in self.reports[:2]:
+            saved = self.new_report(report.ir_family, report.assembly)
+            saved.save()
+            self.assertEqual(saved.archived_version, 3)
+            bulk_saved = GELInterpretationReport.objects.bulk_rollover(
+                [self.new_report(report.ir_family, report.assembly)])
+            self.assertEqual(bulk_saved[0].archived_version, 4)
+
+    def test_overwrite(self):
+        saved = GELInterpretationReport.objects.bulk_rollover(
+            [self.new_report(report.ir_family, report.assembly) for report in self.reports],
+            overwrite=True)
+        self.assertEqual([report.pk for report in saved], [report.pk for report in self.reports])
+        self.assertEqual(GELInterpretationReport.objects.count(), 3)
+        for report in saved:
+            report.refresh_from_db()
+            self.assertEqual(report.user, "new user")
+            self.assertEqual(report.sha_hash, "new hash")
+
+
+class TestDeselectEnsemblTranscripts(TestCase):
+    """
+    Test that selected ENST transcripts are deselected where a RefSeq
+    transcript is also selected, except on the mitochondrial chromosome.
+    """
+    def setUp(self):
+        self.report = GELInterpretationReportFactory()
+        self.ptvs = {}
+        for name, chromosome, refseq_selected in (
+                ("refseq_selected", "1", True),
+                ("no_refseq", "1", None),
+                ("refseq_not_selected", "1", False),
+                ("mitochondrial", "MT", True)):
+            proband_variant = ProbandVariantFactory(
+                interpretation_report=self.report,
+                variant=VariantFactory(chromosome=chromosome))
+            self.ptvs[name] = ProbandTranscriptVariantFactory(
+                proband_variant=proband_variant, selected=True,
+                transcript=TranscriptFactory(name="ENST0000000000" + chromosome))
+            if refseq_selected is not None:
+                ProbandTranscriptVariantFactory(
+                    proband_variant=proband_variant, selected=refseq_selected,
+                    transcript=TranscriptFactory(name="NM_000001." + chromosome))
+
+    def test_deselected(self):
+        case_adder = MultipleCaseAdder.__new__(MultipleCaseAdder)
+        with self.assertNumQueries(2):
+            deselected = case_adder.deselect_ensembl_transcripts([self.report])
+        self.assertEqual(deselected, 1)
+        for name, ptv in self.ptvs.items():
+            ptv.refresh_from_db()
+            self.assertEqual(ptv.selected, name != "refseq_selected")
+
+
+class TestUpdatePlanner(TestCase):
+    """
+    Test that UpdatePlanner sorts cases into those to add, update, skip and
+    block from their families' latest reports.
+    """
+    def setUp(self):
+        self.unchanged = GELInterpretationReportFactory(sample_type="raredisease", sha_hash="same")
+        self.changed = GELInterpretationReportFactory(sample_type="raredisease", sha_hash="old")
+        self.blocked = GELInterpretationReportFactory(sample_type="raredisease", status="report_sent")
+        self.planner = UpdatePlanner("raredisease")
+
+    def test_classify(self):
+        cases = [
+            SimpleNamespace(request_id=self.unchanged.ir_family.ir_family_id, json_hash="same"),
+            SimpleNamespace(request_id=self.changed.ir_family.ir_family_id, json_hash="new"),
+            SimpleNamespace(request_id="999999-1", json_hash="new")]
+        with self.assertNumQueries(1):
+            cases_to_add, cases_to_update, cases_to_skip = self.planner.classify(cases)
+        self.assertEqual(cases_to_add, [cases[2]])
+        self.assertEqual(cases_to_update, [cases[1]])
+        self.assertEqual(cases_to_skip, [cases[0]])
+
+    def test_plan(self):
+        listed_cases = [
+            {"interpretation_request_id": ir_id} for ir_id in (
+                self.unchanged.ir_family.ir_family_id,
+                self.changed.ir_family.ir_family_id,
+                "999999-1")]
+        blocked_cases = [{"interpretation_request_id": self.blocked.ir_family.ir_family_id}]
+        ProbandVariantFactory(interpretation_report=self.changed)
+        update_plan = self.planner.plan(listed_cases, listed_cases[1:], blocked_cases, bin_size=1)
+        self.assertEqual(update_plan.cases, {
+            "add": ["999999-1"],
+            "update": [self.changed.ir_family.ir_family_id],
+            "skip": [self.unchanged.ir_family.ir_family_id],
+            "block": [self.blocked.ir_family.ir_family_id]})
+        self.assertEqual(update_plan.downloads, 2)
+        self.assertEqual(update_plan.bins, 2)
+        self.assertEqual(update_plan.carried_variants, 1)
+
+
+class TestCaseJoins(TestCase):
+    """
+    Test that CaseAttributeManager joins CaseTranscripts to the case's
+    Variant, Transcript and ProbandVariant entries without queries.
+    """
+    def setUp(self):
+        assembly = ToolOrAssemblyVersion(pk=1, tool_name="genome_build", version_number="GRCh38")
+        self.variants = [
+            Variant(pk=i, chromosome="1", position=i, reference="A", alternate="T",
+                    genome_assembly=assembly) for i in (1, 2)]
+        self.transcripts = [Transcript(pk=1, name="ENST1", genome_assembly=assembly)]
+        self.proband_variants = [
+            ProbandVariant(pk=i, variant=variant) for i, variant in enumerate(self.variants, 1)]
+        self.case_transcripts = [
+            CaseTranscript("1-1", str(i), None, None, None, name, "YES", "+",
+                           "missense_variant", "0", None, None, "c.1A>T", "p.Met1?", "g.1A>T")
+            for i, name in ((1, "ENST1"), (2, "ENST1"), (2, "ENST2"))]
+
+        def manager(entries):
+            return SimpleNamespace(case_model=SimpleNamespace(
+                case_models=[SimpleNamespace(entry=entry) for entry in entries]))
+
+        self.manager = CaseAttributeManager.__new__(CaseAttributeManager)
+        self.manager.model_index = None
+        self.manager.case = SimpleNamespace(
+            json={"sample_type": "raredisease"},
+            variants=[CaseVariant("1", i, "1-1", str(i), "A", "T", "GRCh38") for i in (1, 2)],
+            transcripts=self.case_transcripts,
+            ig_objs=[],
+            clinical_report_objs=[],
+            attribute_managers={
+                ToolOrAssemblyVersion: manager([assembly]),
+                Variant: manager(self.variants),
+                Transcript: manager(self.transcripts),
+                ProbandVariant: manager(self.proband_variants)})
+
+    def test_joins(self):
+        with self.assertNumQueries(0):
+            transcript_variants = self.manager.get_transcript_variants()
+            proband_transcript_variants = self.manager.get_proband_transcript_variants()
+        self.assertEqual(
+            [(ctx.variant_entry, ctx.transcript_entry, ctx.proband_variant_entry)
+             for ctx in self.case_transcripts],
+            [(self.variants[0], self.transcripts[0], self.proband_variants[0]),
+             (self.variants[1], self.transcripts[0], self.proband_variants[1]),
+             (self.variants[1], None, self.proband_variants[1])])
+        # ENST2 has no Transcript entry, so gets no TranscriptVariant
+        self.assertEqual(len(transcript_variants.case_models), 2)
+        self.assertEqual(len(proband_transcript_variants.case_models), 2)
+
 class TestAddCases(TestCase):
     """
     Test that a case has been faithfully added to the database along with
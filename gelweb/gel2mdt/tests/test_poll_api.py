@@ -19,9 +19,22 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
+import base64
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
 import unittest
 from django.test import TestCase
 from ..api_utils.poll_api import PollAPI
+from ..api_utils.json_stream import hash_canonical, load_sections
+from ..api_utils.http_client import (
+    CircuitOpenError, HTTPClient, RetryableResponseError, TokenError, set_http_client)
+from ..api_utils.rate_limiter import RateLimiter, parse_rates
+from ..api_utils.replay import ReplayStore, make_response
+from ..api_utils.standin_server import StandinServer
 from ..api_utils.cip_utils import InterpretationList
 
 
@@ -31,6 +44,314 @@ class Poll_CIP_API_TestCase(TestCase):
         cip_api_poll.get_json_response()
 
 
+class HTTPClientTokenTestCase(TestCase):
+    def make_token(self, exp):
+        payload = base64.urlsafe_b64encode(
+            json.dumps({"exp": exp}).encode()).decode().rstrip("=")
+        return "header.{payload}.signature".format(payload=payload)
+
+    def setUp(self):
+        self.client = HTTPClient()
+        self.minted = []
+
+        self.status_code = 200
+
+        class FakeResponse(object):
+            def __init__(self, token, status_code):
+                self.token = token
+                self.status_code = status_code
+                self.text = json.dumps({"token": token})
+
+            def json(self):
+                if self.status_code != 200:
+                    return {"detail": "Unable to log in with provided credentials."}
+                return {"token": self.token}
+
+        def fake_post(host, url, json):
+            token = self.make_token(time.time() + 3600 + len(self.minted))
+            self.minted.append(token)
+            return FakeResponse(token, self.status_code)
+        self.client.post = fake_post
+
+    def test_token_reused_until_rejected(self):
+        first = self.client.get_token("host", "url", {})
+        self.assertEqual(first, self.client.get_token("host", "url", {}))
+        self.assertEqual(self.client.tokens_minted, 1)
+
+        second = self.client.get_token("host", "url", {}, stale_token=first)
+        self.assertNotEqual(first, second)
+        # a second thread reporting the same stale token gets the new one
+        self.assertEqual(
+            second,
+            self.client.get_token("host", "url", {}, stale_token=first))
+        self.assertEqual(self.client.tokens_minted, 2)
+
+    def test_token_refreshed_near_expiry(self):
+        self.client.tokens["url"] = ("old", time.time() + 5)
+        self.assertNotEqual(self.client.get_token("host", "url", {}), "old")
+
+    def test_failed_mint_not_cached(self):
+        first = self.client.get_token("host", "url", {})
+        self.status_code = 400
+        with self.assertRaises(TokenError):
+            self.client.get_token("host", "url", {}, stale_token=first)
+        self.assertNotIn("url", self.client.tokens)
+        self.status_code = 503
+        with self.assertRaises(RetryableResponseError):
+            self.client.get_token("host", "url", {})
+
+        # the next call mints again rather than reusing a missing token
+        self.status_code = 200
+        self.assertEqual(self.client.get_token("host", "url", {}), self.minted[-1])
+        self.assertEqual(self.client.tokens_minted, 2)
+
+    def test_token_expiry_read_from_payload(self):
+        self.assertEqual(
+            self.client.get_token_expiry(self.make_token(1234567890)),
+            1234567890)
+
+
+class HTTPClientRetryTestCase(TestCase):
+    def setUp(self):
+        self.client = HTTPClient(max_retries=3, retry_budget=4)
+        self.client.backoff_delay = lambda retries: 0
+        self.attempts = 0
+
+    def failing_attempt(self):
+        self.attempts += 1
+        raise ValueError("not json")
+
+    def test_retries_are_bounded(self):
+        with self.assertRaises(ValueError):
+            self.client.call("host", self.failing_attempt)
+        self.assertEqual(self.attempts, 4)
+
+        # only one retry is left in the run's budget
+        self.attempts = 0
+        with self.assertRaises(ValueError):
+            self.client.call("other_host", self.failing_attempt)
+        self.assertEqual(self.attempts, 2)
+
+    def test_circuit_closes_after_successful_trial(self):
+        self.client.circuit_reset = 0
+        circuit = self.client.get_circuit("host")
+        for i in range(circuit.failure_threshold):
+            circuit.record_failure()
+        self.assertTrue(circuit.is_open)
+        self.assertEqual(self.client.call("host", lambda: "ok"), "ok")
+        self.assertFalse(circuit.is_open)
+
+
+class RateLimiterTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_parse_rates(self):
+        self.assertEqual(
+            parse_rates("rest.ensembl.org:15, 127.0.0.1:8800:2.5"),
+            {"rest.ensembl.org": 15, "127.0.0.1:8800": 2.5})
+        self.assertEqual(parse_rates(""), {})
+
+    def test_bucket_shared_between_limiters(self):
+        first = RateLimiter(self.directory, {"host": 10}, burst=10)
+        second = RateLimiter(self.directory, {"host": 10}, burst=10)
+        for i in range(50):
+            self.assertEqual(first.acquire("host"), 0)
+            self.assertEqual(second.acquire("host"), 0)
+        # the bucket is empty, so the next request has to wait
+        self.assertGreater(first.acquire("host"), 0)
+        self.assertEqual(first.metrics["host"]["requests"], 51)
+        self.assertEqual(first.shared_metrics()["host"]["requests"], 101)
+        self.assertEqual(first.acquire("unlimited_host"), 0)
+
+
+class ReplayTestCase(TestCase):
+    url = "https://rest.genenames.org/fetch/symbol/BRCA1"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = ReplayStore(self.directory)
+        self.store.record(self.url, make_response(self.url, 200, json.dumps({
+            "response": {"docs": [{"symbol": "BRCA1"}]},
+            "user": {"first_name": "Jo", "email": "jo@example.com"}}).encode()))
+        self.previous_client = set_http_client(None)
+
+    def tearDown(self):
+        set_http_client(self.previous_client)
+        shutil.rmtree(self.directory)
+
+    def test_recording_is_anonymised(self):
+        recording = json.loads(self.store.load(self.url)["body"])
+        self.assertEqual(recording["response"]["docs"][0]["symbol"], "BRCA1")
+        self.assertNotEqual(recording["user"]["first_name"], "Jo")
+        self.assertNotEqual(recording["user"]["email"], "jo@example.com")
+
+    def test_replay_mode(self):
+        set_http_client(HTTPClient(replay_mode='replay', replay_dir=self.directory))
+        response_json = PollAPI("genenames", "fetch/symbol/BRCA1").get_json_response()
+        self.assertEqual(response_json["response"]["docs"][0]["symbol"], "BRCA1")
+
+    def test_standin_server(self):
+        server = StandinServer(self.store, port=0)
+        server.start()
+        try:
+            set_http_client(HTTPClient(standin_url=server.url))
+            poll = PollAPI("genenames", "fetch/symbol/BRCA1")
+            response_json = poll.get_json_response()
+            self.assertEqual(response_json["response"]["docs"][0]["symbol"], "BRCA1")
+
+            # CIP-API token requests are answered by the stand-in
+            poll = PollAPI("cip_api", "interpretation-request?page=1")
+            poll.get_json_response()
+            self.assertEqual(poll.response_status, 404)
+
+            server.error_rate = 1
+            client = HTTPClient(standin_url=server.url, max_retries=0,
+                                circuit_failures=2)
+            set_http_client(client)
+            poll = PollAPI("genenames", "fetch/symbol/BRCA1")
+            with self.assertRaises(RetryableResponseError):
+                poll.get_json_response()
+            self.assertEqual(poll.response_status, 503)
+
+            # the second failure opens the circuit, after which requests
+            # fail without reaching the server
+            with self.assertRaises(RetryableResponseError):
+                poll.get_json_response()
+            requests_served = server.requests_served
+            with self.assertRaises(CircuitOpenError):
+                poll.get_json_response()
+            self.assertEqual(server.requests_served, requests_served)
+            self.assertEqual(len(client.pop_circuit_events()), 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class JSONStreamTestCase(TestCase):
+    case_json = {
+        "version": 2,
+        "interpreted_genome": [{"variants": [{"position": 1.5e6, "name": "\u00e9"}] * 50}],
+        "interpretation_request_id": 1234,
+        "status": [],
+        "clinical_report": None,
+    }
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_load_sections(self):
+        path = os.path.join(self.directory, "case.json")
+        with open(path, "w") as json_file:
+            json.dump(self.case_json, json_file)
+
+        for chunk_size in (1, 7, 1 << 20):
+            sections, json_hash = load_sections(
+                path, keep=["version", "status"], chunk_size=chunk_size)
+            self.assertEqual(sections, {"version": 2, "status": []})
+            self.assertEqual(json_hash, hashlib.sha512(
+                json.dumps(self.case_json, sort_keys=True).encode('utf-8')).hexdigest())
+
+    def test_hash_canonical(self):
+        self.assertEqual(hash_canonical(self.case_json), hashlib.sha512(
+            json.dumps(self.case_json, sort_keys=True).encode('utf-8')).hexdigest())
+
+
+class InterpretationListReplayTestCase(TestCase):
+    page_url = "https://cipapi.genomicsengland.nhs.uk/api/2/interpretation-request?page={page}"
+    page_size = 4
+    statuses = ["sent_to_gmcs", "report_generated", "blocked", "report_sent",
+                "interpretation_generated", "dispatched"]
+    sites = [["RGT"], ["RYJ"], [], ["RYJ", "RGT"], ["RYJ", "WM"]]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = ReplayStore(self.directory)
+        # pages are answered after a random delay, so they come back out of
+        # order when fetched concurrently
+        self.server = StandinServer(self.store, port=0, latency=0.02, jitter=0.02, seed=1)
+        self.server.start()
+        self.previous_client = set_http_client(HTTPClient(standin_url=self.server.url))
+
+    def tearDown(self):
+        set_http_client(self.previous_client)
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def listing_result(self, n):
+        return {
+            "interpretation_request_id": "{}-1".format(1000 + n),
+            "sample_type": "cancer" if n % 3 == 0 else "raredisease",
+            "last_status": self.statuses[n % len(self.statuses)],
+            "proband": ("12000{}" if n % 7 == 0 else "5000{}").format(n),
+            "sites": self.sites[n % len(self.sites)],
+            "version": 1,
+            "last_modified": "2018-06-01T12:00:{:02d}Z".format(n % 60),
+            "cip_version": 2}
+
+    def record_pages(self, pages, count):
+        """
+        Records a listing of the given number of pages, the first of which
+        claims the listing has count results.
+        """
+        for page in range(1, pages + 1):
+            results = [self.listing_result(n) for n in range(
+                (page - 1) * self.page_size, page * self.page_size)]
+            url = self.page_url.format(page=page)
+            self.store.record(url, make_response(url, 200, json.dumps({
+                "count": count if page == 1 else pages * self.page_size,
+                "next": self.page_url.format(page=page + 1) if page < pages else None,
+                "results": results}).encode()))
+
+    def test_parallel_listing_matches_sequential(self):
+        self.record_pages(6, 6 * self.page_size)
+        sequential = InterpretationList('raredisease', workers=1)
+        parallel = InterpretationList('raredisease', workers=4)
+
+        self.assertEqual(parallel.all_cases, sequential.all_cases)
+        self.assertEqual(parallel.cases_to_poll, sequential.cases_to_poll)
+        self.assertEqual(parallel.blocked_cases, sequential.blocked_cases)
+        self.assertEqual(parallel.timings["pages"], 6)
+
+        ir_ids = [case["interpretation_request_id"] for case in parallel.all_cases]
+        self.assertEqual(ir_ids, sorted(ir_ids))
+        # cancer, pilot (12000...) and West London only cases are dropped
+        self.assertEqual(ir_ids, [
+            self.listing_result(n)["interpretation_request_id"]
+            for n in (2, 5, 8, 10, 13, 17, 20, 22, 23)])
+        for case in parallel.cases_to_poll:
+            self.assertIn(case["last_status"], InterpretationList.status_lookup['raredisease'])
+        self.assertTrue(parallel.blocked_cases)
+
+    def test_pages_added_during_listing(self):
+        # the first page was read when there were only two pages
+        self.record_pages(4, 2 * self.page_size)
+        sequential = InterpretationList('raredisease', workers=1)
+        parallel = InterpretationList('raredisease', workers=4)
+
+        self.assertEqual(parallel.all_cases, sequential.all_cases)
+        self.assertEqual(parallel.timings["pages"], 4)
+        self.assertEqual(parallel.all_cases_count, 4 * self.page_size)
+
+    def test_pages_removed_during_listing(self):
+        # the first page was read when there were six pages, the last three
+        # of which have since gone
+        self.record_pages(3, 6 * self.page_size)
+        sequential = InterpretationList('raredisease', workers=1)
+        parallel = InterpretationList('raredisease', workers=4)
+
+        self.assertEqual(parallel.all_cases, sequential.all_cases)
+        self.assertEqual(parallel.timings["pages"], 3)
+        self.assertEqual(parallel.all_cases_count, 3 * self.page_size)
+
+
 class TestInterpretationList(TestCase):
     def setUp(self):
         self.case_list_handler = InterpretationList()
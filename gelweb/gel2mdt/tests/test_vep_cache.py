@@ -0,0 +1,65 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import shutil
+import tempfile
+from django.test import TestCase
+from ..vep_utils.run_vep_batch import CaseVariant, annotate_variants
+from ..vep_utils.vep_cache import VEPCache
+
+
+class VEPCacheTestCase(TestCase):
+    record = ['ENSG00000139618', 'BRCA2', '1101', 'ENST00000380152', 'YES', '1',
+              'missense_variant', '0.001', 'benign(0.01)', 'tolerated(0.5)',
+              'ENST00000380152.7:c.100A>G', 'ENSP00000369497.3:p.Lys34Glu', '13:g.32890598A>G']
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = VEPCache(self.directory, '91', '91', True)
+        self.variant = CaseVariant('13', 32890598, '1234-1', 0, 'A', 'G', 'GRCh37')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_lookup(self):
+        key = VEPCache.key(self.variant)
+        self.assertEqual(key, ('GRCh37', '13', 32890598, 'A', 'G'))
+        self.cache.store({key: [self.record]})
+        self.assertEqual(self.cache.lookup([key]), {key: [self.record]})
+        # the same variant on the other assembly isn't cached
+        self.assertEqual(self.cache.lookup([('GRCh38',) + key[1:]]), {})
+
+    def test_version_change_invalidates(self):
+        key = VEPCache.key(self.variant)
+        self.cache.store({key: [self.record]})
+        self.assertEqual(VEPCache(self.directory, '91', '91', True).lookup([key]), {key: [self.record]})
+        upgraded = VEPCache(self.directory, '95', '91', True)
+        self.assertEqual(upgraded.lookup([key]), {})
+        self.assertEqual(upgraded.stats()['variants'], 0)
+
+    def test_cached_variants_not_run(self):
+        self.cache.store({VEPCache.key(self.variant): [self.record]})
+        recurrent = CaseVariant('13', 32890598, '5678-1', 3, 'A', 'G', 'GRCh37')
+        # every variant is cached, so VEP isn't configured or run
+        transcripts = annotate_variants([self.variant, recurrent], {}, self.cache)
+        self.assertEqual([(t.case_id, t.variant_count, t.transcript_name) for t in transcripts],
+                         [('1234-1', '0', 'ENST00000380152'), ('5678-1', '3', 'ENST00000380152')])
+        self.assertEqual(transcripts[1].transcript_variant_hgvs_g, '13:g.32890598A>G')
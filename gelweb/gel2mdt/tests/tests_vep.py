@@ -19,11 +19,307 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
 from django.test import TestCase
-from ..vep_utils import run_vep_batch
+from ..vep_utils import parse_vep, run_vep_batch, vep_worker
 # from ..database_utils import multiple_case_adder
 # from ..models import *
 #
 # Family.objects.filter(gel_family_id=100).delete()
 # multiple_case_adder.MultipleCaseAdder(test_data=True)
+
+
+class TestVEPShards(TestCase):
+    def test_split_and_concatenate(self):
+        lines = ['1\t{}\t1234-1:{}\tA\tG\n'.format(100 + i, i) for i in range(7)]
+        vcf = tempfile.NamedTemporaryFile(mode='w+t', delete=False)
+        vcf.writelines(lines)
+        vcf.close()
+        shard_paths = run_vep_batch.split_vcf(vcf.name, 3)
+        self.assertEqual([len(open(path).readlines()) for path in shard_paths], [2, 2, 3])
+        self.assertEqual(len(run_vep_batch.split_vcf(vcf.name, 20)), 7)
+
+        # each annotated shard has its own header
+        for path in shard_paths:
+            with open(path) as shard_file:
+                body = shard_file.read()
+            with open(path, 'w') as shard_file:
+                shard_file.write('##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\n' + body)
+        outfile = vcf.name + '.vep.vcf'
+        run_vep_batch.concatenate_vcfs(shard_paths, outfile)
+        with open(outfile) as out_vcf:
+            self.assertEqual(out_vcf.readlines(),
+                             ['##fileformat=VCFv4.1\n', '#CHROM\tPOS\tID\tREF\tALT\n'] + lines)
+        for path in shard_paths + [vcf.name, outfile]:
+            os.remove(path)
+
+
+class TestParseVep(TestCase):
+    vcf_text = (
+        '##fileformat=VCFv4.1\n'
+        '##INFO=<ID=CSQ,Number=.,Type=String,Description="Consequence annotations from Ensembl VEP. '
+        'Format: Allele|Consequence|Gene|SYMBOL|HGNC_ID|Feature|CANONICAL|STRAND|MAX_AF|PolyPhen|SIFT|'
+        'HGVSc|HGVSp|HGVSg">\n'
+        '##contig=<ID=1>\n'
+        '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+        '1\t100\t1234-1:0\tA\tG\t.\t.\tCSQ=G|missense_variant|ENSG1|GENE1|HGNC:11|ENST1|YES|1|0.1|benign|'
+        'tolerated|c.1A>G|p.Leu1%3D|1:g.100A>G,G|intron_variant|ENSG1|GENE1|HGNC:11|ENST2||1|0.1|||||'
+        '1:g.100A>G\n'
+        '1\t200\t1234-1:1\tC\tT\t.\t.\tCSQ=T|intergenic_variant||||||||||||1:g.200C>T\n')
+
+    def setUp(self):
+        vcf = tempfile.NamedTemporaryFile(mode='w+t', suffix='.vcf', delete=False)
+        vcf.write(self.vcf_text)
+        vcf.close()
+        self.vcf = vcf.name
+
+    def tearDown(self):
+        os.remove(self.vcf)
+
+    def test_iter_records(self):
+        records = list(parse_vep.ParseVep().iter_records(self.vcf, ['Feature', 'Consequence']))
+        self.assertEqual(records, [
+            ('1234-1:0', [('ENST1', 'missense_variant'), ('ENST2', 'intron_variant')]),
+            ('1234-1:1', [('', 'intergenic_variant')])])
+        columns = parse_vep.ParseVep().read_columns(self.vcf, ['Feature'])
+        self.assertEqual(columns, {'id': ['1234-1:0', '1234-1:0', '1234-1:1'],
+                                   'Feature': ['ENST1', 'ENST2', '']})
+        with self.assertRaises(ValueError):
+            list(parse_vep.ParseVep().iter_records(self.vcf, ['Feature', 'LoF']))
+
+    def test_matches_read_file(self):
+        read_file_records = [
+            (variant['id'], run_vep_batch.transcript_records(
+                [tuple(transcript[field] for field in run_vep_batch.CSQ_FIELDS)
+                 for transcript in variant['transcript_data'].values()]))
+            for variant in parse_vep.ParseVep().read_file(self.vcf)]
+        records = list(run_vep_batch.parse_vep_records({'hg19_vep': self.vcf}))
+        self.assertEqual(records, read_file_records)
+        self.assertEqual(records[0][1][0][2], '11')
+        self.assertEqual(records[0][1][0][11], 'p.Leu1=')
+        self.assertFalse(records[0][1][1][4])
+
+
+class TestVEPWorker(TestCase):
+    # stands in for VEP reading variants from stdin, holding the last line
+    # back as VEP may, and exiting on a variant with the id crash
+    fake_vep = '\n'.join([
+        'import sys',
+        'held = None',
+        'print("##INFO=<ID=CSQ,Number=.,Type=String,Description=\\"Consequence annotations from '
+        'Ensembl VEP. Format: Feature|Consequence\\">")',
+        'print("#CHROM\\tPOS\\tID\\tREF\\tALT\\tQUAL\\tFILTER\\tINFO")',
+        'for line in sys.stdin:',
+        '    if held is not None:',
+        '        columns = held.split()',
+        '        if columns[2] == "crash":',
+        '            sys.exit(1)',
+        '        print("\\t".join(columns + [".", ".", "CSQ=ENST" + columns[1] + "|missense_variant"]))',
+        '    held = line',
+    ])
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        script = os.path.join(self.directory, 'vep.py')
+        with open(script, 'w') as script_file:
+            script_file.write(self.fake_vep)
+        self.socket_path = os.path.join(self.directory, 'vep.sock')
+        self.server = vep_worker.VEPWorkerServer(
+            self.socket_path, {'GRCh37': '{} -u {}'.format(sys.executable, script)}, timeout=10)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def annotate(self, *variant_ids):
+        lines = vep_worker.request_annotations(
+            self.socket_path, 'GRCh37',
+            ['1\t{}\t{}\tA\tG'.format(100 + i, variant_id) for i, variant_id in enumerate(variant_ids)])
+        return list(parse_vep.ParseVep().iter_lines(lines, ['Feature']))
+
+    def test_annotate(self):
+        self.assertEqual(self.annotate('1234-1:0', '1234-1:1'),
+                         [('1234-1:0', [('ENST100', )]), ('1234-1:1', [('ENST101', )])])
+        # the same process answers the next request
+        self.assertEqual(self.annotate('1234-1:2'), [('1234-1:2', [('ENST100', )])])
+        self.assertEqual(self.server.processes['GRCh37'].restarts, 1)
+
+    def test_restart(self):
+        with self.assertRaises(vep_worker.VEPWorkerError):
+            self.annotate('crash')
+        self.assertEqual(self.annotate('1234-1:0'), [('1234-1:0', [('ENST100', )])])
+        with self.assertRaises(vep_worker.VEPWorkerError):
+            vep_worker.request_annotations(os.path.join(self.directory, 'missing.sock'), 'GRCh37', [])
+
+
+class StubSSHClient(object):
+    """
+    Stands in for a connected paramiko SSHClient, running commands and
+    copying files locally. VEP commands wait for each other, so both genome
+    builds must be annotated at once, and fail on fail_assembly.
+    """
+    class Stream(object):
+        def __init__(self, data=b'', status=0):
+            self.data = data
+            self.status = status
+            self.channel = self
+
+        def read(self):
+            return self.data
+
+        def recv_exit_status(self):
+            return self.status
+
+        def close(self):
+            pass
+
+    class SFTP(object):
+        def __init__(self, ssh):
+            self.ssh = ssh
+
+        @staticmethod
+        def copy(source, destination):
+            shutil.copyfile(source, destination)
+            with open(destination, 'rb') as copied_file:
+                return copied_file.read(2) == b'\x1f\x8b'
+
+        def put(self, local_path, remote_path):
+            self.ssh.uploads.append((remote_path, self.copy(local_path, remote_path)))
+
+        def get(self, remote_path, local_path):
+            self.ssh.downloads.append((local_path, self.copy(remote_path, local_path)))
+
+        def close(self):
+            pass
+
+    def __init__(self):
+        self.commands = []
+        # (path, whether the file copied was gzipped)
+        self.uploads = []
+        self.downloads = []
+        self.fail_assembly = None
+        self.vep_barrier = threading.Barrier(2, timeout=10)
+
+    def get_transport(self):
+        return self
+
+    def is_active(self):
+        return True
+
+    def open_sftp(self):
+        return self.SFTP(self)
+
+    def exec_command(self, cmd):
+        self.commands.append(cmd)
+        if '--assembly' in cmd:
+            self.vep_barrier.wait()
+            if self.fail_assembly and '--assembly ' + self.fail_assembly in cmd:
+                return self.Stream(), self.Stream(status=2), self.Stream(b'VEP failed')
+        process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, error = process.communicate()
+        return self.Stream(), self.Stream(output, process.returncode), self.Stream(error)
+
+
+class TestRemoteVEP(TestCase):
+    # stands in for VEP on the remote server, annotating a gzipped VCF
+    fake_vep = '\n'.join([
+        'import gzip, sys',
+        'args = sys.argv[1:]',
+        'infile, outfile = args[args.index("-i") + 1], args[args.index("-o") + 1]',
+        'opener = gzip.open if "--compress_output" in args else open',
+        'with opener(outfile, "wt") as out_vcf:',
+        '    out_vcf.write("##INFO=<ID=CSQ,Number=.,Type=String,Description=\\"Consequence annotations from "',
+        '                  "Ensembl VEP. Format: Allele|Consequence|Gene|SYMBOL|HGNC_ID|Feature|CANONICAL|STRAND|"',
+        '                  "MAX_AF|PolyPhen|SIFT|HGVSc|HGVSp|HGVSg\\">\\n")',
+        '    out_vcf.write("#CHROM\\tPOS\\tID\\tREF\\tALT\\tQUAL\\tFILTER\\tINFO\\n")',
+        '    for line in gzip.open(infile, "rt"):',
+        '        columns = line.split()',
+        '        out_vcf.write("\\t".join(columns + [".", ".", "CSQ=" + columns[4] + "|missense_variant|ENSG1|GENE1|"',
+        '                      "HGNC:11|ENST" + columns[1] + "|YES|1|0.1|||||"]) + "\\n")',
+    ])
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        script = os.path.join(self.directory, 'vep.py')
+        with open(script, 'w') as script_file:
+            script_file.write(self.fake_vep)
+        self.remote_directory = os.path.join(self.directory, 'remote')
+        os.mkdir(self.remote_directory)
+        self.config_dict = {
+            'remote_ip': 'vep.example.org', 'remote_username': 'gel2mdt', 'remote_password': '',
+            'remote_directory': self.remote_directory, 'remoteVEP': 'True',
+            'vep': '{} {}'.format(sys.executable, script), 'cache': self.directory, 'cache_version': '91',
+            'hg19_fasta_loc': 'hg19.fa', 'hg38_fasta_loc': 'hg38.fa', 'mergedVEP': 'False',
+            'vep_total_cores': '4'}
+        # the connection every run in this process should share
+        self.ssh = StubSSHClient()
+        self.ssh_key = ('vep.example.org', 'gel2mdt', os.getpid())
+        run_vep_batch.ssh_clients[self.ssh_key] = self.ssh
+        self.variants = [
+            run_vep_batch.CaseVariant('1', 100, '1234-1', 0, 'A', 'G', 'GRCh37'),
+            run_vep_batch.CaseVariant('1', 200, '1234-1', 1, 'C', 'T', 'GRCh38')]
+
+    def tearDown(self):
+        run_vep_batch.ssh_clients.pop(self.ssh_key, None)
+        shutil.rmtree(self.directory)
+
+    def run_remotely(self):
+        vcfs = run_vep_batch.generate_vcf(self.variants)
+        local_directory = os.path.join(self.directory, 'local')
+        os.mkdir(local_directory)
+        try:
+            annotated = run_vep_batch.run_vep_remotely(vcfs, self.config_dict, local_directory)
+            return list(run_vep_batch.parse_vep_records(annotated))
+        finally:
+            shutil.rmtree(local_directory)
+            for vcf in vcfs.values():
+                os.remove(vcf)
+
+    def test_run_vep_remotely(self):
+        for _ in range(2):
+            records = self.run_remotely()
+            self.assertEqual([variant_id for variant_id, transcripts in records], ['1234-1:0', '1234-1:1'])
+        self.assertIs(run_vep_batch.remote_ssh_client(self.config_dict), self.ssh)
+
+        # each run works in a directory of its own, removed when it finishes
+        job_directories = [cmd.split()[-1] for cmd in self.ssh.commands if cmd.startswith('mkdir')]
+        self.assertEqual(len(set(job_directories)), 2)
+        for job_directory in job_directories:
+            self.assertTrue(job_directory.startswith(self.remote_directory + '/gel2mdt-'))
+            self.assertIn('rm -rf ' + job_directory, self.ssh.commands)
+        self.assertEqual(os.listdir(self.remote_directory), [])
+
+        # VCFs go up and results come down gzipped
+        self.assertEqual(len(self.ssh.uploads), 4)
+        self.assertEqual(len(self.ssh.downloads), 4)
+        for path, gzipped in self.ssh.uploads + self.ssh.downloads:
+            self.assertTrue(path.endswith('.vcf.gz'))
+            self.assertTrue(gzipped)
+        vep_commands = [cmd for cmd in self.ssh.commands if '--assembly' in cmd]
+        self.assertEqual(len(vep_commands), 4)
+        for cmd in vep_commands:
+            self.assertIn('--compress_output gzip', cmd)
+            self.assertIn('--fork 2', cmd)
+
+    def test_failed_run_cleaned_up(self):
+        self.ssh.fail_assembly = 'GRCh38'
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.run_remotely()
+        self.assertTrue(any(cmd.startswith('rm -rf ') for cmd in self.ssh.commands))
+        self.assertEqual(os.listdir(self.remote_directory), [])
+
+    def test_annotate_variants_removes_results(self):
+        def results_directories():
+            return set(name for name in os.listdir(tempfile.gettempdir()) if name.startswith('gel2mdt_vep_'))
+        existing = results_directories()
+        transcripts = run_vep_batch.annotate_variants(self.variants, self.config_dict)
+        self.assertEqual([transcript.transcript_name for transcript in transcripts], ['ENST100', 'ENST200'])
+        self.assertEqual(results_directories(), existing)
@@ -16,6 +16,9 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
+import gzip
+from operator import itemgetter
+
 from pysam import VariantFile
 
 class ParseVep:
@@ -113,4 +116,70 @@ class ParseVep:
                 else:
                     variant_data_dict[new_key] = rec.info[key]
             master_list.append(variant_data_dict)
-        return master_list
\ No newline at end of file
+        return master_list
+
+    def iter_records(self, file, fields):
+        """
+        Streams the CSQ annotations of each variant in a VEP annotated vcf, keeping only the requested CSQ fields.
+        Unlike read_file, the vcf is read line by line as text, the position of each field in the CSQ is worked out once
+        from the header, and the other INFO keys and CSQ fields are never parsed.
+        :param file: A VCF file that has been annotated with VEP, optionally gzipped
+        :param fields: CSQ field names to keep, e.g. ['Feature', 'Consequence']
+        :return: Generator of (id, transcripts) tuples, one per variant, where transcripts is a list of tuples of
+        the values of fields, one per transcript in the CSQ
+        """
+        opener = gzip.open if file.endswith('.gz') else open
+        with opener(file, 'rt') as vep_vcf:
+            for record in self.iter_lines(vep_vcf, fields):
+                yield record
+
+    def iter_lines(self, lines, fields):
+        """
+        Does the work of iter_records on lines of a VEP annotated vcf, e.g. those returned by a VEP worker.
+        :param lines: Iterable of the vcf's lines, header first
+        :param fields: CSQ field names to keep
+        :return: Generator of (id, transcripts) tuples, as for iter_records
+        """
+        indexes = None
+        for line in lines:
+            if line.startswith('#'):
+                if line.startswith('##INFO=<ID=CSQ,'):
+                    csq_fields = self.get_fields(line)
+                    missing = [field for field in fields if field not in csq_fields]
+                    if missing:
+                        raise ValueError('CSQ in vcf has no {} fields.'.format(', '.join(missing)))
+                    indexes = [csq_fields.index(field) for field in fields]
+                    last_index = max(indexes)
+                    if len(indexes) == 1:
+                        project = lambda values, index=indexes[0]: (values[index], )
+                    else:
+                        project = itemgetter(*indexes)
+                elif line.startswith('#CHROM') and indexes is None:
+                    raise ValueError('Problem parsing CSQ header in vcf.')
+                continue
+            columns = line.split('\t', 8)
+            transcripts = []
+            for info in columns[7].rstrip('\n').split(';'):
+                if info.startswith('CSQ='):
+                    for transcript in info[4:].split(','):
+                        values = transcript.split('|')
+                        if len(values) <= last_index:
+                            values += [''] * (last_index + 1 - len(values))
+                        transcripts.append(project(values))
+                    break
+            yield columns[2], transcripts
+
+    def read_columns(self, file, fields):
+        """
+        Reads the requested CSQ fields of a VEP annotated vcf into column arrays.
+        :param file: A VCF file that has been annotated with VEP
+        :param fields: CSQ field names to keep
+        :return: A dict of lists with one entry per transcript: 'id' holds the id of the transcript's variant, and
+        each of fields its values
+        """
+        columns = dict((field, []) for field in ['id'] + list(fields))
+        for variant_id, transcripts in self.iter_records(file, fields):
+            columns['id'].extend([variant_id] * len(transcripts))
+            for index, field in enumerate(fields):
+                columns[field].extend([values[index] for values in transcripts])
+        return columns
@@ -20,10 +20,26 @@ import os
 import tempfile
 import subprocess
 import csv
+import gzip
+import logging
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from ..config import load_config
-from . import parse_vep
+from . import parse_vep, vep_worker
+from .vep_cache import VEPCache
 import paramiko
 
+# set up logging
+logger = logging.getLogger(__name__)
+
+# SSH connections to remote VEP servers, shared by every run in the process
+ssh_clients = {}
+ssh_clients_lock = threading.Lock()
+
+
 class CaseVariant:
     def __init__(self, chromosome, position, case_id, variant_count, ref, alt, genome_build):
         self.chromosome = chromosome
@@ -80,6 +96,15 @@ class CaseTranscript:
         self.selected = False
 
 
+def vcf_line(variant):
+    '''
+    Formats a CaseVariant as the CHROM, POS, ID, REF and ALT columns of a VCF line, without a newline. The ID is
+    case_id:variant_count
+    '''
+    return str(variant.chromosome) + '\t' + str(variant.position) + '\t' + str(variant.case_id) + ":" + \
+        str(variant.variant_count) + '\t' + variant.ref + '\t' + variant.alt
+
+
 def generate_vcf(variants):
     '''
     Function which creates a VCF formatted file from variant objects specified from MCA.
@@ -91,13 +116,9 @@ def generate_vcf(variants):
     tmphg38 = tempfile.NamedTemporaryFile(mode='w+t', delete=False)
     for variant in variants:
         if 'GRCh37' in variant.genome_build:
-            row_to_write = str(variant.chromosome) + '\t' + str(variant.position) + '\t' + str(variant.case_id) + ":" + \
-                           str(variant.variant_count) + '\t' + variant.ref + '\t' + variant.alt + '\n'
-            tmphg19.writelines(row_to_write)
+            tmphg19.writelines(vcf_line(variant) + '\n')
         elif 'GRCh38' in variant.genome_build:
-            row_to_write = str(variant.chromosome) + '\t' + str(variant.position) + '\t' + str(variant.case_id) + ":" + \
-                           str(variant.variant_count) + '\t' + variant.ref + '\t' + variant.alt + '\n'
-            tmphg38.writelines(row_to_write)
+            tmphg38.writelines(vcf_line(variant) + '\n')
     tmphg19.close()
     tmphg38.close()
     print(tmphg19.name, tmphg38.name)
@@ -105,138 +126,290 @@ def generate_vcf(variants):
     return variant_dict
 
 
+def vep_command(infile, outfile, assembly, config_dict, fork):
+    '''
+    Builds the command for running VEP locally from the options in config.txt
+    :param infile: VCF to annotate, or None for VEP to read VCF lines from its stdin
+    :param outfile: Path VEP writes its annotated VCF to, or STDOUT
+    :param assembly: GRCh37 or GRCh38
+    :param config_dict: Configuration dict
+    :param fork: Number of processes VEP forks; 1 runs it without --fork
+    :return: The command as a string
+    '''
+    fasta_loc = config_dict['hg19_fasta_loc'] if assembly == 'GRCh37' else config_dict['hg38_fasta_loc']
+    cmd = "{vep} {input} -o {outfile} --species homo_sapiens --force_overwrite --cache --dir_cache {cache} " \
+          "--vcf --flag_pick --exclude_predicted --assembly {assembly} --everything " \
+          "--hgvsg --dont_skip --total_length --offline --fasta {fasta_loc} --cache_version {cache_version}".format(
+            vep=config_dict['vep'],
+            input='-i {}'.format(infile) if infile else '--format vcf',
+            outfile=outfile,
+            cache=config_dict['cache'],
+            assembly=assembly,
+            cache_version=config_dict['cache_version'],
+            fasta_loc=fasta_loc,
+    )
+    if fork > 1:
+        cmd += ' --fork {fork}'.format(fork=fork)
+    if config_dict["mergedVEP"] == 'True':
+        cmd += ' --merged'
+    return cmd
+
+
+def split_vcf(vcf, shards):
+    '''
+    Splits a VCF of variants into contiguous chunks of about the same number of lines
+    :param vcf: Path of the VCF, as written by generate_vcf
+    :param shards: Number of chunks wanted; fewer are made if there are fewer variants
+    :return: List of paths of the chunks, in input order
+    '''
+    with open(vcf) as vcf_file:
+        lines = vcf_file.readlines()
+    shards = max(1, min(shards, len(lines)))
+    shard_paths = []
+    for shard in range(shards):
+        start = len(lines) * shard // shards
+        end = len(lines) * (shard + 1) // shards
+        shard_file = tempfile.NamedTemporaryFile(mode='w+t', delete=False)
+        shard_file.writelines(lines[start:end])
+        shard_file.close()
+        shard_paths.append(shard_file.name)
+    return shard_paths
+
+
+def concatenate_vcfs(vcfs, outfile):
+    '''
+    Concatenates VCFs annotated by VEP with the same options, keeping the header of the first only
+    :param vcfs: Paths of the VCFs, in order
+    :param outfile: Path to write the concatenated VCF to
+    '''
+    with open(outfile, 'w') as out_vcf:
+        for index, vcf in enumerate(vcfs):
+            with open(vcf) as shard_vcf:
+                for line in shard_vcf:
+                    if index == 0 or not line.startswith('#'):
+                        out_vcf.write(line)
+
+
+def run_vep_shard(shard):
+    '''
+    Runs VEP on one chunk of a VCF, logging how long it took
+    :param shard: Dict with the assembly, shard number, shard count, variant count and command of the chunk
+    '''
+    start = time.time()
+    subprocess.run(shard['cmd'], stderr=subprocess.STDOUT, shell=True, check=True)
+    logger.info("VEP {assembly} shard {shard}/{shards}: {variants} variants in {seconds:.1f}s".format(
+        seconds=time.time() - start, **shard))
+
+
 def run_vep(infile, config_dict):
     '''
-    Function which runs VEP using subprocess. Takes multiple options from config.txt file
+    Function which runs VEP using subprocess. Takes multiple options from config.txt file.
+    Each build's VCF is split into vep_shards chunks, and the chunks of both builds are annotated
+    concurrently, sharing vep_total_cores between them, then joined back together in input order
     :param infile: Dict containing VCFs for the 2 genome builds
     :param config_dict: Configuration dict
     :return: Dict which contains the locations of the 2 results files relating to the 2 genome builds
     '''
-    hg19_vcf = infile['hg19_vcf']
-    hg38_vcf = infile['hg38_vcf']
-    hg19_outfile = tempfile.NamedTemporaryFile(mode='w+t', delete=False)
-    hg38_outfile = tempfile.NamedTemporaryFile(mode='w+t', delete=False)
-    # run VEP for hg19 variants
+    shard_count = int(config_dict.get('vep_shards') or 1)
+    total_cores = int(config_dict.get('vep_total_cores') or 4)
+    builds = [('hg19', 'GRCh37'), ('hg38', 'GRCh38')]
+
+    shards = []
+    shard_outputs = {}
+    for build, assembly in builds:
+        vcf = infile[build + '_vcf']
+        if os.stat(vcf).st_size == 0:  # no variants on this build
+            continue
+        shard_outputs[build] = []
+        shard_paths = split_vcf(vcf, shard_count)
+        for index, shard_path in enumerate(shard_paths):
+            with open(shard_path) as shard_file:
+                variants = sum(1 for line in shard_file)
+            shards.append({
+                'assembly': assembly,
+                'shard': index + 1,
+                'shards': len(shard_paths),
+                'variants': variants,
+                'infile': shard_path,
+                'outfile': shard_path + '.vep.vcf',
+            })
+            shard_outputs[build].append(shard_path + '.vep.vcf')
+
     annotated_variant_dict = {}
+    if not shards:
+        return annotated_variant_dict
+    # run as many shards at once as the core budget allows, and give each an equal share of it
+    workers = min(len(shards), total_cores)
+    fork = max(1, total_cores // workers)
+    for shard in shards:
+        shard['cmd'] = vep_command(shard['infile'], shard['outfile'], shard['assembly'], config_dict, fork)
+    start = time.time()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # list() so that a failed shard raises here
+            list(executor.map(run_vep_shard, shards))
+        logger.info("VEP: {shards} shards on {workers} workers with --fork {fork} in {seconds:.1f}s".format(
+            shards=len(shards), workers=workers, fork=fork, seconds=time.time() - start))
 
-    if os.stat(hg19_vcf).st_size != 0: # if file not empty
-        # builds command from locations supplied in config file
-        cmd = "{vep} -i {infile} -o {outfile} --species homo_sapiens --force_overwrite --cache --dir_cache {cache} " \
-              "--fork 4 --vcf --flag_pick --exclude_predicted --assembly GRCh37 --everything " \
-              "--hgvsg --dont_skip --total_length --offline --fasta {fasta_loc} --cache_version {cache_version}".format(
-                vep=config_dict['vep'],
-                infile=hg19_vcf,
-                outfile=hg19_outfile.name,
-                cache=config_dict['cache'],
-                cache_version=config_dict['cache_version'],
-                fasta_loc=config_dict['hg19_fasta_loc'],
-        )
-        if config_dict["mergedVEP"] == 'True':
-            cmd += ' --merged'
-        subprocess.run(cmd, stderr=subprocess.STDOUT, shell=True, check=True)
-        annotated_variant_dict['hg19_vep'] = hg19_outfile.name
-    # run VEP for hg38 variants
-    if os.stat(hg38_vcf).st_size != 0:
-        cmd = "{vep} -i {infile} -o {outfile} --species homo_sapiens --force_overwrite --cache --dir_cache {cache}" \
-              " --fork 4 --vcf --flag_pick  --exclude_predicted --assembly GRCh38 --everything " \
-              "--hgvsg --dont_skip --total_length --offline --fasta {fasta_loc} --cache_version {cache_version}".format(
-                vep=config_dict['vep'],
-                infile=hg38_vcf,
-                outfile=hg38_outfile.name,
-                cache=config_dict['cache'],
-                cache_version=config_dict['cache_version'],
-                fasta_loc=config_dict['hg38_fasta_loc'],
-        )
-        if config_dict["mergedVEP"] == 'True':
-            cmd += ' --merged'
-
-        subprocess.run(cmd, stderr=subprocess.STDOUT, shell=True, check=True)
-        annotated_variant_dict['hg38_vep'] = hg38_outfile.name
+        for build, outputs in shard_outputs.items():
+            outfile = tempfile.NamedTemporaryFile(mode='w+t', delete=False)
+            outfile.close()
+            concatenate_vcfs(outputs, outfile.name)
+            annotated_variant_dict[build + '_vep'] = outfile.name
+    finally:
+        for shard in shards:
+            for path in (shard['infile'], shard['outfile']):
+                if os.path.exists(path):
+                    os.remove(path)
     return annotated_variant_dict
 
 
-def run_vep_remotely(infile, config_dict):
+def remote_ssh_client(config_dict):
     '''
-    Function which runs VEP using paramiko on a remote machine.
-    :param infile: Dict containing VCFs for the 2 genome builds
+    Returns the SSH connection to the remote VEP server, which is opened once and shared by every run (and thread)
+    in this process, and reopened if it has dropped
     :param config_dict: Configuration dict
-    :return: Dict which contains the locations of the 2 results files relating to the 2 genome builds
+    :return: A connected paramiko SSHClient
     '''
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    # connections aren't shared with processes forked after they were opened, e.g. celery workers
+    key = (config_dict['remote_ip'], config_dict['remote_username'], os.getpid())
+    with ssh_clients_lock:
+        ssh = ssh_clients.get(key)
+        if ssh is None or ssh.get_transport() is None or not ssh.get_transport().is_active():
+            ssh = paramiko.SSHClient()
+            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            ssh.connect(config_dict['remote_ip'],
+                        username=config_dict['remote_username'],
+                        password=config_dict['remote_password'])
+            ssh.get_transport().set_keepalive(30)
+            ssh_clients[key] = ssh
+    return ssh
+
+
+def run_remote_command(ssh, cmd):
+    '''
+    Runs a command on the remote server, raising CalledProcessError if it fails
+    :return: The command's stdout
+    '''
+    stdin, stdout, stderr = ssh.exec_command(cmd)
+    stdin.close()
+    output = stdout.read()
+    error = stderr.read()
+    status = stdout.channel.recv_exit_status()
+    if status != 0:
+        raise subprocess.CalledProcessError(status, cmd, output=output, stderr=error)
+    return output
+
+
+def run_vep_remote_build(ssh, vcf, build, assembly, job_directory, local_directory, fork, config_dict):
+    '''
+    Uploads one build's VCF gzipped to the job's remote directory, runs VEP on it there and downloads its gzipped
+    results
+    :return: Path of the downloaded results
+    '''
+    local_vcf = os.path.join(local_directory, build + '_input.vcf.gz')
+    with open(vcf, 'rb') as vcf_file, gzip.open(local_vcf, 'wb') as gzipped_vcf:
+        shutil.copyfileobj(vcf_file, gzipped_vcf)
+    remote_vcf = '{}/{}_input.vcf.gz'.format(job_directory, build)
+    remote_outfile = '{}/{}_output.vcf.gz'.format(job_directory, build)
+    local_outfile = os.path.join(local_directory, build + '_results.vcf.gz')
 
-    # builds command from locations supplied in config file
-    ssh.connect(config_dict['remote_ip'],
-                username=config_dict['remote_username'],
-                password=config_dict['remote_password'])
     sftp = ssh.open_sftp()
-    # run VEP for hg19 variants
+    try:
+        sftp.put(local_vcf, remote_vcf)
+        start = time.time()
+        run_remote_command(
+            ssh, vep_command(remote_vcf, remote_outfile, assembly, config_dict, fork) + ' --compress_output gzip')
+        logger.info("Remote VEP {assembly}: {seconds:.1f}s".format(assembly=assembly, seconds=time.time() - start))
+        sftp.get(remote_outfile, local_outfile)
+    finally:
+        sftp.close()
+    return local_outfile
+
+
+def run_vep_remotely(infile, config_dict, local_directory):
+    '''
+    Function which runs VEP using paramiko on a remote machine, over the SSH connection shared by the process.
+    Each run works in its own directory, remote_directory/gel2mdt-<uuid> on the remote machine and local_directory
+    locally, so overlapping runs don't overwrite each other. VCFs are uploaded and results downloaded gzipped, and
+    the two genome builds are annotated at once, sharing vep_total_cores
+    :param infile: Dict containing VCFs for the 2 genome builds
+    :param config_dict: Configuration dict
+    :param local_directory: Directory for the run's local files, which the caller removes once it has read the
+    results
+    :return: Dict which contains the locations of the 2 results files relating to the 2 genome builds
+    '''
+    builds = [
+        (build, assembly) for build, assembly in [('hg19', 'GRCh37'), ('hg38', 'GRCh38')]
+        if build + '_vcf' in infile and os.stat(infile[build + '_vcf']).st_size != 0]
     annotated_variant_dict = {}
+    if not builds:
+        return annotated_variant_dict
 
-    if not os.path.isdir('VEP'):
-        os.makedirs('VEP')
-
-    if 'hg19_vcf' in infile:
-        hg19_vcf = infile['hg19_vcf']
-        hg19_outfile = 'VEP/hg19_results.vcf'
-        if os.stat(hg19_vcf).st_size != 0:
-            sftp.put(hg19_vcf, '{remote_destination}/hg19_destination_file.txt'.format(
-                remote_destination=config_dict['remote_directory']
-            ))
-
-            cmd = "{vep} -i {remote_destination}/hg19_destination_file.txt " \
-                  " -o {remote_destination}/hg19_output.txt --species homo_sapiens --cache_version {cache_version} "  \
-                  " --force_overwrite --cache --dir_cache {cache} --fork 4 --vcf --flag_pick --assembly GRCh37 " \
-                  " --exclude_predicted --everything --hgvsg --dont_skip --total_length --offline --fasta {fasta_loc} ".format(
-                    vep=config_dict['vep'],
-                    cache=config_dict['cache'],
-                    fasta_loc=config_dict['hg19_fasta_loc'],
-                    cache_version=config_dict['cache_version'],
-                    remote_destination=config_dict['remote_directory']
-
-            )
-            if config_dict["mergedVEP"] == 'True':
-                cmd += ' --merged'
-            stdin, stdout, stderr = ssh.exec_command(cmd)
-
-            print('stdin:', stdin, 'stdout:', stdout.read(), 'stderr:', stderr.read())
-            sftp.get('{remote_destination}/hg19_output.txt'.format(
-                remote_destination=config_dict['remote_directory']), hg19_outfile
-            )
-            annotated_variant_dict['hg19_vep'] = hg19_outfile
-    # run VEP for hg38 variants
-    if 'hg38_vcf' in infile:
-        hg38_vcf = infile['hg38_vcf']
-        hg38_outfile = 'VEP/hg38_results.vcf'
-        if os.stat(hg38_vcf).st_size != 0:
-            sftp.put(hg38_vcf, '{remote_destination}/hg38_destination_file.txt'.format(
-                remote_destination=config_dict['remote_directory']
-            ))
-
-            cmd = "{vep} -i {remote_destination}/hg38_destination_file.txt " \
-                  " -o {remote_destination}/hg38_output.txt --species homo_sapiens --cache_version {cache_version} "  \
-                  " --force_overwrite --cache --dir_cache {cache} --fork 4 --vcf --flag_pick --assembly GRCh38 " \
-                  " --exclude_predicted --everything --hgvsg --dont_skip --total_length --offline --fasta {fasta_loc} ".format(
-                    vep=config_dict['vep'],
-                    cache=config_dict['cache'],
-                    cache_version=config_dict['cache_version'],
-                    fasta_loc=config_dict['hg38_fasta_loc'],
-                    remote_destination=config_dict['remote_directory']
-            )
-            if config_dict["mergedVEP"] == 'True':
-                cmd += ' --merged'
-            stdin, stdout, stderr = ssh.exec_command(cmd)
-
-            print('stdin:', stdin, 'stdout:', stdout.read(), 'stderr:', stderr.read())
-            sftp.get('{remote_destination}/hg38_output.txt'.format(remote_destination=config_dict['remote_directory']),
-                     hg38_outfile)
-            annotated_variant_dict['hg38_vep'] = hg38_outfile
-
-    sftp.close()
-    ssh.close()
+    ssh = remote_ssh_client(config_dict)
+    job_directory = '{}/gel2mdt-{}'.format(config_dict['remote_directory'].rstrip('/'), uuid.uuid4().hex)
+    fork = max(1, int(config_dict.get('vep_total_cores') or 4) // len(builds))
+    run_remote_command(ssh, 'mkdir -p {}'.format(job_directory))
+    try:
+        with ThreadPoolExecutor(max_workers=len(builds)) as executor:
+            results = dict(
+                (build, executor.submit(
+                    run_vep_remote_build, ssh, infile[build + '_vcf'], build, assembly, job_directory,
+                    local_directory, fork, config_dict))
+                for build, assembly in builds)
+        for build, result in results.items():
+            annotated_variant_dict[build + '_vep'] = result.result()
+    finally:
+        try:
+            run_remote_command(ssh, 'rm -rf {}'.format(job_directory))
+        except Exception as e:
+            logger.warning("Failed to remove {directory} from the remote VEP server: {error}".format(
+                directory=job_directory, error=e))
     return annotated_variant_dict
 
 
+# the CSQ fields read from VEP's results, in the order of the CaseTranscript arguments after case_id and
+# variant_count
+CSQ_FIELDS = ('Gene', 'SYMBOL', 'HGNC_ID', 'Feature', 'CANONICAL', 'STRAND', 'Consequence', 'MAX_AF', 'PolyPhen',
+              'SIFT', 'HGVSc', 'HGVSp', 'HGVSg')
+
+
+def transcript_records(transcripts):
+    '''
+    Turns the CSQ_FIELDS of each transcript in the CSQ of a variant into the CaseTranscript arguments GeL2MDT
+    stores. A transcript listed more than once keeps its first position and its last values
+    :param transcripts: List of tuples of CSQ_FIELDS values, as yielded by ParseVep.iter_records
+    :return: List of records, one per transcript, each a list of the CaseTranscript arguments after case_id
+    and variant_count
+    '''
+    by_feature = {}
+    for values in transcripts:
+        by_feature[values[3]] = values
+    records = []
+    for (gene_id, gene_name, hgnc_id, transcript_name, canonical, strand, effect, af_max, polyphen, sift,
+         hgvs_c, hgvs_p, hgvs_g) in by_feature.values():
+        if hgnc_id.startswith('HGNC:'):
+            hgnc_id = str(hgnc_id.split(':')[1])
+        if canonical == '':
+            canonical = False
+        records.append([gene_id, gene_name, hgnc_id, transcript_name, canonical, strand, effect, af_max,
+                        polyphen, sift, hgvs_c, hgvs_p.replace('%3D', '='), hgvs_g])
+    return records
+
+
+def parse_vep_records(infile=None):
+    '''
+    Streams the results from VEP as transcript records, GRCh37 first
+    :param infile: Dict from run_vep function which contains VEP vcf file locations
+    :return: Generator of (VCF ID, transcript records) tuples, one per variant. The VCF ID is case_id:variant_count
+    '''
+    if infile is not None:
+        for build in ('hg19_vep', 'hg38_vep'):
+            if build in infile and os.stat(infile[build]).st_size != 0:
+                for variant_id, transcripts in parse_vep.ParseVep().iter_records(infile[build], CSQ_FIELDS):
+                    yield variant_id, transcript_records(transcripts)
+
+
 def parse_vep_annotations(infile=None):
     '''
     Takes the results from VEP and converts them into CaseTranscript objects which will then be passed to CAM for
@@ -245,54 +418,106 @@ def parse_vep_annotations(infile=None):
     :return: List of CaseTranscript objects
     '''
     transcripts_list = []
-    if infile is not None:
-        hg19_variants = []
-        hg38_variants = []
-        if 'hg19_vep' in infile:
-            if os.stat(infile['hg19_vep']).st_size != 0:
-                hg19_variants = parse_vep.ParseVep().read_file(infile['hg19_vep'])
-        if 'hg38_vep' in infile:
-            if os.stat(infile['hg38_vep']).st_size != 0:
-                hg38_variants = parse_vep.ParseVep().read_file(infile['hg38_vep'])
-        # concatenate the two lists of variant dictionaries
-        variants = hg19_variants + hg38_variants
-
-        for variant in variants:
-            case_id = variant['id'].split(":")[0]
-            variant_count = variant['id'].split(":")[1]
-            for transcript in variant['transcript_data']:
-                gene_id = variant['transcript_data'][transcript]['Gene']
-                gene_name = variant['transcript_data'][transcript]['SYMBOL']
-                hgnc_id = variant['transcript_data'][transcript]['HGNC_ID']
-                if hgnc_id.startswith('HGNC:'):
-                    hgnc_id = str(hgnc_id.split(':')[1])
-                if variant['transcript_data'][transcript]['CANONICAL'] == '':
-                    canonical = False
-                else:
-                    canonical = variant['transcript_data'][transcript]['CANONICAL']
-                transcript_name = variant['transcript_data'][transcript]['Feature']
-                transcript_strand = variant['transcript_data'][transcript]['STRAND']
-                proband_transcript_variant_effect = variant['transcript_data'][transcript]['Consequence']
-                transcript_variant_af_max = variant['transcript_data'][transcript]['MAX_AF']
-                variant_polyphen = variant['transcript_data'][transcript]['PolyPhen']
-                variant_sift = variant['transcript_data'][transcript]['SIFT']
-                transcript_variant_hgvs_c = variant['transcript_data'][transcript]['HGVSc']
-                transcript_variant_hgvs_p = variant['transcript_data'][transcript]['HGVSp'].replace('%3D', '=')
-                transcript_variant_hgvs_g = variant['transcript_data'][transcript]['HGVSg']
-                case_transcript = CaseTranscript(case_id, variant_count, gene_id, gene_name, hgnc_id, transcript_name, canonical,
-                                                 transcript_strand, proband_transcript_variant_effect,
-                                                 transcript_variant_af_max, variant_polyphen, variant_sift,
-                                                 transcript_variant_hgvs_c, transcript_variant_hgvs_p,
-                                                 transcript_variant_hgvs_g)
-                transcripts_list.append(case_transcript)
+    for variant_id, records in parse_vep_records(infile):
+        case_id = variant_id.split(":")[0]
+        variant_count = variant_id.split(":")[1]
+        for record in records:
+            transcripts_list.append(CaseTranscript(case_id, variant_count, *record))
     return transcripts_list
 
 
+def run_vep_worker(variants, config_dict):
+    '''
+    Annotates a few variants with the long-lived VEP workers started by `python manage.py run_vep_worker`, which
+    answer without waiting for VEP to load its cache
+    :param variants: List of CaseVariant objects
+    :param config_dict: Configuration dict
+    :return: List of (VCF ID, transcript records) tuples, as from parse_vep_records
+    :raises VEPWorkerError: if the workers can't annotate the variants, so they can be run through VEP in batch
+    '''
+    lines_by_assembly = {}
+    for variant in variants:
+        key = VEPCache.key(variant)
+        if key is not None:
+            lines_by_assembly.setdefault(key[0], []).append(vcf_line(variant))
+    timeout = float(config_dict.get('vep_worker_timeout') or 60)
+    variant_records = []
+    for assembly, lines in sorted(lines_by_assembly.items()):
+        annotated = vep_worker.request_annotations(config_dict['vep_worker_socket'], assembly, lines, timeout)
+        for variant_id, transcripts in parse_vep.ParseVep().iter_lines(annotated, CSQ_FIELDS):
+            variant_records.append((variant_id, transcript_records(transcripts)))
+    return variant_records
+
+
+def annotate_variants(variant_list, config_dict, vep_cache=None):
+    '''
+    Annotates variants with VEP, sending each distinct variant once. With a VEPCache, only the variants which
+    aren't in it are written to the VCFs for VEP, and their annotations are added to it. Up to
+    vep_worker_max_variants variants are sent to the VEP workers if vep_worker_socket is set, falling back to
+    running VEP in batch if they fail.
+    :param variant_list: A list of CaseVariant objects
+    :param config_dict: Configuration dict
+    :param vep_cache: VEPCache, or None to annotate every variant
+    :return: A list of CaseTranscript objects for all the CaseVariants, in the order of the variants
+    '''
+    variant_keys = [VEPCache.key(variant) for variant in variant_list]
+    annotations = {}
+    if vep_cache is not None:
+        annotations = vep_cache.lookup(key for key in variant_keys if key is not None)
+
+    to_annotate = {}
+    for key, variant in zip(variant_keys, variant_list):
+        if key is not None and key not in annotations and key not in to_annotate:
+            to_annotate[key] = variant
+    print("Running VEP for {misses} of {variants} variants".format(
+        misses=len(to_annotate), variants=len(variant_list)))
+
+    if to_annotate:
+        variant_records = None
+        if config_dict.get('vep_worker_socket') and \
+                len(to_annotate) <= int(config_dict.get('vep_worker_max_variants') or 50):
+            try:
+                variant_records = run_vep_worker(list(to_annotate.values()), config_dict)
+            except vep_worker.VEPWorkerError as e:
+                logger.warning("Running VEP in batch as the VEP worker failed: {}".format(e))
+        key_by_id = dict(
+            ("{}:{}".format(variant.case_id, variant.variant_count), key)
+            for key, variant in to_annotate.items())
+        results_directory = None
+        try:
+            if variant_records is None:
+                variant_vcf_dict = generate_vcf(to_annotate.values())
+                if config_dict['remoteVEP'] == 'True':
+                    results_directory = tempfile.mkdtemp(prefix='gel2mdt_vep_')
+                    annotated_files_dict = run_vep_remotely(variant_vcf_dict, config_dict, results_directory)
+                else:
+                    annotated_files_dict = run_vep(variant_vcf_dict, config_dict)
+                variant_records = parse_vep_records(annotated_files_dict)
+            fresh_annotations = {}
+            for variant_id, records in variant_records:
+                fresh_annotations[key_by_id[variant_id]] = records
+        finally:
+            # the results are streamed from the downloaded files, so they can only go once read
+            if results_directory is not None:
+                shutil.rmtree(results_directory, ignore_errors=True)
+        if vep_cache is not None:
+            vep_cache.store(fresh_annotations)
+        annotations.update(fresh_annotations)
+
+    transcript_list = []
+    for key, variant in zip(variant_keys, variant_list):
+        for record in annotations.get(key, []):
+            transcript_list.append(CaseTranscript(
+                str(variant.case_id), str(variant.variant_count), *record))
+    return transcript_list
+
+
 def generate_transcripts(variant_list):
     '''
     Wrapper function for running VEP for MCA. This take as input a variant_list which contains all the variants
     for the cases which MCA will update/add. If bypass_VEP function is used from the config, this will read in
-    the temp.vep.vcf file for transcripts
+    the temp.vep.vcf file for transcripts. Annotations are reused from the VEP annotation cache, if one is set up
+    in the config, so only variants which aren't in it are run through VEP
     :param variant_list: A list of Casevariant objects
     :return: A list of CaseTranscript objects for all the CaseVariants
     '''
@@ -303,12 +528,7 @@ def generate_transcripts(variant_list):
         transcript_list = parse_vep_annotations()
 
     elif config_dict["bypass_VEP"] == "False":
-        print("Running VEP")
-        variant_vcf_dict = generate_vcf(variant_list)
-        if config_dict['remoteVEP'] == 'True':
-            annotated_files_dict = run_vep_remotely(variant_vcf_dict, config_dict)
-        else:
-            annotated_files_dict = run_vep(variant_vcf_dict, config_dict)
-        transcript_list = parse_vep_annotations(annotated_files_dict)
-
-    return transcript_list
\ No newline at end of file
+        transcript_list = annotate_variants(
+            variant_list, config_dict, VEPCache.from_config(config_dict))
+
+    return transcript_list
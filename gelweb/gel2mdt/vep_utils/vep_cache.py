@@ -0,0 +1,169 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import contextlib
+import json
+import os
+import sqlite3
+
+from ..config import load_config
+
+
+class VEPCache(object):
+    """
+    Local cache of VEP annotations, so that variants seen in earlier updates
+    (recurrent variants, and those of re-versioned cases) aren't sent to VEP
+    again.
+
+    Each variant's annotation is stored as the list of per-transcript records
+    parsed from its CSQ (see run_vep_batch.transcript_records), keyed by
+    assembly, chromosome, position, reference and alternate, along with the
+    VEP version, cache_version and mergedVEP it was annotated with. Only
+    annotations matching the current configuration are returned, and those
+    from any other configuration are deleted the first time the cache is
+    opened after it changes.
+
+    Attributes:
+        directory (str): directory holding the SQLite cache.
+        vep_version (str): version of VEP, from config.txt.
+        cache_version (str): version of the VEP cache, from config.txt.
+        merged (bool): whether VEP is run with --merged.
+    """
+    index_name = "vep_annotations.sqlite3"
+
+    def __init__(self, directory, vep_version, cache_version, merged):
+        self.directory = directory
+        self.vep_version = str(vep_version)
+        self.cache_version = str(cache_version)
+        self.merged = bool(merged)
+        self.index_path = os.path.join(directory, self.index_name)
+        os.makedirs(directory, exist_ok=True)
+        with self.connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS annotation (
+                    assembly TEXT NOT NULL,
+                    chromosome TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    reference TEXT NOT NULL,
+                    alternate TEXT NOT NULL,
+                    vep_version TEXT NOT NULL,
+                    cache_version TEXT NOT NULL,
+                    merged INTEGER NOT NULL,
+                    transcripts TEXT NOT NULL,
+                    PRIMARY KEY (assembly, chromosome, position, reference, alternate,
+                                 vep_version, cache_version, merged)
+                )""")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS configuration (
+                    vep_version TEXT NOT NULL,
+                    cache_version TEXT NOT NULL,
+                    merged INTEGER NOT NULL
+                )""")
+            versions = (self.vep_version, self.cache_version, int(self.merged))
+            if connection.execute(
+                    "SELECT * FROM configuration").fetchall() != [versions]:
+                connection.execute(
+                    "DELETE FROM annotation WHERE NOT "
+                    "(vep_version = ? AND cache_version = ? AND merged = ?)", versions)
+                connection.execute("DELETE FROM configuration")
+                connection.execute("INSERT INTO configuration VALUES (?, ?, ?)", versions)
+
+    @classmethod
+    def from_config(cls, config_dict=None):
+        """
+        Opens the cache set up in config.txt, or returns None if either
+        vep_annotation_cache or vep_version is blank, in which case every
+        variant is sent to VEP.
+        """
+        if config_dict is None:
+            config_dict = load_config.LoadConfig().load()
+        directory = config_dict.get('vep_annotation_cache')
+        vep_version = config_dict.get('vep_version')
+        if not directory or not vep_version:
+            return None
+        return cls(directory, vep_version, config_dict['cache_version'],
+                   config_dict.get('mergedVEP') == 'True')
+
+    @contextlib.contextmanager
+    def connect(self):
+        """
+        Context manager giving a connection to the cache, committed and closed
+        on exit.
+        """
+        connection = sqlite3.connect(self.index_path, timeout=60)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    @staticmethod
+    def key(variant):
+        """
+        Returns the (assembly, chromosome, position, reference, alternate) of
+        a CaseVariant, or None if it is on neither GRCh37 nor GRCh38 and so
+        isn't annotated.
+        """
+        if 'GRCh37' in variant.genome_build:
+            assembly = 'GRCh37'
+        elif 'GRCh38' in variant.genome_build:
+            assembly = 'GRCh38'
+        else:
+            return None
+        return (assembly, str(variant.chromosome), int(variant.position),
+                variant.ref, variant.alt)
+
+    def lookup(self, keys):
+        """
+        Returns the cached transcript records of the variants with the given
+        keys by key. Variants which aren't cached are left out.
+        """
+        versions = (self.vep_version, self.cache_version, int(self.merged))
+        annotations = {}
+        with self.connect() as connection:
+            for key in set(keys):
+                row = connection.execute(
+                    "SELECT transcripts FROM annotation WHERE assembly = ? AND chromosome = ? "
+                    "AND position = ? AND reference = ? AND alternate = ? AND vep_version = ? "
+                    "AND cache_version = ? AND merged = ?", key + versions).fetchone()
+                if row is not None:
+                    annotations[key] = json.loads(row[0])
+        return annotations
+
+    def store(self, annotations):
+        """
+        Caches the transcript records of freshly annotated variants.
+
+        Args:
+            annotations (dict): lists of transcript records by variant key.
+        """
+        versions = (self.vep_version, self.cache_version, int(self.merged))
+        with self.connect() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO annotation VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key + versions + (json.dumps(records),)
+                 for key, records in annotations.items()))
+
+    def stats(self):
+        """
+        Returns a dict of the number of variants cached.
+        """
+        with self.connect() as connection:
+            variants, = connection.execute("SELECT COUNT(*) FROM annotation").fetchone()
+        return {'variants': variants}
@@ -0,0 +1,290 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import json
+import logging
+import os
+import pty
+import select
+import socket
+import socketserver
+import subprocess
+import threading
+import time
+import tty
+
+# set up logging
+logger = logging.getLogger(__name__)
+
+
+class VEPWorkerError(Exception):
+    """
+    Raised when a VEP worker can't annotate a request, so that the caller can
+    fall back to running VEP in batch.
+    """
+    pass
+
+
+class VEPProcess(object):
+    """
+    A VEP process for one assembly which is kept running between requests,
+    so that the cache and FASTA are only loaded once. VEP reads VCF lines
+    from its stdin and writes annotated lines to its stdout, which is a
+    pseudo-terminal so that each line is flushed as soon as it is written
+    rather than when Perl's buffer fills.
+
+    VEP may hold back the last line it has read until it sees the next, so
+    each request is followed by a flush line, whose annotation is dropped.
+
+    Attributes:
+        assembly (str): GRCh37 or GRCh38.
+        cmd (str): command running VEP, reading STDIN and writing STDOUT.
+        timeout (float): seconds to wait for a request's annotations.
+        header (list): VCF header lines VEP has written, with the CSQ format.
+        restarts (int): number of times VEP has been (re)started.
+    """
+    flush_id = 'gel2mdt_flush'
+
+    def __init__(self, assembly, cmd, timeout=60):
+        self.assembly = assembly
+        self.cmd = cmd
+        self.timeout = timeout
+        self.process = None
+        self.output_fd = None
+        self.buffer = b''
+        self.header = []
+        self.restarts = 0
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        self.stop()
+        master_fd, slave_fd = pty.openpty()
+        # no newline translation or echo on the terminal
+        tty.setraw(slave_fd)
+        self.process = subprocess.Popen(
+            'exec ' + self.cmd, shell=True, stdin=subprocess.PIPE, stdout=slave_fd,
+            close_fds=True)
+        os.close(slave_fd)
+        self.output_fd = master_fd
+        self.buffer = b''
+        self.header = []
+        self.restarts += 1
+        logger.info("Started VEP worker for {assembly} (pid {pid})".format(
+            assembly=self.assembly, pid=self.process.pid))
+
+    def stop(self):
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+            self.process.stdin.close()
+            self.process = None
+        if self.output_fd is not None:
+            os.close(self.output_fd)
+            self.output_fd = None
+
+    def readline(self, deadline):
+        """
+        Returns the next line VEP writes, without its newline, waiting until
+        deadline at most.
+        """
+        while b'\n' not in self.buffer:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise VEPWorkerError('VEP {} timed out'.format(self.assembly))
+            readable, _, _ = select.select([self.output_fd], [], [], remaining)
+            if not readable:
+                continue
+            try:
+                data = os.read(self.output_fd, 1 << 16)
+            except OSError:
+                # the terminal raises EIO once VEP has exited
+                data = b''
+            if not data:
+                raise VEPWorkerError('VEP {} exited'.format(self.assembly))
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        return line.decode('utf-8')
+
+    def annotate(self, lines):
+        """
+        Annotates VCF lines with VEP.
+
+        Args:
+            lines (list): tab separated CHROM, POS, ID, REF and ALT lines,
+                without newlines. Each ID must be unique.
+
+        Returns:
+            list: the annotated lines, in VEP's order, without the header.
+
+        Raises:
+            VEPWorkerError: if VEP exits or doesn't answer in time, in which
+                case it is stopped.
+        """
+        if not self.is_alive():
+            raise VEPWorkerError('VEP {} is not running'.format(self.assembly))
+        waiting = set(line.split('\t')[2] for line in lines)
+        columns = lines[0].split('\t')
+        flush_line = '\t'.join(columns[:2] + [self.flush_id] + columns[3:5])
+        deadline = time.time() + self.timeout
+        try:
+            self.process.stdin.write(
+                ''.join(line + '\n' for line in lines + [flush_line]).encode('utf-8'))
+            self.process.stdin.flush()
+            annotated = []
+            while waiting:
+                line = self.readline(deadline)
+                if line.startswith('#'):
+                    # VEP writes the header once, before its first annotation
+                    self.header.append(line)
+                    continue
+                variant_id = line.split('\t', 3)[2]
+                if variant_id in waiting:
+                    waiting.remove(variant_id)
+                    annotated.append(line)
+            return annotated
+        except (OSError, VEPWorkerError) as e:
+            self.stop()
+            raise VEPWorkerError(str(e))
+
+
+class VEPWorkerHandler(socketserver.StreamRequestHandler):
+    """
+    Answers one request per connection. A request is a line of JSON
+    {"assembly": "GRCh37", "variants": [<VCF line>, ...]}, and the response
+    a line of JSON {"lines": [<annotated VCF line>, ...]} with the header
+    first, or {"error": <message>}.
+    """
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            lines = self.server.annotate(request['assembly'], request['variants'])
+            response = {'lines': lines}
+        except (ValueError, KeyError, VEPWorkerError) as e:
+            response = {'error': str(e)}
+        self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+
+class VEPWorkerServer(socketserver.ThreadingUnixStreamServer):
+    """
+    Serves VEP annotations over a UNIX socket from a long-lived VEPProcess
+    per assembly, for single variants and small batches which shouldn't
+    wait for VEP to start. Requests for the same assembly are annotated one
+    at a time. A VEP process which has exited or stopped answering is
+    restarted and the request tried once more.
+
+    Attributes:
+        socket_path (str): path of the UNIX socket.
+        processes (dict): VEPProcess by assembly.
+        max_variants (int): largest request accepted.
+        requests_served (int): number of requests annotated.
+    """
+    daemon_threads = True
+    warmup_line = '1\t1000000\tgel2mdt_warmup\tA\tG'
+
+    def __init__(self, socket_path, commands, timeout=60, max_variants=50):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        socketserver.ThreadingUnixStreamServer.__init__(self, socket_path, VEPWorkerHandler)
+        self.socket_path = socket_path
+        self.processes = dict(
+            (assembly, VEPProcess(assembly, cmd, timeout)) for assembly, cmd in commands.items())
+        self.locks = dict((assembly, threading.Lock()) for assembly in commands)
+        self.max_variants = max_variants
+        self.requests_served = 0
+
+    def warm_up(self):
+        """
+        Starts VEP for each assembly and annotates one variant with it, so
+        that the first real request doesn't wait for VEP to load.
+        """
+        for assembly in self.processes:
+            start = time.time()
+            try:
+                self.annotate(assembly, [self.warmup_line])
+            except VEPWorkerError as e:
+                logger.error("VEP worker for {assembly} failed to start: {error}".format(
+                    assembly=assembly, error=e))
+                continue
+            logger.info("VEP worker for {assembly} ready in {seconds:.1f}s".format(
+                assembly=assembly, seconds=time.time() - start))
+
+    def annotate(self, assembly, lines):
+        """
+        Returns the header and annotated lines for VCF lines on assembly.
+        """
+        if assembly not in self.processes:
+            raise VEPWorkerError('No VEP worker for {}'.format(assembly))
+        if not lines:
+            return []
+        if len(lines) > self.max_variants:
+            raise VEPWorkerError('{} variants is more than the {} a VEP worker takes'.format(
+                len(lines), self.max_variants))
+        process = self.processes[assembly]
+        with self.locks[assembly]:
+            for attempt in range(2):
+                if not process.is_alive():
+                    process.start()
+                try:
+                    annotated = process.annotate(lines)
+                    break
+                except VEPWorkerError as e:
+                    logger.warning("Restarting VEP worker for {assembly}: {error}".format(
+                        assembly=assembly, error=e))
+                    if attempt:
+                        raise
+            self.requests_served += 1
+            return process.header + annotated
+
+    def server_close(self):
+        socketserver.ThreadingUnixStreamServer.server_close(self)
+        for process in self.processes.values():
+            process.stop()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def request_annotations(socket_path, assembly, lines, timeout=60):
+    """
+    Asks the VEP worker listening on socket_path to annotate VCF lines.
+
+    Returns:
+        list: the annotated VCF lines, header first.
+
+    Raises:
+        VEPWorkerError: if the worker isn't running, doesn't answer in time
+            or can't annotate the lines.
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(timeout)
+            connection.connect(socket_path)
+            connection.sendall((json.dumps({'assembly': assembly, 'variants': lines}) + '\n').encode('utf-8'))
+            with connection.makefile('rb') as response_file:
+                response = response_file.readline()
+    except OSError as e:
+        raise VEPWorkerError('VEP worker at {} unavailable: {}'.format(socket_path, e))
+    try:
+        response = json.loads(response.decode('utf-8'))
+    except ValueError:
+        raise VEPWorkerError('VEP worker at {} gave no answer'.format(socket_path))
+    if 'error' in response:
+        raise VEPWorkerError(response['error'])
+    return response['lines']
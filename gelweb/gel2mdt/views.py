@@ -1643,15 +1643,9 @@ def audit(request, sample_type):
     :return:
     '''
     config_dict = load_config.LoadConfig().load()
-    # Getting all GELIRs
-    qs = GELInterpretationReport.objects.filter(
-        sample_type=sample_type).prefetch_related(*['ir_family', 'ir_family__participant_family__proband'])
-
-    # Filtering out duplicates
-    qs_df = pd.DataFrame(list(qs.values())).sort_values(by=['ir_family_id', 'archived_version'])
-    multi_archived = qs_df.drop_duplicates(subset=['ir_family_id'], keep='last')
-    ids_of_latest = multi_archived["id"].tolist()
-    queryset = GELInterpretationReport.objects.filter(id__in=ids_of_latest).filter(~Q(status='blocked'))
+    # Getting the latest GELIR of each case
+    queryset = GELInterpretationReport.objects.latest_cases_by_sample_type(
+        sample_type).filter(~Q(status='blocked'))
 
     # Getting case status options
     status_choices = dict(GELInterpretationReport._meta.get_field('case_status').choices)